@@ -0,0 +1,197 @@
+import os, sys, json, errno, shutil, hashlib, argparse, threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_ROOT = os.getenv("ARTIFACT_STORE", "artifacts")
+MANIFEST_NAME = "manifest.json"
+
+
+def file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def reflink(src: str, dest: str):
+    """Copy-on-write clone of ``src`` at ``dest``, on file systems that have them (Btrfs, XFS)."""
+    if fcntl is None or not hasattr(fcntl, "FICLONE"):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        fcntl.ioctl(d.fileno(), fcntl.FICLONE, s.fileno())
+
+
+def link_or_copy(src: str, dest: str) -> str:
+    """Place ``src`` at ``dest`` as a hard link, else a reflink, else a copy; returns which."""
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        reflink(src, dest)
+        return "reflink"
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+    shutil.copyfile(src, dest)
+    return "copy"
+
+
+def _write_json(path: str, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+class ArtifactStore:
+    """
+    Content-addressed store of firmware artifacts: every distinct file is kept once,
+    read-only, as ``<root>/sha256/<ab>/<digest>`` and linked into the per-firmware
+    trees, so a jar shared by a hundred builds takes the space of one.
+
+    ``aliases.json`` maps keys known before a download, such as the git blob id or
+    the ETag of a file, to the digest of its content, so known files are linked
+    instead of downloaded. Files in the trees are links to the blobs and must be
+    replaced, never written to in place.
+    """
+
+    def __init__(self, root: str = DEFAULT_ROOT):
+        self.root = root
+        self.aliases_path = os.path.join(root, "aliases.json")
+        self.stats = dict(added=0, deduplicated=0, linked=0)
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._aliases = {}
+        os.makedirs(os.path.join(root, "sha256"), exist_ok=True)
+        if os.path.exists(self.aliases_path):
+            with open(self.aliases_path, "r") as f:
+                self._aliases = json.load(f)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, "sha256", digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.blob_path(digest))
+
+    @staticmethod
+    def _identity(path: str) -> tuple:
+        stat = os.stat(path)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def digest(self, path: str) -> str:
+        """SHA-256 of ``path``, remembered per inode so links to one blob are hashed once."""
+        identity = self._identity(path)
+        with self._lock:
+            digest = self._digests.get(identity)
+        if digest is None:
+            digest = file_sha256(path)
+            with self._lock:
+                self._digests[identity] = digest
+        return digest
+
+    def add(self, path: str, digest: str = None) -> str:
+        """
+        Store the content of ``path`` and leave a link to its blob there; if the blob
+        exists already, ``path`` is replaced by a link to it. ``digest`` skips hashing
+        when the caller has just verified it. Returns the digest.
+        """
+        digest = digest or self.digest(path)
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            if os.path.samefile(path, blob):
+                return digest
+            self.link(digest, path)
+            with self._lock:
+                self.stats["deduplicated"] += 1
+            return digest
+
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        temp_path = f"{blob}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if link_or_copy(path, temp_path) != "hardlink":
+            # The store lives on another file system: keep the copy and link back to it
+            os.replace(temp_path, blob)
+            os.chmod(blob, 0o444)
+            self.link(digest, path)
+        else:
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, blob)
+        with self._lock:
+            self._digests[self._identity(blob)] = digest
+            self.stats["added"] += 1
+        return digest
+
+    def link(self, digest: str, dest: str):
+        """Materialize the blob ``digest`` at ``dest``, atomically replacing whatever is there."""
+        temp_path = f"{dest}.{os.getpid()}.{threading.get_ident()}.link"
+        link_or_copy(self.blob_path(digest), temp_path)
+        os.replace(temp_path, dest)
+        with self._lock:
+            self._digests[self._identity(dest)] = digest
+            self.stats["linked"] += 1
+
+    def lookup(self, key: str):
+        """The digest recorded for ``key``, if its blob is still in the store."""
+        with self._lock:
+            digest = self._aliases.get(key)
+        return digest if digest is not None and self.has(digest) else None
+
+    def remember(self, key: str, digest: str):
+        with self._lock:
+            if self._aliases.get(key) == digest:
+                return
+            self._aliases[key] = digest
+            _write_json(self.aliases_path, self._aliases)
+
+    def write_manifest(self, tree: str, subdirs=("bootcp", "systemservercp")) -> dict:
+        """
+        Add every file below ``subdirs`` of a firmware tree to the store and list them,
+        by path relative to the tree, with their digest and size in ``<tree>/manifest.json``.
+        """
+        manifest = {}
+        for subdir in subdirs:
+            for dirpath, _, filenames in os.walk(os.path.join(tree, subdir)):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    digest = self.add(path)
+                    manifest[os.path.relpath(path, tree).replace(os.sep, "/")] = dict(
+                        sha256=digest, size=os.path.getsize(path)
+                    )
+        _write_json(os.path.join(tree, MANIFEST_NAME), manifest)
+        return manifest
+
+    def blobs(self):
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, "sha256")):
+            for filename in filenames:
+                if not filename.endswith((".tmp", ".link")):
+                    yield os.path.join(dirpath, filename)
+
+    def prune(self) -> int:
+        """
+        Remove blobs no tree links to any more, i.e. with a single hard link left.
+        Trees holding reflinks or copies keep their own data and are unaffected.
+        """
+        freed = 0
+        for blob in self.blobs():
+            stat = os.stat(blob)
+            if stat.st_nlink == 1:
+                os.remove(blob)
+                freed += stat.st_size
+        return freed
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Summarize or prune the shared artifact store")
+    arg_parser.add_argument("root", nargs="?", default=DEFAULT_ROOT)
+    arg_parser.add_argument("--prune", action="store_true", help="remove blobs no firmware tree links to")
+    args = arg_parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        sys.exit(f"{args.root} is not an artifact store")
+    store = ArtifactStore(args.root)
+    if args.prune:
+        print(f"Freed {store.prune() / 1e6:.1f} MB")
+    sizes = [os.path.getsize(blob) for blob in store.blobs()]
+    print(f"{len(sizes)} blobs, {sum(sizes) / 1e6:.1f} MB")
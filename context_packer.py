@@ -0,0 +1,143 @@
+import re
+from collections import deque
+from dataclasses import dataclass
+
+# FoundTransaction.process appends each single-invoke-chain target as
+# "\n// <soot method signature>\n<decompiled source>"
+METHOD_HEADER_PATTERN = re.compile(r"^// (<[^<>\n]+: [^<>\n]*? ([\w$<>]+)\([^\n]*\)>)$", re.MULTILINE)
+TOKEN_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d{1,3}|\n|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Approximate the token count of source code the way BPE tokenizers split it:
+    camel-case word pieces, short digit groups, newlines and punctuation each count
+    as about one token, and long pieces count for more.
+    """
+    return sum(1 + len(piece) // 8 for piece in TOKEN_PATTERN.findall(text))
+
+
+@dataclass
+class Method:
+    name: str
+    header: str
+    source: str
+    index: int
+
+    @property
+    def text(self) -> str:
+        if not self.header:
+            return self.source
+        return f"// {self.header}\n{self.source}"
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.text)
+
+
+def split_methods(source: str) -> list[Method]:
+    """Split a ``binder_interface`` source into the entry method and the methods it calls."""
+    headers = list(METHOD_HEADER_PATTERN.finditer(source))
+    if not headers:
+        return [Method(name="", header="", source=source, index=0)]
+
+    methods = [Method(name="", header="", source=source[:headers[0].start()].rstrip("\n"), index=0)]
+    for idx, match in enumerate(headers):
+        end = headers[idx + 1].start() if idx + 1 < len(headers) else len(source)
+        methods.append(Method(
+            name=match.group(2),
+            header=match.group(1),
+            source=source[match.end():end].strip("\n"),
+            index=idx + 1,
+        ))
+    return methods
+
+
+def call_graph_order(methods: list[Method]) -> list[Method]:
+    """
+    Order methods by call distance from the entry method (breadth first over calls
+    found by name in each body), keeping the original order between equals. Methods
+    that cannot be reached come last.
+    """
+    callees = {
+        method.index: [
+            other for other in methods[1:]
+            # Not \b: names such as <init> and <clinit> do not start with a word character
+            if other.index != method.index and re.search(rf"(?<![\w$]){re.escape(other.name)}\s*\(", method.source)
+        ]
+        for method in methods
+    }
+
+    ordered = []
+    seen = {methods[0].index}
+    queue = deque([methods[0]])
+    while queue:
+        method = queue.popleft()
+        ordered.append(method)
+        for callee in callees[method.index]:
+            if callee.index not in seen:
+                seen.add(callee.index)
+                queue.append(callee)
+
+    ordered.extend(method for method in methods if method.index not in seen)
+    return ordered
+
+
+def truncate_line_to_tokens(line: str, budget: int) -> str:
+    """The longest prefix of ``line`` costing at most ``budget`` tokens, cutting long pieces if needed."""
+    used = 0
+    for match in TOKEN_PATTERN.finditer(line):
+        cost = 1 + len(match.group()) // 8
+        if used + cost > budget:
+            if used >= budget:
+                return line[:match.start()]
+            # A piece of up to 8 * n - 1 characters costs n tokens
+            return line[:match.start() + (budget - used) * 8 - 1]
+        used += cost
+    return line
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    lines = text.split("\n")
+    kept = []
+    used = 0
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            if not kept:
+                # Even the first line is too long, e.g. minified or generated code
+                kept.append(truncate_line_to_tokens(line, budget - 1))
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept) + f"\n// Truncated from {len(lines)} lines"
+
+
+def pack_source(source: str, token_budget: int) -> str:
+    """
+    Fit ``source`` into ``token_budget`` tokens. The entry method always comes first
+    (truncated only if it alone is too large); called methods follow in call-graph
+    order for as long as they fit, and the names of left-out methods are listed at
+    the end.
+    """
+    if estimate_tokens(source) <= token_budget:
+        return source
+
+    methods = call_graph_order(split_methods(source))
+    entry = methods[0]
+    if entry.tokens >= token_budget:
+        return truncate_to_tokens(entry.text, token_budget)
+
+    packed = [entry.text]
+    used = entry.tokens
+    omitted = []
+    for method in methods[1:]:
+        if used + method.tokens + 1 <= token_budget:
+            packed.append(method.text)
+            used += method.tokens + 1
+        else:
+            omitted.append(method.name)
+
+    if omitted:
+        packed.append(f"// Omitted {len(omitted)} called methods: {', '.join(omitted)}")
+    return "\n".join(packed)
@@ -0,0 +1,454 @@
+import os, re, sys, json, time, shutil, threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from artifact_store import ArtifactStore, file_sha256
+
+
+class Progress:
+    """Aggregate progress of all downloads, printed at most every ``interval`` seconds."""
+
+    def __init__(self, interval: float = 1.0, stream=sys.stdout):
+        self.interval = interval
+        self.stream = stream
+        self.started = time.monotonic()
+        self.files = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self._printed = 0.0
+        self._lock = threading.Lock()
+
+    def add_file(self):
+        with self._lock:
+            self.files += 1
+
+    def add_total(self, size: int):
+        with self._lock:
+            self.bytes_total += size
+
+    def advance(self, size: int):
+        with self._lock:
+            self.bytes_done += size
+            self._maybe_print()
+
+    def file_done(self):
+        with self._lock:
+            self.files_done += 1
+            self._maybe_print(force=True)
+
+    def _maybe_print(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._printed < self.interval:
+            return
+        self._printed = now
+        rate = self.bytes_done / max(now - self.started, 1e-6) / 1e6
+        print(f"\r{self.files_done}/{self.files} files, {self.bytes_done / 1e6:.1f}/{self.bytes_total / 1e6:.1f} MB, "
+              f"{rate:.1f} MB/s", end="", file=self.stream, flush=True)
+
+    def finish(self):
+        with self._lock:
+            if self.files:
+                self._maybe_print(force=True)
+                print(file=self.stream)
+
+
+class DownloadChanged(Exception):
+    """The remote file no longer matches the partial download, which has to start over."""
+
+
+class IncompleteDownload(IOError):
+    """The transfer ended early; the partial file is kept for a later resume."""
+
+
+class ChecksumStore:
+    """
+    JSON file of the SHA-256, size and modification time of every completed download,
+    keyed by path relative to the file's directory. A recorded file whose size and
+    mtime are unchanged counts as verified; otherwise it is hashed again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._base = os.path.dirname(os.path.abspath(path))
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+
+    def _key(self, filename: str) -> str:
+        return os.path.relpath(os.path.abspath(filename), self._base)
+
+    def get(self, filename: str):
+        with self._lock:
+            return self._entries.get(self._key(filename))
+
+    def verified(self, filename: str) -> bool:
+        entry = self.get(filename)
+        if entry is None or not os.path.exists(filename):
+            return False
+        stat = os.stat(filename)
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        if file_sha256(filename) != entry["sha256"]:
+            return False
+        self.record(filename, entry["sha256"], url=entry.get("url"), etag=entry.get("etag"))
+        return True
+
+    def record(self, filename: str, sha256: str, url: str = None, etag: str = None):
+        stat = os.stat(filename)
+        with self._lock:
+            self._entries[self._key(filename)] = dict(
+                sha256=sha256, size=stat.st_size, mtime_ns=stat.st_mtime_ns, url=url, etag=etag
+            )
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self._entries, f, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+
+class PartialDownload:
+    """
+    Resume state of ``<file>.part``, kept next to it as ``<file>.part.json``: the URL,
+    the ETag and size the transfer started with, and how many bytes of each segment
+    ``[start, end)`` have been written.
+    """
+
+    def __init__(self, part_path: str, url: str, size: int = None, etag: str = None, segments: list = None):
+        self.part_path = part_path
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.segments = segments or [[0, size, 0]]
+        self._lock = threading.Lock()
+
+    @property
+    def state_path(self) -> str:
+        return self.part_path + ".json"
+
+    @property
+    def written(self) -> int:
+        return sum(done for _, _, done in self.segments)
+
+    @classmethod
+    def load(cls, part_path: str, url: str):
+        state_path = part_path + ".json"
+        if os.path.exists(state_path):
+            with open(state_path, "r") as f:
+                saved = json.load(f)
+            if saved["url"] == url and os.path.exists(part_path):
+                return cls(part_path, url, saved["size"], saved["etag"], saved["segments"])
+            # State of another transfer, or without its .part: a segmented .part is
+            # preallocated, so its size says nothing about what was written. Start over.
+            if saved["url"] != url:
+                print(f"Discarding {part_path} left by a download of {saved['url']}")
+            cls(part_path, url).discard()
+            return None
+        if os.path.exists(part_path):
+            # A .part without state, e.g. from an older run: resume it as one segment
+            return cls(part_path, url, segments=[[0, None, os.path.getsize(part_path)]])
+        return None
+
+    def save(self):
+        with self._lock:
+            temp_path = self.state_path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(dict(url=self.url, size=self.size, etag=self.etag, segments=self.segments), f)
+            os.replace(temp_path, self.state_path)
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def parse_content_range(value: str):
+    """
+    ``bytes 100-199/1000`` to ``(100, 199, 1000)`` and ``bytes */1000`` to
+    ``(None, None, 1000)``; the total is None for ``*``.
+    """
+    match = re.fullmatch(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)", (value or "").strip())
+    if not match:
+        return None
+    first, last, total = match.groups()
+    return (
+        None if first is None else int(first),
+        None if last is None else int(last),
+        None if total == "*" else int(total),
+    )
+
+
+def etag_key(url: str, resp: requests.Response):
+    """
+    Artifact store key of the content behind a ``HEAD`` response: its ETag, scoped to
+    the host and size since ETags are only meant to be unique per server.
+    """
+    etag = resp.headers.get("ETag") if resp.ok else None
+    if not etag or "Content-Length" not in resp.headers:
+        return None
+    return f"etag {urlparse(resp.url or url).netloc} {etag} {resp.headers['Content-Length']}"
+
+
+class DownloadManager:
+    """
+    Downloads files on a bounded pool of worker threads sharing one pooled session,
+    with at most ``per_host`` transfers to the same host at a time.
+
+    Interrupted downloads resume from their ``.part`` file with ``Range`` requests,
+    guarded by the ETag and size seen when they started. Files of at least
+    ``segment_threshold`` bytes are fetched as ``segments`` parallel ranges when the
+    server supports them. With a ``checksum_path``, completed files are hashed and
+    recorded there, and later runs skip files that still match their record.
+
+    With an ``artifacts`` store, completed files are moved into it and linked back,
+    and a file whose key (given to ``submit``, else the host, ETag and size from a
+    ``HEAD`` request) maps to a stored blob is linked instead of downloaded.
+    """
+
+    def __init__(self, max_workers: int = 8, per_host: int = 4, chunk_size: int = 1024 * 1024,
+                 progress_interval: float = 1.0, timeout=(10, 60), checksum_path: str = None,
+                 segments: int = 4, segment_threshold: int = 64 * 1024 * 1024, artifacts: ArtifactStore = None):
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.checksums = ChecksumStore(checksum_path) if checksum_path else None
+        self.artifacts = artifacts
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.progress = Progress(progress_interval)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self._per_host = per_host
+        self._host_slots = defaultdict(lambda: threading.BoundedSemaphore(self._per_host))
+        self._host_lock = threading.Lock()
+        self._futures: list[Future] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _slot(self, url: str) -> threading.BoundedSemaphore:
+        with self._host_lock:
+            return self._host_slots[urlparse(url).netloc]
+
+    def get_json(self, url: str):
+        with self._slot(url):
+            resp = self.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    def get_binary(self, url: str) -> bytes:
+        with self._slot(url):
+            resp = self.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.content
+
+    def download(self, url: str, filename: str, key: str = None):
+        """Download ``url`` to ``filename`` on the calling thread, unless the file already exists."""
+        self.progress.add_file()
+        return self._download(url, filename, key)
+
+    def _download(self, url: str, filename: str, key: str = None):
+        if self.checksums is None and self.artifacts is None and os.path.exists(filename):
+            print(f"{filename} already exists.")
+            self.progress.file_done()
+            return filename
+        if self.checksums is not None and self.checksums.verified(filename):
+            print(f"{filename} already downloaded and verified.")
+            if self.artifacts is not None:
+                entry = self.checksums.get(filename)
+                self._store(url, filename, entry["sha256"], entry.get("etag"), key)
+            self.progress.file_done()
+            return filename
+
+        part_path = filename + ".part"
+        head = None
+        if self.artifacts is not None:
+            if key is None:
+                head = self._head(url)
+                key = etag_key(url, head)
+            digest = self.artifacts.lookup(key) if key else None
+            if digest is not None:
+                print(f"{filename} linked from the artifact store.")
+                self.artifacts.link(digest, filename)
+                PartialDownload(part_path, url).discard()
+                self._store(url, filename, digest, head.headers.get("ETag") if head else None, key)
+                self.progress.file_done()
+                return filename
+
+        if os.path.exists(filename):
+            if self.checksums is not None and self.checksums.get(filename) is not None:
+                print(f"{filename} does not match its checksum, downloading it again")
+                os.remove(filename)
+            elif not os.path.exists(part_path):
+                # Never recorded: let a range request from its end tell if anything is missing
+                if os.stat(filename).st_nlink > 1:
+                    # Linked to a stored blob, which appending to would corrupt
+                    shutil.copyfile(filename, part_path)
+                    os.remove(filename)
+                else:
+                    os.replace(filename, part_path)
+
+        try:
+            partial = self._transfer(url, part_path, head)
+        except DownloadChanged as e:
+            print(f"Restarting {filename}: {e}")
+            PartialDownload(part_path, url).discard()
+            partial = self._transfer(url, part_path)
+
+        os.replace(part_path, filename)
+        if os.path.exists(partial.state_path):
+            os.remove(partial.state_path)
+        if self.checksums is not None or self.artifacts is not None:
+            self._store(url, filename, file_sha256(filename), partial.etag, key)
+        self.progress.file_done()
+        return filename
+
+    def _store(self, url: str, filename: str, digest: str, etag: str = None, key: str = None):
+        # Into the artifact store first, since linking ``filename`` to a blob changes its mtime
+        if self.artifacts is not None:
+            self.artifacts.add(filename, digest)
+            if key:
+                self.artifacts.remember(key, digest)
+        if self.checksums is not None:
+            self.checksums.record(filename, digest, url=url, etag=etag)
+
+    def _head(self, url: str) -> requests.Response:
+        # The same encoding as the GETs, so Content-Length and ETag describe the bytes they return
+        with self._slot(url):
+            return self.session.head(url, allow_redirects=True, timeout=self.timeout,
+                                     headers={"Accept-Encoding": "identity"})
+
+    def _plan(self, url: str, part_path: str, head: requests.Response = None) -> PartialDownload:
+        resp = head if head is not None else self._head(url)
+        if not resp.ok:
+            return PartialDownload(part_path, url)
+        size = int(resp.headers["Content-Length"]) if "Content-Length" in resp.headers else None
+        partial = PartialDownload(part_path, url, size, resp.headers.get("ETag"))
+        if size and size >= self.segment_threshold and self.segments > 1 \
+                and resp.headers.get("Accept-Ranges") == "bytes":
+            step = -(-size // self.segments)
+            partial.segments = [[start, min(start + step, size), 0] for start in range(0, size, step)]
+        return partial
+
+    def _transfer(self, url: str, part_path: str, head: requests.Response = None) -> PartialDownload:
+        partial = PartialDownload.load(part_path, url)
+        if partial is None:
+            partial = self._plan(url, part_path, head)
+            with open(part_path, "wb") as f:
+                if len(partial.segments) > 1:
+                    f.truncate(partial.size)
+            partial.save()
+        elif partial.written:
+            print(f"Resuming {url} from {partial.written} bytes")
+
+        if partial.size is not None:
+            self.progress.add_total(partial.size - partial.written)
+        if len(partial.segments) == 1:
+            self._fetch_segment(partial, 0)
+        else:
+            with ThreadPoolExecutor(max_workers=len(partial.segments), thread_name_prefix="segment") as pool:
+                for future in [pool.submit(self._fetch_segment, partial, idx) for idx in range(len(partial.segments))]:
+                    future.result()
+
+        written = os.path.getsize(part_path)
+        if partial.size is not None and written != partial.size:
+            raise IncompleteDownload(f"{url}: got {written} of {partial.size} bytes")
+        return partial
+
+    def _fetch_segment(self, partial: PartialDownload, idx: int):
+        segment = partial.segments[idx]
+        start, end, done = segment
+        if end is not None and start + done >= end:
+            return
+
+        # Sizes and offsets are of the stored bytes, so ask for them unencoded
+        headers = {"Accept-Encoding": "identity"}
+        ranged = start + done > 0 or len(partial.segments) > 1
+        if ranged:
+            headers["Range"] = f"bytes={start + done}-{end - 1 if end is not None else ''}"
+            if partial.etag and not partial.etag.startswith("W/"):
+                headers["If-Range"] = partial.etag
+
+        with self._slot(partial.url), \
+                self.session.get(partial.url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 416 and end is None:
+                # Nothing after the current end: complete if the server's size agrees
+                content_range = parse_content_range(r.headers.get("Content-Range"))
+                if content_range is None or content_range[2] != start + done:
+                    raise DownloadChanged(f"range from {start + done} not satisfiable")
+                partial.size = content_range[2]
+                return
+            r.raise_for_status()
+            etag = r.headers.get("ETag")
+            if partial.etag and etag and etag != partial.etag:
+                raise DownloadChanged(f"ETag changed from {partial.etag} to {etag}")
+            if ranged and r.status_code != 206:
+                raise DownloadChanged("server answered a range request with the whole file")
+            if r.status_code == 206:
+                content_range = parse_content_range(r.headers.get("Content-Range"))
+                if content_range is None or content_range[0] != start + done:
+                    raise DownloadChanged(f"unexpected Content-Range {r.headers.get('Content-Range')}")
+                total = content_range[2]
+            else:
+                total = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+            if partial.size is None and total is not None:
+                partial.size = total
+                self.progress.add_total(total - partial.written)
+            elif total is not None and total != partial.size:
+                raise DownloadChanged(f"size changed from {partial.size} to {total}")
+            if partial.etag is None:
+                partial.etag = etag
+
+            with open(partial.part_path, "r+b") as f:
+                f.seek(start + done)
+                saved = done
+                try:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        if end is not None:
+                            chunk = chunk[:end - start - segment[2]]
+                        f.write(chunk)
+                        segment[2] += len(chunk)
+                        self.progress.advance(len(chunk))
+                        if segment[2] - saved >= 8 * self.chunk_size:
+                            f.flush()
+                            partial.save()
+                            saved = segment[2]
+                finally:
+                    # Also after a dropped connection, so a resume continues from here
+                    f.flush()
+                    partial.save()
+
+        if end is not None and start + segment[2] < end:
+            raise IncompleteDownload(f"{partial.url}: segment {start}-{end} ended at {start + segment[2]}")
+
+    def submit(self, url: str, filename: str, key: str = None) -> Future:
+        """
+        Queue a download; the future's result is ``filename``. ``key`` names the content
+        in the artifact store before it is downloaded, e.g. ``git-blob <id>``.
+        """
+        self.progress.add_file()
+        future = self._executor.submit(self._download, url, filename, key)
+        self._futures.append(future)
+        return future
+
+    def wait(self):
+        """Wait for every queued download and raise the first error, if any."""
+        futures, self._futures = self._futures, []
+        wait(futures)
+        self.progress.finish()
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.session.close()
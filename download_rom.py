@@ -1,35 +1,9 @@
 from itertools import chain
-import requests, os, sys, shutil, binascii, zipfile, subprocess
-from protobuf_decoder import Parser, parse_apx_manifest, parse_classpath_bin
-
-
-def download_file(url, filename):
-    if os.path.exists(filename):
-        print(f"{filename} already exists.")
-        return
-    print(f"Downloading {filename} from {url}")
-
-    temp_filename = filename + ".part"
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        total_size = int(r.headers.get("content-length", 0))
-        downloaded_size = 0
-
-        with open(temp_filename, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-                downloaded_size += len(chunk)
-                print(f"\r{downloaded_size}/{total_size} bytes downloaded", end="")
-        print()
-    os.rename(temp_filename, filename)
-
-
-def get_json(url):
-    return requests.get(url).json()
-
-
-def get_binary(url):
-    return requests.get(url).content
+import os, sys, shutil, argparse, binascii, zipfile, subprocess
+from protobuf_decoder import Parser, read_apex_manifest, parse_classpath_bin
+from download_manager import DownloadManager
+from artifact_store import ArtifactStore, DEFAULT_ROOT
+from image_reader import HostDirectory, map_file, load_image, buffer_file, zip_member_view
 
 
 def fix_download_path(path):
@@ -41,11 +15,34 @@ def fix_download_path(path):
 
 
 if __name__ == "__main__":
-    oem = sys.argv[1]
-    product = sys.argv[2]
-    branch = sys.argv[3]
+    arg_parser = argparse.ArgumentParser(description="Download the files needed for analysis from a firmware dump")
+    arg_parser.add_argument("oem")
+    arg_parser.add_argument("product")
+    arg_parser.add_argument("branch")
+    arg_parser.add_argument("--workers", type=int, default=8, help="concurrent downloads")
+    arg_parser.add_argument("--per-host", type=int, default=4, help="concurrent downloads from one host")
+    arg_parser.add_argument("--chunk-size", type=int, default=1024 * 1024, help="bytes read per chunk")
+    arg_parser.add_argument("--segments", type=int, default=4, help="parallel ranges for one large file")
+    arg_parser.add_argument("--segment-threshold", type=int, default=64 * 1024 * 1024,
+                            help="smallest file in bytes fetched in parallel ranges")
+    arg_parser.add_argument("--artifacts", default=DEFAULT_ROOT, help="content-addressed store shared by all firmwares")
+    args = arg_parser.parse_args()
+    oem = args.oem
+    product = args.product
+    branch = args.branch
 
     rom_path = os.path.join("rom", oem, product, branch)
+    artifacts = ArtifactStore(args.artifacts)
+    downloads = DownloadManager(
+        max_workers=args.workers,
+        per_host=args.per_host,
+        chunk_size=args.chunk_size,
+        checksum_path=os.path.join(rom_path, "checksums.json"),
+        segments=args.segments,
+        segment_threshold=args.segment_threshold,
+        artifacts=artifacts,
+    )
+
     temp_path = os.path.join(rom_path, "temp")
     os.makedirs(temp_path, exist_ok=True)
 
@@ -57,27 +54,28 @@ if __name__ == "__main__":
         f"https://dumps.tadiphone.dev/api/v4/projects/dumps%2F{oem}%2F{product}"
     )
 
-    download_file(
+    downloads.submit(
         f"{raw_base_url}/system/system/build.prop", os.path.join(out_path, "build.prop")
     )
 
     # SELinux rules
-    download_file(
+    downloads.submit(
         f"{raw_base_url}/system/system/etc/selinux/plat_sepolicy.cil",
         os.path.join(out_path, "plat_sepolicy.cil"),
     )
-    download_file(
+    downloads.submit(
         f"{raw_base_url}/system/system/etc/selinux/plat_service_contexts",
         os.path.join(out_path, "plat_service_contexts"),
     )
-    download_file(
+    downloads.submit(
         f"{raw_base_url}/system_ext/etc/selinux/system_ext_sepolicy.cil",
         os.path.join(out_path, "system_ext_sepolicy.cil"),
     )
-    download_file(
+    downloads.submit(
         f"{raw_base_url}/system_ext/etc/selinux/system_ext_service_contexts",
         os.path.join(out_path, "system_ext_service_contexts"),
     )
+    downloads.wait()
 
     fingerprint = None
     security_patch = None
@@ -107,11 +105,11 @@ if __name__ == "__main__":
     with open(os.path.join(out_path, "brand.txt"), "w") as f:
         f.write(brand)
 
-    bootcp_bin = get_binary(
+    bootcp_bin = downloads.get_binary(
         f"{raw_base_url}/system/system/etc/classpaths/bootclasspath.pb"
     )
     bootcp = parse_classpath_bin(bootcp_bin)
-    syscp_bin = get_binary(
+    syscp_bin = downloads.get_binary(
         f"{raw_base_url}/system/system/etc/classpaths/systemserverclasspath.pb"
     )
     syscp = parse_classpath_bin(syscp_bin)
@@ -124,7 +122,7 @@ if __name__ == "__main__":
         local_path = os.path.join(bootcp_path, path[1:])
         local_dir = os.path.dirname(local_path)
         os.makedirs(local_dir, exist_ok=True)
-        download_file(f"{raw_base_url}{fix_download_path(path)}", local_path)
+        downloads.submit(f"{raw_base_url}{fix_download_path(path)}", local_path)
 
     syscp_path = os.path.join(out_path, "systemservercp")
     os.makedirs(syscp_path, exist_ok=True)
@@ -134,99 +132,113 @@ if __name__ == "__main__":
         local_path = os.path.join(syscp_path, path[1:])
         local_dir = os.path.dirname(local_path)
         os.makedirs(local_dir, exist_ok=True)
-        download_file(f"{raw_base_url}{fix_download_path(path)}", local_path)
+        downloads.submit(f"{raw_base_url}{fix_download_path(path)}", local_path)
 
     art_bootcp: list[str] = None
     art_syscp: list[str] = None
 
-    apex_files = get_json(f"{api_base_url}/repository/tree?path=system/system/apex&ref={branch}")
+    apex_files = downloads.get_json(f"{api_base_url}/repository/tree?path=system/system/apex&ref={branch}")
     print(apex_files)
-    for item in apex_files:
+    # Fetch every APEX up front, and unpack them in listing order as they arrive. The git
+    # blob id from the listing identifies an APEX already in the artifact store.
+    apex_downloads = [
+        downloads.submit(
+            f"{raw_base_url}/{item['path']}", os.path.join(temp_path, item["name"]), key=f"git-blob {item['id']}"
+        )
+        for item in apex_files
+    ]
+    apex_payloads = {}
+    for item, apex_download in zip(apex_files, apex_downloads):
         name = item["name"]
-        path = item["path"]
-
-        download_file(f"{raw_base_url}/{path}", os.path.join(temp_path, name))
+        apex_download.result()
 
         try:
-            with zipfile.ZipFile(os.path.join(temp_path, name), "r") as z:
+            apex_data = map_file(os.path.join(temp_path, name))
+            with zipfile.ZipFile(buffer_file(apex_data), "r") as z:
                 manifest_data = z.read("apex_manifest.pb")
-                apex_name = parse_apx_manifest(manifest_data)[0]["data"]
+                apex_name = read_apex_manifest(manifest_data).name
                 names = z.namelist()
 
-                payload_path = os.path.join(temp_path, "apex_payload.img")
-
+                # The payload is stored uncompressed, so it is read in place
                 if "original_apex" in names:
                     print("Found original_apex in", name)
-                    with zipfile.ZipFile(z.open("original_apex"), "r") as orig_z:
-                        orig_z.extract("apex_payload.img", temp_path)
+                    original_data = zip_member_view(z, "original_apex", apex_data)
+                    with zipfile.ZipFile(buffer_file(original_data), "r") as orig_z:
+                        payload_data = zip_member_view(orig_z, "apex_payload.img", original_data)
                 elif "apex_payload.img" in names:
-                    z.extract("apex_payload.img", temp_path)
+                    payload_data = zip_member_view(z, "apex_payload.img", apex_data)
                 else:
                     raise Exception(f"APEX payload not found in {name}")
 
+            try:
+                payload = load_image(payload_data)
+            except (ValueError, NotImplementedError) as e:
+                print(f"Unpacking {name} with 7z: {e}")
+                payload_path = os.path.join(temp_path, "apex_payload.img")
+                with open(payload_path, "wb") as f:
+                    f.write(payload_data)
                 ext_path = os.path.join(temp_path, apex_name)
                 shutil.rmtree(ext_path, ignore_errors=True)
                 os.makedirs(ext_path, exist_ok=True)
-
-                # Use 7z
                 subprocess.run(["7z", "x", payload_path, f"-o{ext_path}"], check=True)
-
-                apex_bootcp = []
-                if os.path.exists(
-                    os.path.join(ext_path, "etc/classpaths/bootclasspath.pb")
-                ):
-                    apex_bootcp_bin = open(
-                        os.path.join(ext_path, "etc/classpaths/bootclasspath.pb"), "rb"
-                    ).read()
-                    apex_bootcp = parse_classpath_bin(apex_bootcp_bin)
-                apex_syscp = []
-                if os.path.exists(
-                    os.path.join(ext_path, "etc/classpaths/systemserverclasspath.pb")
-                ):
-                    apex_syscp_bin = open(
-                        os.path.join(ext_path, "etc/classpaths/systemserverclasspath.pb"),
-                        "rb",
-                    ).read()
-                    apex_syscp = parse_classpath_bin(apex_syscp_bin)
-
-                if apex_name == "com.android.art":
-                    art_bootcp = apex_bootcp
-                    art_syscp = apex_syscp
-                else:
-                    bootcp.extend(apex_bootcp)
-                    syscp.extend(apex_syscp)
+                payload = HostDirectory(ext_path)
+            apex_payloads[apex_name] = payload
+
+            apex_bootcp = []
+            if payload.exists("etc/classpaths/bootclasspath.pb"):
+                apex_bootcp = parse_classpath_bin(payload.read("etc/classpaths/bootclasspath.pb"))
+            apex_syscp = []
+            if payload.exists("etc/classpaths/systemserverclasspath.pb"):
+                apex_syscp = parse_classpath_bin(payload.read("etc/classpaths/systemserverclasspath.pb"))
+
+            if apex_name == "com.android.art":
+                art_bootcp = apex_bootcp
+                art_syscp = apex_syscp
+            else:
+                bootcp.extend(apex_bootcp)
+                syscp.extend(apex_syscp)
         except Exception as e:
             print(f"Error processing {name}: {e}")
 
+    downloads.wait()
+    downloads.close()
+
     bootcp = art_bootcp + bootcp
     syscp = art_syscp + syscp
 
     for path in bootcp:
         if not path.startswith("/apex/"):
             continue
-        src_path = os.path.join(temp_path, path[len("/apex/") :])
-        if not os.path.exists(src_path):
-            print(f"File {src_path} not found")
+        apex_name, _, apex_path = path[len("/apex/") :].partition("/")
+        payload = apex_payloads.get(apex_name)
+        if payload is None or not payload.exists(apex_path):
+            print(f"File {path} not found")
             continue
         dest_path = os.path.join(bootcp_path, path[1:])
         dest_dir = os.path.dirname(dest_path)
         os.makedirs(dest_dir, exist_ok=True)
-        shutil.copyfile(src_path, dest_path)
+        payload.extract(apex_path, dest_path)
+        artifacts.add(dest_path)
 
     for path in syscp:
         if not path.startswith("/apex/"):
             continue
-        src_path = os.path.join(temp_path, path[len("/apex/") :])
-        if not os.path.exists(src_path):
-            print(f"File {src_path} not found")
+        apex_name, _, apex_path = path[len("/apex/") :].partition("/")
+        payload = apex_payloads.get(apex_name)
+        if payload is None or not payload.exists(apex_path):
+            print(f"File {path} not found")
             continue
         dest_path = os.path.join(syscp_path, path[1:])
         dest_dir = os.path.dirname(dest_path)
         os.makedirs(dest_dir, exist_ok=True)
-        shutil.copyfile(src_path, dest_path)
+        payload.extract(apex_path, dest_path)
+        artifacts.add(dest_path)
 
     with open(os.path.join(out_path, "bootclasspath.txt"), "w") as f:
         f.write(":".join(bootcp))
 
     with open(os.path.join(out_path, "systemserverclasspath.txt"), "w") as f:
         f.write(":".join(syscp))
+
+    manifest = artifacts.write_manifest(out_path)
+    print(f"{len(manifest)} artifacts in {out_path}, {artifacts.stats['deduplicated']} already stored")
@@ -1,33 +1,113 @@
 import subprocess, sys, tempfile, os, shutil
 import zipfile
-from protobuf_decoder import Parser, parse_apx_manifest, parse_classpath_bin
+from protobuf_decoder import Parser, read_apex_manifest, parse_classpath_bin
+from artifact_store import ArtifactStore
+from image_reader import HostDirectory, open_image, load_image, buffer_file, zip_member_view
+
+
+SYSTEM_FILES = [
+    "system/build.prop",
+    "system/etc/classpaths/bootclasspath.pb",
+    "system/etc/classpaths/systemserverclasspath.pb",
+    "system/etc/selinux/plat_sepolicy.cil",
+    "system/etc/selinux/plat_service_contexts",
+    "system/system_ext/etc/selinux/system_ext_sepolicy.cil",
+    "system/system_ext/etc/selinux/system_ext_service_contexts",
+]
+
+
+def extract_files_7z(archive_path, files_to_extract, output_dir):
+    """
+    Extract ``files_to_extract`` with their paths below ``output_dir`` in one 7z run,
+    so the image is opened and indexed once instead of once per file.
+    """
+    if not files_to_extract:
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as list_file:
+        list_file.write("\n".join(files_to_extract) + "\n")
+    try:
+        subprocess.run(['7z', 'x', '-y', '-scsUTF-8', archive_path, f'-o{output_dir}', f'@{list_file.name}'],
+                       stdout=subprocess.DEVNULL, check=True)
+    finally:
+        os.remove(list_file.name)
 
 
-def extract_file_7z(archive_path, file_to_extract, output_dir):
-    subprocess.run(['7z', 'e', archive_path, f'-o{output_dir}', file_to_extract], check=True)
-
 def list_files_7z(archive_path):
     result = subprocess.run(['7z', 'l', '-ba', archive_path], stdout=subprocess.PIPE, check=True)
     return result.stdout.decode("utf-8")
 
+
 def fix_extract_path(path):
     if path.startswith("/"):
         return path[1:]
     return path
 
+
+class SevenZipImage(HostDirectory):
+    """
+    Fallback for images the native reader cannot open, e.g. sparse or compressed ones:
+    files are unpacked below ``workdir`` with 7z when first used, or together in one
+    run for all paths given to ``prefetch``.
+    """
+
+    def __init__(self, archive_path, workdir):
+        super().__init__(workdir)
+        self.archive_path = archive_path
+        self.files = set()
+        for line in list_files_7z(archive_path).splitlines():
+            line_split = line.split()
+            if line_split[2][0] != 'D':
+                self.files.add(line_split[-1])
+
+    def prefetch(self, paths):
+        extract_files_7z(self.archive_path, [
+            path for path in paths if path in self.files and not os.path.exists(os.path.join(self.root, path))
+        ], self.root)
+
+    def _path(self, path):
+        self.prefetch([path])
+        return super()._path(path)
+
+    def exists(self, path):
+        return self.isfile(path) or self.isdir(path)
+
+    def isfile(self, path):
+        return path in self.files
+
+    def isdir(self, path):
+        prefix = path.strip("/") + "/"
+        return any(file.startswith(prefix) for file in self.files)
+
+    def listdir(self, path=""):
+        prefix = path.strip("/") + "/" if path.strip("/") else ""
+        return sorted({file[len(prefix):].split("/", 1)[0] for file in self.files if file.startswith(prefix)})
+
+    def extract(self, path, dest):
+        # Copied, so the file stays unpacked for later reads of the same path
+        shutil.copyfile(self._path(path), dest)
+
+
+def open_system_image(system_img_path, workdir):
+    try:
+        return open_image(system_img_path)
+    except (ValueError, NotImplementedError) as e:
+        print(f"Reading {system_img_path} with 7z: {e}")
+        return SevenZipImage(system_img_path, workdir)
+
+
 if __name__ == '__main__':
     system_img_path = sys.argv[1]
 
     with tempfile.TemporaryDirectory() as tempdir:
-        extract_file_7z(system_img_path, 'system/build.prop', tempdir)
-        extract_file_7z(system_img_path, 'system/etc/classpaths/bootclasspath.pb', tempdir)
-        extract_file_7z(system_img_path, 'system/etc/classpaths/systemserverclasspath.pb', tempdir)
+        image = open_system_image(system_img_path, os.path.join(tempdir, "image"))
 
-        file_list = []
-        for line in list_files_7z(system_img_path).splitlines():
-            line_split = line.split()
-            if line_split[2][0] != 'D':
-                file_list.append(line_split[-1])
+        # Everything but the classpath jars, which are only known once the .pb files are read
+        apex_files = [
+            f"system/apex/{name}" for name in sorted(image.listdir("system/apex"))
+            if image.isfile(f"system/apex/{name}")
+        ]
+        image.prefetch(SYSTEM_FILES + apex_files)
 
         fingerprint = None
         security_patch = None
@@ -36,20 +116,20 @@ if __name__ == '__main__':
         release = None
         build_id = None
 
-        with open(os.path.join(tempdir, "build.prop"), "r", encoding="utf-8") as f:
-            for line in f:
-                if line.startswith("ro.system.build.fingerprint="):
-                    fingerprint = line[len("ro.system.build.fingerprint="):].strip()
-                elif line.startswith("ro.build.version.security_patch="):
-                    security_patch = line[len("ro.build.version.security_patch="):].strip()
-                elif line.startswith("ro.product.system.name="):
-                    product_name = line[len("ro.product.system.name="):].strip()
-                elif line.startswith("ro.product.system.brand="):
-                    brand = line[len("ro.product.system.brand="):].strip()
-                elif line.startswith("ro.build.version.release="):
-                    release = line[len("ro.build.version.release="):].strip()
-                elif line.startswith("ro.build.id="):
-                    build_id = line[len("ro.build.id="):].strip()
+        build_prop = image.read("system/build.prop").decode("utf-8")
+        for line in build_prop.splitlines():
+            if line.startswith("ro.system.build.fingerprint="):
+                fingerprint = line[len("ro.system.build.fingerprint="):].strip()
+            elif line.startswith("ro.build.version.security_patch="):
+                security_patch = line[len("ro.build.version.security_patch="):].strip()
+            elif line.startswith("ro.product.system.name="):
+                product_name = line[len("ro.product.system.name="):].strip()
+            elif line.startswith("ro.product.system.brand="):
+                brand = line[len("ro.product.system.brand="):].strip()
+            elif line.startswith("ro.build.version.release="):
+                release = line[len("ro.build.version.release="):].strip()
+            elif line.startswith("ro.build.id="):
+                build_id = line[len("ro.build.id="):].strip()
         
         out_path = os.path.join("base_rom", brand, product_name, build_id)
         print(out_path)
@@ -71,35 +151,33 @@ if __name__ == '__main__':
         with open(os.path.join(out_path, "release.txt"), "w") as f:
             f.write(release)
 
-        shutil.copyfile(os.path.join(tempdir, "build.prop"), os.path.join(out_path, "build.prop"))
+        image.extract("system/build.prop", os.path.join(out_path, "build.prop"))
 
 
-        extract_file_7z(system_img_path, "system/etc/selinux/plat_sepolicy.cil", tempdir)
-        shutil.move(os.path.join(tempdir, "plat_sepolicy.cil"), os.path.join(out_path, "plat_sepolicy.cil"))
-        extract_file_7z(system_img_path, "system/etc/selinux/plat_service_contexts", tempdir)
-        shutil.move(os.path.join(tempdir, "plat_service_contexts"), os.path.join(out_path, "plat_service_contexts"))
+        image.extract("system/etc/selinux/plat_sepolicy.cil", os.path.join(out_path, "plat_sepolicy.cil"))
+        image.extract("system/etc/selinux/plat_service_contexts", os.path.join(out_path, "plat_service_contexts"))
 
-        if "system/system_ext/etc/selinux/system_ext_sepolicy.cil" in file_list:
-            extract_file_7z(system_img_path, "system/system_ext/etc/selinux/system_ext_sepolicy.cil", tempdir)
-            shutil.move(os.path.join(tempdir, "system_ext_sepolicy.cil"), os.path.join(out_path, "system_ext_sepolicy.cil"))
+        if image.exists("system/system_ext/etc/selinux/system_ext_sepolicy.cil"):
+            image.extract("system/system_ext/etc/selinux/system_ext_sepolicy.cil", os.path.join(out_path, "system_ext_sepolicy.cil"))
         else: # write empty file
             with open(os.path.join(out_path, "system_ext_sepolicy.cil"), "w") as f:
                 pass
         
-        if "system/system_ext/etc/selinux/system_ext_service_contexts" in file_list:
-            extract_file_7z(system_img_path, "system/system_ext/etc/selinux/system_ext_service_contexts", tempdir)
-            shutil.move(os.path.join(tempdir, "system_ext_service_contexts"), os.path.join(out_path, "system_ext_service_contexts"))
+        if image.exists("system/system_ext/etc/selinux/system_ext_service_contexts"):
+            image.extract("system/system_ext/etc/selinux/system_ext_service_contexts", os.path.join(out_path, "system_ext_service_contexts"))
         else: # write empty file
             with open(os.path.join(out_path, "system_ext_service_contexts"), "w") as f:
                 pass
 
 
-        with open(os.path.join(tempdir, "bootclasspath.pb"), "rb") as f:
-            bootcp = parse_classpath_bin(f.read())
-        
-        with open(os.path.join(tempdir, "systemserverclasspath.pb"), "rb") as f:
-            syscp = parse_classpath_bin(f.read())
-        
+        with image.open("system/etc/classpaths/bootclasspath.pb") as f:
+            bootcp = parse_classpath_bin(f)
+        with image.open("system/etc/classpaths/systemserverclasspath.pb") as f:
+            syscp = parse_classpath_bin(f)
+
+        # All jars outside APEXes in a second and last pass over the image
+        image.prefetch([fix_extract_path(path) for path in bootcp + syscp if not path.startswith("/apex/")])
+
         bootcp_path = os.path.join(out_path, "bootcp")
         os.makedirs(bootcp_path, exist_ok=True)
         for path in bootcp:
@@ -108,10 +186,7 @@ if __name__ == '__main__':
             local_path = os.path.join(bootcp_path, path[1:])
             local_dir = os.path.dirname(local_path)
             os.makedirs(local_dir, exist_ok=True)
-
-            filename = os.path.basename(local_path)
-            extract_file_7z(system_img_path, fix_extract_path(path), tempdir)
-            shutil.move(os.path.join(tempdir, filename), local_path)
+            image.extract(fix_extract_path(path), local_path)
         
         syscp_path = os.path.join(out_path, "systemservercp")
         os.makedirs(syscp_path, exist_ok=True)
@@ -121,66 +196,59 @@ if __name__ == '__main__':
             local_path = os.path.join(syscp_path, path[1:])
             local_dir = os.path.dirname(local_path)
             os.makedirs(local_dir, exist_ok=True)
-
-            filename = os.path.basename(local_path)
-            extract_file_7z(system_img_path, fix_extract_path(path), tempdir)
-            shutil.move(os.path.join(tempdir, filename), local_path)
+            image.extract(fix_extract_path(path), local_path)
         
         art_bootcp: list[str] = None
         art_syscp: list[str] = None
-        apex_files = filter(lambda x: x.startswith("system/apex/"), file_list)
+        apex_payloads = {}
         for item in apex_files:
             file_name = os.path.basename(item)
-            extract_file_7z(system_img_path, item, tempdir)
             
             try:
-                with zipfile.ZipFile(os.path.join(tempdir, file_name), "r") as z:
+                apex_data = image.map(item)
+                with zipfile.ZipFile(buffer_file(apex_data), "r") as z:
                     manifest_data = z.read("apex_manifest.pb")
-                    apex_name = parse_apx_manifest(manifest_data)[0]["data"]
+                    apex_name = read_apex_manifest(manifest_data).name
                     names = z.namelist()
 
-                    payload_path = os.path.join(tempdir, "apex_payload.img")
-
+                    # The payload is stored uncompressed, so it is read in place
                     if "original_apex" in names:
                         print("Found original_apex in", file_name)
-                        with zipfile.ZipFile(z.open("original_apex"), "r") as orig_z:
-                            orig_z.extract("apex_payload.img", tempdir)
+                        original_data = zip_member_view(z, "original_apex", apex_data)
+                        with zipfile.ZipFile(buffer_file(original_data), "r") as orig_z:
+                            payload_data = zip_member_view(orig_z, "apex_payload.img", original_data)
                     elif "apex_payload.img" in names:
-                        z.extract("apex_payload.img", tempdir)
+                        payload_data = zip_member_view(z, "apex_payload.img", apex_data)
                     else:
                         raise Exception(f"APEX payload not found in {file_name}")
 
+                try:
+                    payload = load_image(payload_data)
+                except (ValueError, NotImplementedError) as e:
+                    print(f"Unpacking {file_name} with 7z: {e}")
+                    payload_path = os.path.join(tempdir, "apex_payload.img")
+                    with open(payload_path, "wb") as f:
+                        f.write(payload_data)
                     ext_path = os.path.join(tempdir, apex_name)
                     shutil.rmtree(ext_path, ignore_errors=True)
                     os.makedirs(ext_path, exist_ok=True)
-
-                    # Use 7z
                     subprocess.run(["7z", "x", payload_path, f"-o{ext_path}"], check=True)
-
-                    apex_bootcp = []
-                    if os.path.exists(
-                        os.path.join(ext_path, "etc/classpaths/bootclasspath.pb")
-                    ):
-                        apex_bootcp_bin = open(
-                            os.path.join(ext_path, "etc/classpaths/bootclasspath.pb"), "rb"
-                        ).read()
-                        apex_bootcp = parse_classpath_bin(apex_bootcp_bin)
-                    apex_syscp = []
-                    if os.path.exists(
-                        os.path.join(ext_path, "etc/classpaths/systemserverclasspath.pb")
-                    ):
-                        apex_syscp_bin = open(
-                            os.path.join(ext_path, "etc/classpaths/systemserverclasspath.pb"),
-                            "rb",
-                        ).read()
-                        apex_syscp = parse_classpath_bin(apex_syscp_bin)
-
-                    if apex_name == "com.android.art":
-                        art_bootcp = apex_bootcp
-                        art_syscp = apex_syscp
-                    else:
-                        bootcp.extend(apex_bootcp)
-                        syscp.extend(apex_syscp)
+                    payload = HostDirectory(ext_path)
+                apex_payloads[apex_name] = payload
+
+                apex_bootcp = []
+                if payload.exists("etc/classpaths/bootclasspath.pb"):
+                    apex_bootcp = parse_classpath_bin(payload.read("etc/classpaths/bootclasspath.pb"))
+                apex_syscp = []
+                if payload.exists("etc/classpaths/systemserverclasspath.pb"):
+                    apex_syscp = parse_classpath_bin(payload.read("etc/classpaths/systemserverclasspath.pb"))
+
+                if apex_name == "com.android.art":
+                    art_bootcp = apex_bootcp
+                    art_syscp = apex_syscp
+                else:
+                    bootcp.extend(apex_bootcp)
+                    syscp.extend(apex_syscp)
             except Exception as e:
                 print(f"Error processing {file_name}: {e}")
         
@@ -190,26 +258,28 @@ if __name__ == '__main__':
         for path in bootcp:
             if not path.startswith("/apex/"):
                 continue
-            src_path = os.path.join(tempdir, path[len("/apex/") :])
-            if not os.path.exists(src_path):
-                print(f"File {src_path} not found")
+            apex_name, _, apex_path = path[len("/apex/") :].partition("/")
+            payload = apex_payloads.get(apex_name)
+            if payload is None or not payload.exists(apex_path):
+                print(f"File {path} not found")
                 continue
             dest_path = os.path.join(bootcp_path, path[1:])
             dest_dir = os.path.dirname(dest_path)
             os.makedirs(dest_dir, exist_ok=True)
-            shutil.copyfile(src_path, dest_path)
+            payload.extract(apex_path, dest_path)
 
         for path in syscp:
             if not path.startswith("/apex/"):
                 continue
-            src_path = os.path.join(tempdir, path[len("/apex/") :])
-            if not os.path.exists(src_path):
-                print(f"File {src_path} not found")
+            apex_name, _, apex_path = path[len("/apex/") :].partition("/")
+            payload = apex_payloads.get(apex_name)
+            if payload is None or not payload.exists(apex_path):
+                print(f"File {path} not found")
                 continue
             dest_path = os.path.join(syscp_path, path[1:])
             dest_dir = os.path.dirname(dest_path)
             os.makedirs(dest_dir, exist_ok=True)
-            shutil.copyfile(src_path, dest_path)
+            payload.extract(apex_path, dest_path)
 
         with open(os.path.join(out_path, "bootclasspath.txt"), "w") as f:
             f.write(":".join(bootcp))
@@ -217,3 +287,8 @@ if __name__ == '__main__':
         with open(os.path.join(out_path, "systemserverclasspath.txt"), "w") as f:
             f.write(":".join(syscp))
 
+        # Keep one copy of each jar in the shared store, linked into this build's tree
+        artifacts = ArtifactStore()
+        manifest = artifacts.write_manifest(out_path)
+        print(f"{len(manifest)} artifacts in {out_path}, {artifacts.stats['deduplicated']} already stored")
+
@@ -0,0 +1,644 @@
+import io, os, sys, mmap, stat, errno, shutil, struct, zipfile, argparse
+from bisect import bisect_right
+from collections import deque
+from dataclasses import dataclass
+
+EXT4_MAGIC = 0xEF53
+EROFS_MAGIC = 0xE0F5E1E2
+SPARSE_MAGIC = 0xED26FF3A
+SUPERBLOCK_OFFSET = 1024
+MAX_SYMLINKS = 40
+
+
+def map_file(path: str) -> memoryview:
+    """Read-only memory map of a whole file; pages are only read when touched."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b"")
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class ImageFile(io.RawIOBase):
+    """
+    Read-only, seekable view of a file inside an image, assembled from ``runs`` of
+    ``(logical offset, length, physical offset)`` into the image. Bytes no run covers,
+    and runs whose physical offset is None, read as zeros.
+    """
+
+    def __init__(self, data: memoryview, size: int, runs: list, name: str = None):
+        super().__init__()
+        self.name = name
+        self.size = size
+        self._data = data
+        self._runs = sorted(runs)
+        self._starts = [run[0] for run in self._runs]
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._pos = offset
+        return offset
+
+    def readinto(self, buffer) -> int:
+        out = memoryview(buffer).cast("B")
+        total = min(len(out), max(self.size - self._pos, 0))
+        filled = 0
+        while filled < total:
+            pos = self._pos + filled
+            idx = bisect_right(self._starts, pos) - 1
+            if idx >= 0 and pos < self._runs[idx][0] + self._runs[idx][1]:
+                logical, length, physical = self._runs[idx]
+                count = min(total - filled, logical + length - pos)
+                if physical is None:
+                    out[filled:filled + count] = bytes(count)
+                else:
+                    start = physical + pos - logical
+                    out[filled:filled + count] = self._data[start:start + count]
+            else:
+                # A hole up to the next run
+                following = self._starts[idx + 1] if idx + 1 < len(self._starts) else self.size
+                count = min(total - filled, following - pos)
+                out[filled:filled + count] = bytes(count)
+            filled += count
+        self._pos += filled
+        return filled
+
+    def readall(self) -> bytes:
+        buffer = bytearray(max(self.size - self._pos, 0))
+        self.readinto(buffer)
+        return bytes(buffer)
+
+    def view(self):
+        """The file's bytes as a view of the image, without copying, if they are stored in one piece."""
+        if self.size == 0:
+            return memoryview(b"")
+        if len(self._runs) == 1:
+            logical, length, physical = self._runs[0]
+            if logical == 0 and length >= self.size and physical is not None:
+                return self._data[physical:physical + self.size]
+        return None
+
+
+def buffer_file(data) -> ImageFile:
+    """A seekable file over a buffer, without copying it, e.g. to open a mapped APEX as a zip."""
+    data = memoryview(data).cast("B")
+    return ImageFile(data, len(data), [(0, len(data), 0)])
+
+
+class FilesystemImage:
+    """
+    Path based, read-only access to a file system image held in a buffer, usually a
+    memory map. Subclasses decode the on-disk format: ``_root``, ``_node`` by inode
+    number, ``_entries`` of a directory and the ``_runs`` of a file's data.
+    """
+
+    def __init__(self, data: memoryview):
+        self.data = data
+        self._nodes = {}
+        self._dirs = {}
+
+    # Format specific
+    def _root(self):
+        raise NotImplementedError
+
+    def _node(self, number: int):
+        raise NotImplementedError
+
+    def _entries(self, node) -> dict:
+        raise NotImplementedError
+
+    def _runs(self, node) -> list:
+        raise NotImplementedError
+
+    def _cached_node(self, number: int):
+        node = self._nodes.get(number)
+        if node is None:
+            node = self._nodes[number] = self._node(number)
+        return node
+
+    def _cached_entries(self, node) -> dict:
+        entries = self._dirs.get(node.number)
+        if entries is None:
+            entries = self._dirs[node.number] = self._entries(node)
+        return entries
+
+    def _file(self, node, name: str = None) -> ImageFile:
+        return ImageFile(self.data, node.size, self._runs(node), name)
+
+    def _readlink(self, node) -> str:
+        return self._file(node).read().decode("utf-8", "surrogateescape")
+
+    def _lookup(self, path: str, follow: bool = True):
+        """The node at ``path``, relative to the image root, following symbolic links on the way."""
+        parts = deque(part for part in path.split("/") if part not in ("", "."))
+        stack = [self._cached_node(self._root())]
+        links = 0
+        while parts:
+            name = parts.popleft()
+            if name == "..":
+                if len(stack) > 1:
+                    stack.pop()
+                continue
+            if not stat.S_ISDIR(stack[-1].mode):
+                raise NotADirectoryError(errno.ENOTDIR, "Not a directory", path)
+            number = self._cached_entries(stack[-1]).get(name)
+            if number is None:
+                raise FileNotFoundError(errno.ENOENT, "No such file or directory", path)
+            node = self._cached_node(number)
+            if stat.S_ISLNK(node.mode) and (parts or follow):
+                links += 1
+                if links > MAX_SYMLINKS:
+                    raise OSError(errno.ELOOP, "Too many levels of symbolic links", path)
+                target = self._readlink(node)
+                if target.startswith("/"):
+                    del stack[1:]
+                parts.extendleft(reversed([part for part in target.split("/") if part not in ("", ".")]))
+                continue
+            stack.append(node)
+        return stack[-1]
+
+    def exists(self, path: str) -> bool:
+        try:
+            self._lookup(path)
+        except OSError:
+            return False
+        return True
+
+    def isdir(self, path: str) -> bool:
+        try:
+            return stat.S_ISDIR(self._lookup(path).mode)
+        except OSError:
+            return False
+
+    def isfile(self, path: str) -> bool:
+        try:
+            return stat.S_ISREG(self._lookup(path).mode)
+        except OSError:
+            return False
+
+    def getsize(self, path: str) -> int:
+        return self._lookup(path).size
+
+    def readlink(self, path: str) -> str:
+        node = self._lookup(path, follow=False)
+        if not stat.S_ISLNK(node.mode):
+            raise OSError(errno.EINVAL, "Not a symbolic link", path)
+        return self._readlink(node)
+
+    def listdir(self, path: str = "") -> list[str]:
+        node = self._lookup(path)
+        if not stat.S_ISDIR(node.mode):
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory", path)
+        return list(self._cached_entries(node))
+
+    def walk(self, top: str = ""):
+        """Like :func:`os.walk`, top-down, without following symbolic links to directories."""
+        node = self._lookup(top)
+        dirnames, filenames = [], []
+        for name, number in self._cached_entries(node).items():
+            (dirnames if stat.S_ISDIR(self._cached_node(number).mode) else filenames).append(name)
+        yield top, dirnames, filenames
+        for name in dirnames:
+            yield from self.walk(f"{top}/{name}" if top else name)
+
+    def prefetch(self, paths):
+        """Nothing to do, files are read in place; see ``HostDirectory`` subclasses."""
+
+    def open(self, path: str) -> ImageFile:
+        node = self._lookup(path)
+        if stat.S_ISDIR(node.mode):
+            raise IsADirectoryError(errno.EISDIR, "Is a directory", path)
+        return self._file(node, path)
+
+    def read(self, path: str) -> bytes:
+        with self.open(path) as f:
+            return f.read()
+
+    def map(self, path: str) -> memoryview:
+        """The bytes of ``path``, as a view of the image when they are stored in one piece."""
+        with self.open(path) as f:
+            view = f.view()
+            return view if view is not None else memoryview(f.read())
+
+    def extract(self, path: str, dest: str):
+        """Copy ``path`` to ``dest``, replacing rather than writing into an existing file."""
+        temp_path = dest + ".extract"
+        with self.open(path) as src, open(temp_path, "wb") as dst:
+            view = src.view()
+            if view is not None:
+                dst.write(view)
+            else:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(temp_path, dest)
+
+
+@dataclass
+class Ext4Inode:
+    number: int
+    mode: int
+    size: int
+    flags: int
+    offset: int
+
+
+class Ext4Image(FilesystemImage):
+    """
+    ext2/3/4 without a journal replay: extent trees and indirect block maps, inline
+    data, htree directories read as linear ones, 32 and 64 bit group descriptors.
+    """
+
+    ROOT_INODE = 2
+    EXTENTS_FL = 0x80000
+    INLINE_DATA_FL = 0x10000000
+    EXTENT_MAGIC = 0xF30A
+    INCOMPAT_FILETYPE = 0x2
+    INCOMPAT_META_BG = 0x10
+    INCOMPAT_64BIT = 0x80
+    INCOMPAT_ENCRYPT = 0x10000
+
+    def __init__(self, data: memoryview):
+        super().__init__(data)
+        (self.inodes_count, _, _, _, _, self.first_data_block, log_block_size, _, self.blocks_per_group, _,
+         self.inodes_per_group) = struct.unpack_from("<11I", data, SUPERBLOCK_OFFSET)
+        magic, = struct.unpack_from("<H", data, SUPERBLOCK_OFFSET + 56)
+        if magic != EXT4_MAGIC:
+            raise ValueError("not an ext2/3/4 image")
+        rev_level, = struct.unpack_from("<I", data, SUPERBLOCK_OFFSET + 76)
+        inode_size, = struct.unpack_from("<H", data, SUPERBLOCK_OFFSET + 88)
+        self.incompat, = struct.unpack_from("<I", data, SUPERBLOCK_OFFSET + 96)
+        desc_size, = struct.unpack_from("<H", data, SUPERBLOCK_OFFSET + 254)
+        if self.incompat & (self.INCOMPAT_META_BG | self.INCOMPAT_ENCRYPT):
+            raise NotImplementedError(f"ext4 features {self.incompat:#x} are not supported")
+        self.block_size = 1024 << log_block_size
+        self.inode_size = inode_size if rev_level else 128
+        self.desc_size = desc_size if self.incompat & self.INCOMPAT_64BIT and desc_size else 32
+        self.descriptors = (self.first_data_block + 1) * self.block_size
+
+    def _root(self):
+        return self.ROOT_INODE
+
+    def _node(self, number: int) -> Ext4Inode:
+        if not 0 < number <= self.inodes_count:
+            raise ValueError(f"inode {number} out of range")
+        group, index = divmod(number - 1, self.inodes_per_group)
+        descriptor = self.descriptors + group * self.desc_size
+        table, = struct.unpack_from("<I", self.data, descriptor + 8)
+        if self.desc_size >= 64:
+            table |= struct.unpack_from("<I", self.data, descriptor + 0x28)[0] << 32
+        offset = table * self.block_size + index * self.inode_size
+        mode, _, size_lo = struct.unpack_from("<HHI", self.data, offset)
+        flags, = struct.unpack_from("<I", self.data, offset + 32)
+        size_hi, = struct.unpack_from("<I", self.data, offset + 108)
+        return Ext4Inode(number, mode, size_lo | size_hi << 32, flags, offset)
+
+    def _inline_xattr(self, node: Ext4Inode):
+        """Offset and size of the ``system.data`` attribute holding inline data past the first 60 bytes."""
+        if self.inode_size <= 128:
+            return None
+        extra_size, = struct.unpack_from("<H", self.data, node.offset + 128)
+        start = node.offset + 128 + extra_size
+        end = node.offset + self.inode_size
+        if start + 4 > end or struct.unpack_from("<I", self.data, start)[0] != 0xEA020000:
+            return None
+        entries = start + 4
+        pos = entries
+        while pos + 16 <= end:
+            name_len, name_index, value_offs, _, value_size = struct.unpack_from("<BBHII", self.data, pos)
+            if name_len == 0 and name_index == 0 and value_offs == 0:
+                break
+            name = bytes(self.data[pos + 16:pos + 16 + name_len])
+            if name_index == 7 and name == b"data":
+                return entries + value_offs, value_size
+            pos += (16 + name_len + 3) & ~3
+        return None
+
+    def _runs(self, node: Ext4Inode) -> list:
+        if node.flags & self.INLINE_DATA_FL:
+            runs = [(0, min(node.size, 60), node.offset + 40)]
+            extra = self._inline_xattr(node)
+            if node.size > 60 and extra is not None:
+                runs.append((60, min(node.size - 60, extra[1]), extra[0]))
+            return runs
+        if node.flags & self.EXTENTS_FL:
+            runs = []
+            self._extent_runs(node.offset + 40, runs)
+            return runs
+        if stat.S_ISLNK(node.mode) and node.size < 60:
+            # Fast symbolic link, the target is kept in the block map
+            return [(0, node.size, node.offset + 40)]
+        return self._block_map_runs(node)
+
+    def _extent_runs(self, offset: int, runs: list):
+        magic, entries, _, depth = struct.unpack_from("<4H", self.data, offset)
+        if magic != self.EXTENT_MAGIC:
+            raise ValueError(f"bad extent header at {offset:#x}")
+        for idx in range(entries):
+            entry = offset + 12 + idx * 12
+            if depth:
+                _, leaf_lo, leaf_hi = struct.unpack_from("<IIH", self.data, entry)
+                self._extent_runs((leaf_hi << 32 | leaf_lo) * self.block_size, runs)
+            else:
+                block, length, start_hi, start_lo = struct.unpack_from("<IHHI", self.data, entry)
+                # Unwritten extents have the top bit of the length set and read as zeros
+                unwritten = length > 32768
+                if unwritten:
+                    length -= 32768
+                physical = None if unwritten else (start_hi << 32 | start_lo) * self.block_size
+                runs.append((block * self.block_size, length * self.block_size, physical))
+
+    def _block_map_runs(self, node: Ext4Inode) -> list:
+        block_size = self.block_size
+        per_block = block_size // 4
+        wanted = -(-node.size // block_size)
+        blocks = []
+
+        def walk(pointer: int, level: int, first: int):
+            span = per_block ** level
+            if first >= wanted:
+                return
+            if level == 0:
+                blocks.append((first, pointer))
+                return
+            if pointer == 0:
+                return
+            pointers = struct.unpack_from(f"<{per_block}I", self.data, pointer * block_size)
+            for idx, child in enumerate(pointers):
+                if child:
+                    walk(child, level - 1, first + idx * (span // per_block))
+
+        pointers = struct.unpack_from("<15I", self.data, node.offset + 40)
+        for idx in range(12):
+            if pointers[idx]:
+                walk(pointers[idx], 0, idx)
+        first = 12
+        for level, pointer in zip((1, 2, 3), pointers[12:]):
+            walk(pointer, level, first)
+            first += per_block ** level
+
+        runs = []
+        for logical, physical in blocks:
+            if runs and runs[-1][0] + runs[-1][1] == logical * block_size \
+                    and runs[-1][2] + runs[-1][1] == physical * block_size:
+                runs[-1] = (runs[-1][0], runs[-1][1] + block_size, runs[-1][2])
+            else:
+                runs.append((logical * block_size, block_size, physical * block_size))
+        return runs
+
+    def _entries(self, node: Ext4Inode) -> dict:
+        if node.flags & self.INLINE_DATA_FL:
+            # The parent's inode number comes first, then the entries, continued in system.data
+            regions = [bytes(self.data[node.offset + 44:node.offset + 100])]
+            extra = self._inline_xattr(node)
+            if extra is not None:
+                regions.append(bytes(self.data[extra[0]:extra[0] + extra[1]]))
+        else:
+            content = self._file(node).read()
+            regions = [content[pos:pos + self.block_size] for pos in range(0, len(content), self.block_size)]
+
+        entries = {}
+        for region in regions:
+            pos = 0
+            while pos + 8 <= len(region):
+                number, rec_len, name_len = struct.unpack_from("<IHB", region, pos)
+                if not self.incompat & self.INCOMPAT_FILETYPE:
+                    name_len, = struct.unpack_from("<H", region, pos + 6)
+                if rec_len < 8:
+                    break
+                name = region[pos + 8:pos + 8 + name_len].decode("utf-8", "surrogateescape")
+                if number and name not in (".", ".."):
+                    entries[name] = number
+                pos += rec_len
+        return entries
+
+
+@dataclass
+class ErofsInode:
+    number: int
+    mode: int
+    size: int
+    layout: int
+    raw: int
+    offset: int
+    header_size: int
+
+
+class ErofsImage(FilesystemImage):
+    """
+    EROFS with uncompressed files: flat, tail-packed inline and chunk based layouts.
+
+    Only uncompressed EROFS is supported. There is no LZ4/LZMA/DEFLATE decoder here,
+    and Android builds EROFS with LZ4 by default, so most system images and APEX
+    payloads are refused by :meth:`check_supported` from the superblock alone, and
+    callers fall back to 7z (see ``extract_gsi.open_system_image``). ``image_reader_check.py`` checks both cases
+    against ``mkfs.erofs``.
+    """
+
+    LAYOUT_FLAT_PLAIN = 0
+    LAYOUT_COMPRESSED_FULL = 1
+    LAYOUT_FLAT_INLINE = 2
+    LAYOUT_COMPRESSED_COMPACT = 3
+    LAYOUT_CHUNK_BASED = 4
+    CHUNK_FORMAT_BLKBITS_MASK = 0x1F
+    CHUNK_FORMAT_INDEXES = 0x20
+    NULL_ADDR = 0xFFFFFFFF
+    # ZERO_PADDING, COMPR_CFGS/BIG_PCLUSTER, ZTAILPACKING and FRAGMENTS only come with compression
+    INCOMPAT_COMPRESSION = 0x1 | 0x2 | 0x10 | 0x20
+    # Shared by DEVICE_TABLE and COMPR_HEAD2
+    INCOMPAT_DEVICE_TABLE = 0x8
+
+    def __init__(self, data: memoryview):
+        super().__init__(data)
+        self.incompat = self.check_supported(data)
+        blkszbits, _, self.root_nid = struct.unpack_from("<BBH", data, SUPERBLOCK_OFFSET + 12)
+        self.meta_blkaddr, = struct.unpack_from("<I", data, SUPERBLOCK_OFFSET + 40)
+        self.block_size = 1 << blkszbits
+
+    @classmethod
+    def check_supported(cls, data) -> int:
+        """Refuse images this class cannot read from their superblock alone; returns the incompat flags."""
+        magic, = struct.unpack_from("<I", data, SUPERBLOCK_OFFSET)
+        if magic != EROFS_MAGIC:
+            raise ValueError("not an EROFS image")
+        incompat, compression = struct.unpack_from("<IH", data, SUPERBLOCK_OFFSET + 80)
+        if incompat & cls.INCOMPAT_COMPRESSION or compression:
+            raise NotImplementedError("compressed EROFS images are not supported")
+        if incompat & cls.INCOMPAT_DEVICE_TABLE:
+            raise NotImplementedError("multi-device or compressed EROFS images are not supported")
+        return incompat
+
+    def _root(self):
+        return self.root_nid
+
+    def _node(self, number: int) -> ErofsInode:
+        offset = self.meta_blkaddr * self.block_size + number * 32
+        fmt, xattr_count, mode = struct.unpack_from("<3H", self.data, offset)
+        if fmt & 1:
+            size, raw = struct.unpack_from("<QI", self.data, offset + 8)
+            inode_size = 64
+        else:
+            size, _, raw = struct.unpack_from("<3I", self.data, offset + 8)
+            inode_size = 32
+        xattr_size = 12 + (xattr_count - 1) * 4 if xattr_count else 0
+        return ErofsInode(number, mode, size, fmt >> 1 & 0x7, raw, offset, inode_size + xattr_size)
+
+    def _runs(self, node: ErofsInode) -> list:
+        block_size = self.block_size
+        if node.size == 0:
+            return []
+        if node.layout == self.LAYOUT_FLAT_PLAIN:
+            return [(0, node.size, node.raw * block_size)]
+        if node.layout == self.LAYOUT_FLAT_INLINE:
+            # Whole blocks from raw, the tail right after the inode and its attributes
+            tail = (node.size - 1) // block_size * block_size
+            runs = [(0, tail, node.raw * block_size)] if tail else []
+            return runs + [(tail, node.size - tail, node.offset + node.header_size)]
+        if node.layout == self.LAYOUT_CHUNK_BASED:
+            chunk_size = block_size << (node.raw & self.CHUNK_FORMAT_BLKBITS_MASK)
+            chunks = -(-node.size // chunk_size)
+            table = node.offset + node.header_size
+            if node.raw & self.CHUNK_FORMAT_INDEXES:
+                table = (table + 7) & ~7
+                entries = [struct.unpack_from("<HHI", self.data, table + idx * 8) for idx in range(chunks)]
+                if any(device for _, device, _ in entries):
+                    raise NotImplementedError("chunks on extra devices are not supported")
+                addresses = [address for _, _, address in entries]
+            else:
+                addresses = struct.unpack_from(f"<{chunks}I", self.data, table)
+            return [
+                (idx * chunk_size, chunk_size, None if address == self.NULL_ADDR else address * block_size)
+                for idx, address in enumerate(addresses)
+            ]
+        raise NotImplementedError(f"EROFS data layout {node.layout} (compressed) is not supported")
+
+    def _entries(self, node: ErofsInode) -> dict:
+        content = self._file(node).read()
+        entries = {}
+        for start in range(0, len(content), self.block_size):
+            block = content[start:start + self.block_size]
+            # Fixed size records of nid, name offset and file type, then the names
+            first_name, = struct.unpack_from("<H", block, 8)
+            count = first_name // 12
+            records = [struct.unpack_from("<QH", block, idx * 12) for idx in range(count)]
+            for idx, (nid, name_offset) in enumerate(records):
+                name_end = records[idx + 1][1] if idx + 1 < count else len(block)
+                name = block[name_offset:name_end].split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+                if name not in (".", ".."):
+                    entries[name] = nid
+        return entries
+
+
+class HostDirectory:
+    """A directory on disk behind the same interface, e.g. where an external tool unpacked an image."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(self._path(path))
+
+    def isdir(self, path: str) -> bool:
+        return os.path.isdir(self._path(path))
+
+    def isfile(self, path: str) -> bool:
+        return os.path.isfile(self._path(path))
+
+    def getsize(self, path: str) -> int:
+        return os.path.getsize(self._path(path))
+
+    def listdir(self, path: str = "") -> list[str]:
+        return os.listdir(self._path(path))
+
+    def prefetch(self, paths):
+        pass
+
+    def open(self, path: str):
+        return open(self._path(path), "rb")
+
+    def read(self, path: str) -> bytes:
+        with self.open(path) as f:
+            return f.read()
+
+    def map(self, path: str) -> memoryview:
+        return map_file(self._path(path))
+
+    def extract(self, path: str, dest: str):
+        temp_path = dest + ".extract"
+        shutil.copyfile(self._path(path), temp_path)
+        os.replace(temp_path, dest)
+
+
+def load_image(data) -> FilesystemImage:
+    """Open the ext4 or EROFS image in ``data``, a buffer such as :func:`map_file` returns."""
+    data = memoryview(data).cast("B")
+    if len(data) >= 4 and struct.unpack_from("<I", data, 0)[0] == SPARSE_MAGIC:
+        raise ValueError("Android sparse image; convert it with simg2img first")
+    if len(data) < SUPERBLOCK_OFFSET + 1024:
+        raise ValueError("too small for a file system image")
+    if struct.unpack_from("<I", data, SUPERBLOCK_OFFSET)[0] == EROFS_MAGIC:
+        return ErofsImage(data)
+    if struct.unpack_from("<H", data, SUPERBLOCK_OFFSET + 56)[0] == EXT4_MAGIC:
+        return Ext4Image(data)
+    raise ValueError("neither an ext4 nor an EROFS image")
+
+
+def open_image(path: str) -> FilesystemImage:
+    with open(path, "rb") as f:
+        head = f.read(SUPERBLOCK_OFFSET + 1024)
+    if len(head) == SUPERBLOCK_OFFSET + 1024 and struct.unpack_from("<I", head, SUPERBLOCK_OFFSET)[0] == EROFS_MAGIC:
+        # Most EROFS images are compressed: refuse those before mapping the whole file
+        ErofsImage.check_supported(head)
+    return load_image(map_file(path))
+
+
+def zip_member_view(archive: zipfile.ZipFile, name: str, data: memoryview = None) -> memoryview:
+    """
+    The bytes of ``name`` in ``archive``. When the member is stored uncompressed, as
+    ``apex_payload.img`` is, and ``data`` holds the archive's bytes, this is a view into
+    ``data`` rather than a copy.
+    """
+    info = archive.getinfo(name)
+    if data is not None and info.compress_type == zipfile.ZIP_STORED:
+        signature, = struct.unpack_from("<I", data, info.header_offset)
+        if signature == 0x04034B50:
+            name_len, extra_len = struct.unpack_from("<HH", data, info.header_offset + 26)
+            start = info.header_offset + 30 + name_len + extra_len
+            return data[start:start + info.file_size]
+    return memoryview(archive.read(name))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="List or read files in an ext4 or EROFS image")
+    arg_parser.add_argument("image")
+    arg_parser.add_argument("path", nargs="?", default="")
+    arg_parser.add_argument("--cat", action="store_true", help="write the file at path to stdout")
+    arg_parser.add_argument("-r", "--recursive", action="store_true")
+    args = arg_parser.parse_args()
+
+    image = open_image(args.image)
+    if args.cat:
+        with image.open(args.path) as f:
+            shutil.copyfileobj(f, sys.stdout.buffer)
+    elif args.recursive:
+        for dirpath, dirnames, filenames in image.walk(args.path):
+            for name in sorted(dirnames + filenames):
+                print(f"{dirpath}/{name}" if dirpath else name)
+    else:
+        for name in sorted(image.listdir(args.path)):
+            print(name + "/" if image.isdir(f"{args.path}/{name}") else name)
@@ -0,0 +1,140 @@
+import os, sys, random, shutil, argparse, tempfile, subprocess
+from image_reader import open_image
+
+# mke2fs options of each ext image checked, covering the layouts Ext4Image reads
+EXT_CONFIGS = {
+    "ext4": ["-t", "ext4"],
+    "ext4-1k-blocks": ["-t", "ext4", "-b", "1024"],
+    "ext4-inline-data": ["-t", "ext4", "-O", "inline_data"],
+    "ext4-64bit-csum": ["-t", "ext4", "-O", "64bit,metadata_csum"],
+    "ext4-no-filetype": ["-t", "ext4", "-O", "^filetype"],
+    "ext3-128-inodes": ["-t", "ext3", "-I", "128"],
+    "ext2": ["-t", "ext2"],
+}
+
+# mkfs.erofs options of each uncompressed EROFS image checked
+EROFS_CONFIGS = {
+    "erofs": [],
+    "erofs-no-inline": ["-E", "noinline_data"],
+    "erofs-chunks": ["--chunksize=8192"],
+}
+
+# Compressed EROFS is not supported and must be refused, so callers fall back to 7z
+EROFS_COMPRESSED_CONFIGS = {
+    "erofs-lz4": ["-zlz4"],
+    "erofs-lz4hc": ["-zlz4hc"],
+}
+
+
+def build_tree(root: str, seed: int = 1):
+    """A small system tree with the awkward cases: many names, large, holey and empty files, symlinks."""
+    rng = random.Random(seed)
+    for directory in ("system/framework", "system/etc/classpaths", "system/many", "system/" + "d" * 80):
+        os.makedirs(os.path.join(root, directory))
+    for idx in range(300):
+        with open(os.path.join(root, f"system/many/file_{idx:04d}_{'x' * rng.randrange(40)}"), "wb") as f:
+            f.write(rng.randbytes(rng.randrange(200)))
+    with open(os.path.join(root, "system/framework/big.jar"), "wb") as f:
+        f.write(rng.randbytes(3_000_000))
+    with open(os.path.join(root, "system/etc/classpaths/bootclasspath.pb"), "wb") as f:
+        f.write(rng.randbytes(77))
+    with open(os.path.join(root, "system/holes.bin"), "wb") as f:
+        for idx in range(40):
+            f.seek(idx * 200_000)
+            f.write(rng.randbytes(5000))
+    open(os.path.join(root, "system/empty"), "wb").close()
+    with open(os.path.join(root, "system/ünïcode ñame"), "wb") as f:
+        f.write(b"hi")
+    os.symlink("framework/big.jar", os.path.join(root, "system/link.jar"))
+    os.symlink("/system/" + "d" * 80 + "/../framework", os.path.join(root, "system/long_link"))
+    os.symlink("../system/etc", os.path.join(root, "etc_link"))
+
+
+def check_image(image_path: str, root: str) -> int:
+    """Compare every directory, file and symlink below ``root`` with the image; returns the files read."""
+    image = open_image(image_path)
+    files = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root).replace(os.sep, "/")
+        rel_dir = "" if rel_dir == "." else rel_dir
+        listed = sorted(set(image.listdir(rel_dir)) - {"lost+found"})
+        assert listed == sorted(dirnames + filenames), f"{rel_dir or '/'}: listed {listed[:5]}..."
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            rel_path = f"{rel_dir}/{name}" if rel_dir else name
+            if os.path.islink(path):
+                assert image.readlink(rel_path) == os.readlink(path), f"{rel_path}: wrong link target"
+                if not os.path.isfile(path):
+                    continue
+            with open(path, "rb") as f:
+                data = f.read()
+            assert image.getsize(rel_path) == len(data), f"{rel_path}: wrong size"
+            assert image.read(rel_path) == data, f"{rel_path}: wrong content"
+            with image.open(rel_path) as f:
+                f.seek(len(data) // 2)
+                assert f.read(100) == data[len(data) // 2:len(data) // 2 + 100], f"{rel_path}: wrong content at offset"
+            files += 1
+    assert image.isdir("system/long_link"), "system/long_link: not resolved"
+    assert image.listdir("etc_link") == image.listdir("system/etc"), "etc_link: not resolved"
+    return files
+
+
+def run_checks(workdir: str, only=None) -> bool:
+    root = os.path.join(workdir, "tree")
+    build_tree(root)
+    builds = [(name, ["mke2fs", "-q", "-F", *options, "-d", root, "{image}", "64M"], True)
+              for name, options in EXT_CONFIGS.items()]
+    builds += [(name, ["mkfs.erofs", "-q", *options, "{image}", root], True)
+               for name, options in EROFS_CONFIGS.items()]
+    builds += [(name, ["mkfs.erofs", "-q", *options, "{image}", root], False)
+               for name, options in EROFS_COMPRESSED_CONFIGS.items()]
+
+    ok = True
+    for name, command, supported in builds:
+        if only and not any(pattern in name for pattern in only):
+            continue
+        if shutil.which(command[0]) is None:
+            print(f"{name:<20} skipped, {command[0]} not found")
+            continue
+        image_path = os.path.join(workdir, f"{name}.img")
+        result = subprocess.run([arg.replace("{image}", image_path) for arg in command],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            print(f"{name:<20} skipped, {command[0]} failed: {result.stdout.decode(errors='replace').strip()}")
+            continue
+
+        try:
+            if supported:
+                print(f"{name:<20} ok, {check_image(image_path, root)} files")
+            else:
+                try:
+                    open_image(image_path)
+                    print(f"{name:<20} FAILED: compressed image was not refused")
+                    ok = False
+                except NotImplementedError as e:
+                    print(f"{name:<20} ok, refused: {e}")
+        except Exception as e:
+            print(f"{name:<20} FAILED: {type(e).__name__}: {e}")
+            ok = False
+        os.remove(image_path)
+    return ok
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Build ext2/3/4 and EROFS images of a test tree with mke2fs and mkfs.erofs and check "
+                    "that image_reader reads them back identically"
+    )
+    arg_parser.add_argument("--only", action="append", help="only check images whose name contains this")
+    arg_parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    args = arg_parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="image_reader_check.")
+    try:
+        passed = run_checks(workdir, args.only)
+    finally:
+        if args.keep:
+            print(f"Work directory: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if passed else 1)
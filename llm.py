@@ -1,16 +1,23 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import os, json
+import os, json, asyncio, argparse
+from collections import Counter
+from dataclasses import dataclass
 import pymongo.collection
 import requests
 import pymongo, bson
 from dotenv import load_dotenv
+from llm_dispatch import Dispatcher, SingleFlight, InvalidResponseError, source_hash
+from context_packer import estimate_tokens, pack_source
+from llm_cache import ResponseCache
+from llm_store import ResultSink, WorkSelector, DeadLetterLog
+from llm_stream import read_streamed_object, parse_json_object
+from llm_metrics import Metrics, serve_metrics
 
 load_dotenv()
-oneapi_token = "Bearer " + os.getenv("ONEAPI_TOKEN")
+oneapi_token = "Bearer " + os.getenv("ONEAPI_TOKEN", "")
 oneapi_chat_url = "https://one-api.m.reimu.host/v1/chat/completions"
-ohmygpt_token = "Bearer " + os.getenv("OHMYGPT_TOKEN")
+ohmygpt_token = "Bearer " + os.getenv("OHMYGPT_TOKEN", "")
 ohmygpt_chat_url = "https://cn2us02.opapi.win/v1/chat/completions"
-qwen_token = "Bearer " + os.getenv("QWEN_TOKEN")
+qwen_token = "Bearer " + os.getenv("QWEN_TOKEN", "")
 qwen_chat_url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
 hgd_ollama_token = "Bearer sk-114514"
 hgd_ollama_url = "http://10.249.188.48:11430/v1/chat/completions"
@@ -20,19 +27,42 @@ models = {
         "enabled": False,
         "url": ohmygpt_chat_url,
         "token": ohmygpt_token,
+        "concurrency": 8,
+        "cost": 1,
+        "context_tokens": 8192,
     },
     "deepseek-chat": {
         "enabled": False,
         "url": oneapi_chat_url,
         "token": oneapi_token,
+        "concurrency": 8,
+        "cost": 2,
+        "context_tokens": 8192,
     },
     "qwen2.5-coder-32b-instruct": {
         "enabled": True,
         "url": hgd_ollama_url,
         "token": hgd_ollama_token,
+        "concurrency": 2,
+        "cost": 0,
+        "context_tokens": 3072,
     },
 }
 
+# Set "stream": True on a model to read its completion as a stream and stop at the end
+# of the JSON object instead of waiting for the whole generation.
+
+# Token budget for the code input of models without a "context_tokens" entry
+default_context_tokens = 2048
+
+# Ensemble mode: query the enabled models in order of "cost" and stop as soon as this
+# many of them agree on the verdict. None queries every enabled model.
+ensemble_quorum = None
+
+# In ensemble mode, results reported with a lower confidence are not counted as votes,
+# so the next model is asked. Results without a confidence always count.
+ensemble_min_confidence = 0.7
+
 system_prompt_old = """
 The user will provide Java methods from an Android Binder handler. The first method is the entry point.
 Analyze the code for explicit security checks including but not limited to permissions, UID validation, or signature validation. Provide a brief description of any security checks found.
@@ -85,7 +115,8 @@ Output Format (JSON):
     "contains_security_check": boolean,  // Has explicit security validation, required
     "description": string,  // Brief description of security checks found, required
     "permission": string | null,  // Single permission string if applicable, optional
-    "sensitive": boolean  // Processes sensitive user data, required
+    "sensitive": boolean,  // Processes sensitive user data, required
+    "confidence": number  // Confidence in this analysis from 0 to 1, optional
 }
 
 Notes:
@@ -96,6 +127,9 @@ Notes:
 """
 
 
+required_keys = ("is_not_empty", "clears_calling_identity", "contains_security_check", "description", "sensitive")
+
+
 def escape_model_name(model_name: str):
     return model_name.replace(".", "_")
 
@@ -104,84 +138,297 @@ def bool_to_int(b: bool):
     return 1 if b else 0
 
 
-def exec_model(code_input: str, chat_url: str, token: str, model: str, proxy: dict = None):
+def to_confidence(value):
+    """The reported confidence as a float in [0, 1], or None if missing or unusable."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value) if 0 <= value <= 1 else None
+
+
+def exec_model(code_input: str, chat_url: str, token: str, model: str, proxy: dict = None, session=None,
+               stream: bool = False):
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": code_input},
     ]
 
-    resp = requests.post(
+    resp = (session or requests).post(
         chat_url,
         json={
             "model": model,
             "messages": messages,
-            "stream": False,
+            "stream": stream,
             "response_format": {"type": "json_object"},
         },
         headers={"Authorization": token},
         proxies=proxy,
         timeout=(5, 120),
+        stream=stream,
     )
     resp.raise_for_status()
 
-    content = resp.json()["choices"][0]["message"]["content"]
-
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        return None
-
-
-def process_item(item, model_name: str, model_info: dict):
-    source_len = len(item["source"])
-    source = item["source"]
-    truncated = False
-    if source_len > 8192:
-        source = item["source"][:8192]
-        truncated = True
-
-    code_input = source
+    if stream:
+        # Stops reading once the JSON object is complete, the rest is never generated,
+        # and neither is the final event carrying the usage
+        model_resp = read_streamed_object(resp)
+        usage = None
+    else:
+        try:
+            body = resp.json()
+            content = body["choices"][0]["message"]["content"]
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise InvalidResponseError(f"Unusable response from {model}: {e}") from e
+        model_resp = parse_json_object(content)
+        usage = body.get("usage") if isinstance(body.get("usage"), dict) else None
+    if not isinstance(model_resp, dict):
+        raise InvalidResponseError(f"Expected a JSON object from {model}, got {type(model_resp).__name__}")
+    missing = [key for key in required_keys if key not in model_resp]
+    if missing:
+        raise InvalidResponseError(f"Response from {model} is missing {', '.join(missing)}")
+    return model_resp, usage
+
+
+def build_code_input(item, model_info: dict):
+    return pack_source(item["source"], model_info.get("context_tokens", default_context_tokens))
+
+
+def process_item(item, model_name: str, model_info: dict, session=None, code_input: str = None):
+    if code_input is None:
+        code_input = build_code_input(item, model_info)
+    return exec_model(
+        code_input, model_info["url"], model_info["token"], model_name, model_info.get("proxy"), session=session,
+        stream=model_info.get("stream", False),
+    )
 
-    if truncated:
-        code_input += f"// Truncated from {source_len} characters"
 
-    return exec_model(code_input, model_info["url"], model_info["token"], model_name, model_info.get("proxy"))
+def verdict(result: dict):
+    return (
+        result["containsSecurityCheck"],
+        result["clearsCallingIdentity"],
+        result["isNotEmpty"],
+        result["sensitive"],
+    )
 
 
-def worker(
-    collection: pymongo.collection.Collection, txn, model_name: str, model_info: dict
-):
+def to_result(model_resp: dict):
+    return {
+        "containsSecurityCheck": bool_to_int(model_resp["contains_security_check"]),
+        "isNotEmpty": bool_to_int(model_resp["is_not_empty"]),
+        "clearsCallingIdentity": bool_to_int(model_resp["clears_calling_identity"]),
+        "permission": model_resp.get("permission", None),
+        "description": model_resp["description"],
+        "sensitive": bool_to_int(model_resp["sensitive"]),
+        "confidence": to_confidence(model_resp.get("confidence")),
+    }
+
+
+def is_vote(result: dict):
+    confidence = result.get("confidence")
+    return confidence is None or confidence >= ensemble_min_confidence
+
+
+@dataclass
+class Pipeline:
+    dispatcher: Dispatcher
+    sink: ResultSink
+    cache: ResponseCache = None
+    groups: SingleFlight = None
+    dead_letters: DeadLetterLog = None
+    metrics: Metrics = None
+    ensemble_saved: int = 0
+
+
+async def query_model(pipeline: Pipeline, txn, model_name: str, model_info: dict, info_str: str):
+    code_input = build_code_input(txn, model_info)
+    cache_key = ResponseCache.make_key(model_name, system_prompt, code_input) if pipeline.cache else None
+    model_resp = pipeline.cache.get(cache_key) if pipeline.cache else None
+    if model_resp is not None:
+        print(f"Cache hit for {info_str} with {model_name}")
+        if pipeline.metrics:
+            pipeline.metrics.observe_cache_hit(model_name, pipeline.dispatcher.endpoints[model_name].host)
+        return model_resp
+
+    print(f"Processing {info_str} with {model_name}")
+    tokens = estimate_tokens(system_prompt) + estimate_tokens(code_input)
+    model_resp, usage = await pipeline.dispatcher.call(
+        model_name, process_item, txn, model_name, model_info, code_input=code_input, tokens=tokens
+    )
+    print(model_resp)
+    endpoint = pipeline.dispatcher.endpoints[model_name]
+    usage = usage or {}
+    tokens_in = usage.get("prompt_tokens", tokens)
+    # Streamed replies carry no usage, their completion is estimated
+    tokens_out = usage.get("completion_tokens")
+    if tokens_out is None:
+        tokens_out = estimate_tokens(json.dumps(model_resp))
+    # Only the estimated prompt was taken from the TPM budget before the call
+    endpoint.settle_tokens(tokens, usage.get("total_tokens", tokens_in + tokens_out))
+    if pipeline.metrics:
+        pipeline.metrics.observe_tokens(model_name, endpoint.host, tokens_in, tokens_out)
+    if pipeline.cache and isinstance(model_resp, dict):
+        pipeline.cache.put(cache_key, model_name, model_resp)
+    return model_resp
+
+
+async def worker(pipeline: Pipeline, txn, model_name: str, model_info: dict):
     info_str = f"{txn['serviceName']} {txn['interfaceCode']} {txn['callee']['name']}"
     try:
-        print(f"Processing {info_str} with {model_name}")
-        model_resp = process_item(txn, model_name, model_info)
-        print(model_resp)
-        result = {
-            "containsSecurityCheck": bool_to_int(model_resp["contains_security_check"]),
-            "isNotEmpty": bool_to_int(model_resp["is_not_empty"]),
-            "clearsCallingIdentity": bool_to_int(model_resp["clears_calling_identity"]),
-            "permission": model_resp.get("permission", None),
-            "description": model_resp["description"],
-            "sensitive": bool_to_int(model_resp["sensitive"]),
-        }
-        collection.update_one(
-            {"_id": txn["_id"]},
-            {"$set": {f"results.{escape_model_name(model_name)}": result}},
+        if pipeline.groups is None:
+            model_resp = await query_model(pipeline, txn, model_name, model_info, info_str)
+        else:
+            # Interfaces with the same normalised source share a single request
+            group_key = (model_name, source_hash(txn["source"]))
+            if pipeline.groups.is_known(group_key):
+                print(f"Sharing result for {info_str} with {model_name}")
+            model_resp = await pipeline.groups.run(
+                group_key, lambda: query_model(pipeline, txn, model_name, model_info, info_str)
+            )
+        result = to_result(model_resp)
+        pipeline.sink.add(
+            txn["_id"], {f"results.{escape_model_name(model_name)}": result}, f"{info_str} with {model_name}"
         )
         print(f"Processed {info_str} with {model_name}")
+        return result
     except Exception as e:
         print(f"Error processing {info_str}: {e}")
+        if pipeline.dead_letters:
+            pipeline.dead_letters.record(txn["_id"], model_name, info_str, e)
+        return None
+
+
+async def analyse(pipeline: Pipeline, txn):
+    await asyncio.gather(*(
+        worker(pipeline, txn, model_name, model_info)
+        for model_name, model_info in models.items()
+        if model_info["enabled"] and escape_model_name(model_name) not in txn.get("results", {})
+    ))
+
+
+async def analyse_ensemble(pipeline: Pipeline, txn, quorum: int):
+    """
+    Query models cheapest first until ``quorum`` results agree on the verdict. Results
+    already stored for the interface count as votes; a failed or unparsable response,
+    or one below ``ensemble_min_confidence``, counts as no vote, so the next model is
+    asked instead. Once the quorum is reached, ``ensembleQuorum`` is stored so the
+    interface is not selected again for the models that were skipped.
+    """
+    votes = Counter(verdict(result) for result in txn.get("results", {}).values() if is_vote(result))
+    remaining = sorted(
+        (
+            (model_name, model_info) for model_name, model_info in models.items()
+            if model_info["enabled"] and escape_model_name(model_name) not in txn.get("results", {})
+        ),
+        key=lambda item: item[1].get("cost", 0),
+    )
+
+    while remaining and max(votes.values(), default=0) < quorum:
+        # At least this many more answers are needed anyway, so ask for them together
+        missing_votes = quorum - max(votes.values(), default=0)
+        batch, remaining = remaining[:missing_votes], remaining[missing_votes:]
+        results = await asyncio.gather(*(
+            worker(pipeline, txn, model_name, model_info) for model_name, model_info in batch
+        ))
+        votes.update(verdict(result) for result in results if result is not None and is_vote(result))
+
+    if max(votes.values(), default=0) >= quorum:
+        pipeline.ensemble_saved += len(remaining)
+        info_str = f"{txn['serviceName']} {txn['interfaceCode']} {txn['callee']['name']}"
+        pipeline.sink.add(txn["_id"], {"ensembleQuorum": quorum}, f"{info_str} quorum")
+
+
+async def save_checkpoints(selector: WorkSelector, sink: ResultSink, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        # Only results that are already written may be skipped on resume
+        checkpoint = selector.checkpoint
+        await sink.drain()
+        selector.save_checkpoint(checkpoint)
+
+
+async def run(collection: pymongo.collection.Collection, query: dict, cache: ResponseCache = None,
+              checkpoint_path: str = None, batch_size: int = 100, max_in_flight: int = 200,
+              checkpoint_interval: float = 30.0, deduplicate: bool = True, quorum: int = None,
+              dead_letters: DeadLetterLog = None, metrics: Metrics = None, metrics_port: int = None):
+    metrics = metrics or Metrics()
+    metrics_server = serve_metrics(metrics, metrics_port) if metrics_port is not None else None
+    dispatcher = Dispatcher(models, metrics)
+    groups = SingleFlight() if deduplicate else None
+    selector = WorkSelector(
+        collection,
+        query,
+        [escape_model_name(model_name) for model_name, model_info in models.items() if model_info["enabled"]],
+        batch_size=batch_size,
+        checkpoint_path=checkpoint_path,
+        quorum=quorum,
+    )
+    if selector.resume_after is not None:
+        print(f"Resuming after {selector.resume_after}")
+    metrics.set_backlog(await asyncio.to_thread(collection.count_documents, selector.query))
+
+    in_flight = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+
+    def on_done(task: asyncio.Task, doc_id):
+        tasks.discard(task)
+        in_flight.release()
+        selector.finished(doc_id)
+        metrics.item_done()
+
+    try:
+        async with ResultSink(collection) as sink:
+            pipeline = Pipeline(dispatcher, sink, cache, groups, dead_letters, metrics)
+            checkpointer = asyncio.create_task(save_checkpoints(selector, sink, checkpoint_interval))
+            async for batch in selector.iter_batches():
+                for txn in batch:
+                    # Backpressure: do not pull more work than max_in_flight documents
+                    await in_flight.acquire()
+                    selector.started(txn["_id"])
+                    if quorum:
+                        task = asyncio.create_task(analyse_ensemble(pipeline, txn, quorum))
+                    else:
+                        task = asyncio.create_task(analyse(pipeline, txn))
+                    tasks.add(task)
+                    task.add_done_callback(lambda t, doc_id=txn["_id"]: on_done(t, doc_id))
+            await asyncio.gather(*tasks)
+            checkpointer.cancel()
+        selector.clear_checkpoint()
+        print(f"Selected {selector.selected} interfaces")
+        print(f"Wrote {sink.written} results, {len(sink.failed)} failed")
+        if groups:
+            print(f"Deduplicated sources: {groups.calls} requests, {groups.shared} requests saved")
+        if quorum:
+            print(f"Ensemble quorum {quorum}: {pipeline.ensemble_saved} model queries skipped")
+        if dead_letters and dead_letters.recorded:
+            print(f"Dead letters: {dead_letters.recorded} failed queries, replay with --replay-dead-letters")
+        print(metrics.report())
+    finally:
+        dispatcher.close()
+        if metrics_server:
+            metrics_server.shutdown()
+        if cache:
+            print(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+    return metrics
 
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Analyse Binder interfaces with LLMs")
+    arg_parser.add_argument("--replay-dead-letters", action="store_true",
+                            help="only retry the interfaces recorded in the dead letter log")
+    arg_parser.add_argument("--metrics-port", type=int, help="serve /metrics and /metrics.json on this port")
+    arg_parser.add_argument("--report", help="write the final run metrics as JSON to this file")
+    args = arg_parser.parse_args()
+
     mongo_client = pymongo.MongoClient(os.getenv("MONGODB_URL"))
     db = mongo_client["binder_analyzer"]
     interface_collection = db["binder_interface"]
-
-    executor = ThreadPoolExecutor(max_workers=8)
-
-    for txn in interface_collection.find(
-        {
+    response_cache = ResponseCache(os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3"))
+    dead_letter_log = DeadLetterLog(os.getenv("LLM_DEAD_LETTER_PATH", "llm_dead_letter.jsonl"))
+
+    if args.replay_dead_letters:
+        analysis_query = dead_letter_log.take()
+        analysis_checkpoint = None
+    else:
+        analysis_query = {
             "isAccessible": True,
             "isEmpty": False,
             "inBaseline": False,
@@ -191,14 +438,21 @@ if __name__ == "__main__":
                 bson.ObjectId("680cba1803e5b756f518f1fa"),
             ]},
         }
-    ):
-        for model_name, model_info in models.items():
-            if not model_info["enabled"] or escape_model_name(model_name) in txn.get(
-                "results", {}
-            ):
-                continue
-            fut = executor.submit(
-                worker, interface_collection, txn, model_name, model_info
-            )
-
-    executor.shutdown(wait=True)
+        analysis_checkpoint = os.getenv("LLM_CHECKPOINT_PATH", "llm_checkpoint.json")
+
+    run_metrics = asyncio.run(run(
+        interface_collection,
+        analysis_query,
+        cache=response_cache,
+        checkpoint_path=analysis_checkpoint,
+        quorum=ensemble_quorum,
+        dead_letters=dead_letter_log,
+        metrics_port=args.metrics_port,
+    ))
+    response_cache.close()
+    if args.replay_dead_letters:
+        dead_letter_log.replayed()
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(run_metrics.snapshot(), f, indent=2)
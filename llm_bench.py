@@ -0,0 +1,127 @@
+import os, sys, json, time, random, asyncio, argparse, platform, contextlib
+import bson
+import llm
+from llm_mock import MockLLMServer, FakeCollection, add_config_arguments, config_from_args
+
+FIRMWARE_ID = bson.ObjectId("67c7c0eba4e85150ae1813fa")
+QUERY = {"isAccessible": True, "isEmpty": False, "inBaseline": False, "firmwareId": {"$in": [FIRMWARE_ID]}}
+
+
+def synthetic_source(rng: random.Random, idx: int, callees: int) -> str:
+    lines = [
+        f"public int onTransact{idx}(int code, Parcel data, Parcel reply) {{",
+        f"    mContext.enforceCallingOrSelfPermission(\"android.permission.PERM_{idx % 50}\", null);",
+        "    long token = Binder.clearCallingIdentity();",
+    ]
+    lines += [f"    helper{idx}_{callee}(data.readInt());" for callee in range(callees)]
+    lines += ["    Binder.restoreCallingIdentity(token);", "    return 0;", "}"]
+    source = "\n".join(lines)
+    for callee in range(callees):
+        body = "\n".join(f"    mState.put({rng.randrange(1 << 16)}, value);" for _ in range(rng.randrange(2, 40)))
+        source += (f"\n// <com.android.server.Synthetic{idx}: void helper{idx}_{callee}(int)>\n"
+                   f"void helper{idx}_{callee}(int value) {{\n{body}\n}}")
+    return source
+
+
+def synthetic_interfaces(count: int, duplicates: float = 0.3, callees: int = 3, seed: int = 1) -> list[dict]:
+    """``count`` accessible interfaces; a share of ``duplicates`` reuses an earlier source."""
+    rng = random.Random(seed)
+    sources = []
+    docs = []
+    for idx in range(count):
+        if sources and rng.random() < duplicates:
+            source = rng.choice(sources)
+        else:
+            source = synthetic_source(rng, idx, callees)
+            sources.append(source)
+        docs.append(dict(
+            _id=bson.ObjectId(),
+            firmwareId=FIRMWARE_ID,
+            serviceName=f"service{idx % 40}",
+            interfaceCode=idx % 100 + 1,
+            callee=dict(name=f"onTransact{idx}"),
+            source=source,
+            isAccessible=True,
+            isEmpty=False,
+            inBaseline=False,
+        ))
+    return docs
+
+
+def mock_models(url: str, count: int, concurrency: int, stream: bool) -> dict:
+    return {
+        f"mock-model-{idx}": {
+            "enabled": True,
+            "url": url,
+            "token": "Bearer mock",
+            "concurrency": concurrency,
+            "cost": idx,
+            "stream": stream,
+        }
+        for idx in range(count)
+    }
+
+
+def run_benchmark(args) -> dict:
+    server = MockLLMServer(config_from_args(args)).start()
+    llm.models = mock_models(server.url, args.models, args.concurrency, args.stream)
+    collection = FakeCollection(synthetic_interfaces(args.interfaces, args.duplicates, args.callees, args.seed),
+                                write_delay=args.write_delay_ms / 1000)
+
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        metrics = asyncio.run(llm.run(
+            collection,
+            QUERY,
+            batch_size=args.batch_size,
+            max_in_flight=args.max_in_flight,
+            deduplicate=not args.no_dedup,
+            quorum=args.quorum,
+        ))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    analysed = collection.count_documents({"$and": [QUERY, {"$or": [
+        {f"results.{llm.escape_model_name(model_name)}": {"$exists": True}} for model_name in llm.models
+    ]}]})
+    print(metrics.report(), file=sys.stderr)
+    return dict(
+        python=platform.python_version(),
+        settings={key: value for key, value in vars(args).items() if key not in ("save", "verbose")},
+        seconds=round(elapsed, 3),
+        interfaces=args.interfaces,
+        analysed=analysed,
+        items_per_s=round(analysed / elapsed, 2),
+        server=server.stats,
+        bulk_writes=collection.bulk_writes,
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="End-to-end throughput benchmark of llm.py against a mock endpoint")
+    arg_parser.add_argument("--interfaces", type=int, default=1000)
+    arg_parser.add_argument("--duplicates", type=float, default=0.3, help="share of interfaces reusing a source")
+    arg_parser.add_argument("--callees", type=int, default=3, help="called methods appended to each source")
+    arg_parser.add_argument("--models", type=int, default=1, help="number of mock models to enable")
+    arg_parser.add_argument("--concurrency", type=int, default=8, help="concurrent requests per model")
+    arg_parser.add_argument("--stream", action="store_true", help="use the streaming mode of exec_model")
+    arg_parser.add_argument("--batch-size", type=int, default=100)
+    arg_parser.add_argument("--max-in-flight", type=int, default=200)
+    arg_parser.add_argument("--no-dedup", action="store_true")
+    arg_parser.add_argument("--quorum", type=int)
+    arg_parser.add_argument("--write-delay-ms", type=float, default=2.0, help="simulated round trip per bulk write")
+    arg_parser.add_argument("--save", help="write results as JSON to this file")
+    arg_parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    add_config_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    report = run_benchmark(args)
+    print(f"{report['analysed']} interfaces in {report['seconds']}s: {report['items_per_s']} interfaces/s",
+          file=sys.stderr)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
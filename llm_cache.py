@@ -0,0 +1,44 @@
+import json, time, sqlite3, hashlib, threading
+
+
+class ResponseCache:
+    """
+    Persistent cache of parsed model responses, keyed on a hash of the model name,
+    the system prompt and the exact code input sent to the model.
+    """
+
+    def __init__(self, path: str = "llm_cache.sqlite3"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, created REAL NOT NULL)"
+            )
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_name: str, system_prompt: str, code_input: str) -> str:
+        payload = json.dumps([model_name, system_prompt, code_input], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, model_name: str, response: dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created) VALUES (?, ?, ?, ?)",
+                (key, model_name, json.dumps(response, ensure_ascii=False), time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
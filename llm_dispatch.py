@@ -0,0 +1,307 @@
+import asyncio, time, random, hashlib, functools
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class RateLimiter:
+    """Token bucket holding up to ``per_minute`` units, refilled continuously."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    async def acquire(self, amount: int = 1):
+        # A single request larger than the whole budget waits for a full bucket
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) * 60 / self.capacity)
+
+    def charge(self, amount: int):
+        """
+        Take ``amount`` more units after the fact, or give them back if it is negative,
+        e.g. to settle an estimate against actual usage. The bucket may go below zero,
+        which holds back the following acquires until it has refilled.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class InvalidResponseError(ValueError):
+    """The endpoint answered, but not with a usable completion."""
+
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """Whether ``error`` means the endpoint itself is unavailable or overloaded."""
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+def is_retryable(error: Exception) -> bool:
+    return is_endpoint_failure(error) or isinstance(error, InvalidResponseError)
+
+
+def retry_after(error: Exception):
+    """Seconds to wait as requested by a ``Retry-After`` header on ``error``, if any."""
+    response = getattr(error, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, never shorter than a server's ``Retry-After``."""
+
+    def __init__(self, attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        requested = retry_after(error)
+        return backoff if requested is None else max(backoff, min(requested, self.max_delay))
+
+
+class CircuitBreaker:
+    """
+    Opens after ``failure_threshold`` endpoint failures in a row and holds back every
+    call for ``reset_timeout`` seconds. Then a single probe call is let through: if it
+    succeeds the breaker closes, otherwise it opens again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._probe: asyncio.Event = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self._probe is not None else "open"
+
+    async def wait(self) -> bool:
+        """Wait until a call may go through; returns whether that call is the probe."""
+        while self.opened_at is not None:
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            elif self._probe is None:
+                self._probe = asyncio.Event()
+                return True
+            else:
+                await self._probe.wait()
+        return False
+
+    def cancel_probe(self):
+        """The probe call ended without an outcome, e.g. cancelled: let another call probe."""
+        self._end_probe()
+
+    def _end_probe(self):
+        if self._probe is not None:
+            self._probe.set()
+            self._probe = None
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._end_probe()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self._probe is None and self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+        self._end_probe()
+
+
+class Endpoint:
+    """
+    One entry of the ``models`` table: a pooled HTTP session plus its own concurrency
+    limit, optional requests-per-minute / tokens-per-minute budgets, retry policy and
+    circuit breaker.
+    """
+
+    def __init__(self, name: str, concurrency: int = 4, rpm: int = None, tpm: int = None,
+                 retry: RetryPolicy = None, breaker: CircuitBreaker = None, host: str = ""):
+        self.name = name
+        self.host = host
+        self.concurrency = concurrency
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.request_limiter = RateLimiter(rpm) if rpm else None
+        self.token_limiter = RateLimiter(tpm) if tpm else None
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+
+    @classmethod
+    def from_model_info(cls, model_name: str, model_info: dict):
+        return cls(
+            model_name,
+            concurrency=model_info.get("concurrency", 4),
+            rpm=model_info.get("rpm"),
+            tpm=model_info.get("tpm"),
+            retry=RetryPolicy(attempts=model_info.get("attempts", 5)),
+            breaker=CircuitBreaker(reset_timeout=model_info.get("breaker_reset", 30.0)),
+            host=urlparse(model_info["url"]).netloc,
+        )
+
+    async def acquire_budget(self, tokens: int):
+        if self.request_limiter is not None:
+            await self.request_limiter.acquire()
+        if self.token_limiter is not None and tokens:
+            await self.token_limiter.acquire(tokens)
+
+    def settle_tokens(self, estimated: int, used: int):
+        """Correct the tokens-per-minute budget taken for a call by the tokens it actually used."""
+        if self.token_limiter is not None and used != estimated:
+            self.token_limiter.charge(used - estimated)
+
+    def close(self):
+        self.session.close()
+
+
+class Dispatcher:
+    """
+    Runs blocking model calls on worker threads, one :class:`Endpoint` per enabled
+    model, so a slow endpoint only queues its own requests.
+    """
+
+    def __init__(self, models: dict, metrics=None):
+        self.metrics = metrics
+        self.endpoints = {
+            model_name: Endpoint.from_model_info(model_name, model_info)
+            for model_name, model_info in models.items()
+            if model_info["enabled"]
+        }
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, sum(endpoint.concurrency for endpoint in self.endpoints.values())),
+            thread_name_prefix="llm-dispatch",
+        )
+
+    async def call(self, model_name: str, func, *args, tokens: int = 0, **kwargs):
+        """
+        Wait for a free slot, budget and a closed circuit on the model's endpoint, then
+        run ``func(*args, session=<endpoint session>, **kwargs)`` on a worker thread.
+        Retryable failures are tried again after a backoff, up to the endpoint's attempts.
+        """
+        endpoint = self.endpoints[model_name]
+        attempt = 0
+        while True:
+            queued = time.monotonic()
+            async with endpoint.semaphore:
+                # Checked inside the slot, so calls already queued are held back as well
+                is_probe = await endpoint.breaker.wait()
+                try:
+                    await endpoint.acquire_budget(tokens)
+                    started = time.monotonic()
+                    try:
+                        result = await asyncio.get_running_loop().run_in_executor(
+                            self._executor, functools.partial(func, *args, session=endpoint.session, **kwargs)
+                        )
+                    except Exception as e:
+                        error = e
+                    else:
+                        self._observe(endpoint, started - queued, time.monotonic() - started, "ok")
+                        endpoint.breaker.record_success()
+                        return result
+                except BaseException:
+                    # Cancelled (CancelledError is not an Exception): neither outcome
+                    # gets recorded, so hand the probe on or the waiters block forever
+                    if is_probe:
+                        endpoint.breaker.cancel_probe()
+                    raise
+
+            self._observe(endpoint, started - queued, time.monotonic() - started,
+                          "invalid" if isinstance(error, InvalidResponseError) else "error")
+
+            if is_endpoint_failure(error):
+                endpoint.breaker.record_failure()
+            else:
+                endpoint.breaker.record_success()
+            attempt += 1
+            if not is_retryable(error) or attempt >= endpoint.retry.attempts:
+                raise error
+            delay = endpoint.retry.delay(attempt - 1, error)
+            print(f"Retrying {model_name} in {delay:.1f}s after attempt {attempt} failed: {error}")
+            await asyncio.sleep(delay)
+
+    def _observe(self, endpoint: Endpoint, queue_wait: float, latency: float, outcome: str):
+        if self.metrics is not None:
+            self.metrics.observe_request(endpoint.name, endpoint.host, queue_wait, latency, outcome)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for endpoint in self.endpoints.values():
+            endpoint.close()
+
+
+def source_hash(source: str) -> str:
+    """Hash of ``source`` with all whitespace runs collapsed, so reformatted copies match."""
+    return hashlib.sha256(" ".join(source.split()).encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    Runs one call per key and shares its result with every other caller using the
+    same key, both while it is in flight and for the rest of the run. A failed call
+    is not remembered, so a later caller tries again.
+    """
+
+    def __init__(self):
+        self._futures: dict = {}
+        self.calls = 0
+        self.shared = 0
+
+    def is_known(self, key) -> bool:
+        return key in self._futures
+
+    async def run(self, key, factory):
+        future = self._futures.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(factory())
+        self._futures[key] = future
+        self.calls += 1
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+            raise
@@ -0,0 +1,224 @@
+import json, time, threading
+from collections import deque, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(values, quantile: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+class SeriesStats:
+    """Counters and recent latency samples of one model endpoint."""
+
+    def __init__(self, samples: int):
+        self.outcomes = defaultdict(int)
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.cache_hits = 0
+        self.latency = deque(maxlen=samples)
+        self.latency_sum = 0.0
+        self.queue_wait = deque(maxlen=samples)
+        self.queue_wait_sum = 0.0
+
+    @property
+    def requests(self) -> int:
+        return sum(self.outcomes.values())
+
+    def to_dict(self) -> dict:
+        answered = self.outcomes["ok"] + self.outcomes["invalid"]
+        return dict(
+            requests=self.requests,
+            outcomes=dict(self.outcomes),
+            parse_success_rate=self.outcomes["ok"] / answered if answered else None,
+            cache_hits=self.cache_hits,
+            # Share of the answers that came from the response cache instead of the model
+            cache_hit_rate=self.cache_hits / (self.cache_hits + self.outcomes["ok"])
+            if self.cache_hits + self.outcomes["ok"] else None,
+            tokens_in=self.tokens_in,
+            tokens_out=self.tokens_out,
+            latency={f"p{int(q * 100)}": percentile(self.latency, q) for q in QUANTILES},
+            queue_wait={f"p{int(q * 100)}": percentile(self.queue_wait, q) for q in QUANTILES},
+        )
+
+
+class Metrics:
+    """
+    Per-request measurements of a run, labelled by model and endpoint host, plus the
+    item throughput over the last ``window`` seconds. Percentiles are computed over
+    the last ``samples`` requests of each series. Safe to read from another thread.
+    """
+
+    def __init__(self, window: float = 300.0, samples: int = 10000):
+        self._window = window
+        self._samples = samples
+        self._lock = threading.Lock()
+        self._series: dict[tuple[str, str], SeriesStats] = {}
+        self._done_times = deque()
+        self.started = time.monotonic()
+        self.items_done = 0
+        self.backlog = None
+
+    def _get_series(self, model: str, endpoint: str) -> SeriesStats:
+        key = (model, endpoint)
+        if key not in self._series:
+            self._series[key] = SeriesStats(self._samples)
+        return self._series[key]
+
+    def set_backlog(self, total: int):
+        with self._lock:
+            self.backlog = total
+
+    def observe_request(self, model: str, endpoint: str, queue_wait: float, latency: float, outcome: str):
+        """Record one attempt; ``outcome`` is ``ok``, ``invalid`` (unparsable reply) or ``error``."""
+        with self._lock:
+            series = self._get_series(model, endpoint)
+            series.outcomes[outcome] += 1
+            series.latency.append(latency)
+            series.latency_sum += latency
+            series.queue_wait.append(queue_wait)
+            series.queue_wait_sum += queue_wait
+
+    def observe_tokens(self, model: str, endpoint: str, tokens_in: int, tokens_out: int):
+        with self._lock:
+            series = self._get_series(model, endpoint)
+            series.tokens_in += tokens_in
+            series.tokens_out += tokens_out
+
+    def observe_cache_hit(self, model: str, endpoint: str):
+        with self._lock:
+            self._get_series(model, endpoint).cache_hits += 1
+
+    def item_done(self):
+        now = time.monotonic()
+        with self._lock:
+            self.items_done += 1
+            self._done_times.append(now)
+            while self._done_times[0] < now - self._window:
+                self._done_times.popleft()
+
+    def _throughput(self, now: float) -> float:
+        # Items per minute over the window, or since the start while the run is younger
+        span = min(self._window, now - self.started)
+        recent = sum(1 for done in self._done_times if done >= now - self._window)
+        return recent * 60 / span if span > 0 else 0.0
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            throughput = self._throughput(now)
+            remaining = max(0, self.backlog - self.items_done) if self.backlog is not None else None
+            cache_hits = sum(series.cache_hits for series in self._series.values())
+            answers = cache_hits + sum(series.outcomes["ok"] for series in self._series.values())
+            return dict(
+                elapsed=now - self.started,
+                items_done=self.items_done,
+                backlog=self.backlog,
+                remaining=remaining,
+                items_per_minute=throughput,
+                cache_hits=cache_hits,
+                cache_hit_rate=cache_hits / answers if answers else None,
+                # Items answered from the cache count towards the throughput, like any other
+                eta_seconds=remaining * 60 / throughput if remaining is not None and throughput else None,
+                models={
+                    f"{model}@{endpoint}": series.to_dict() for (model, endpoint), series in self._series.items()
+                },
+            )
+
+    def prometheus(self) -> str:
+        now = time.monotonic()
+        lines = []
+
+        def metric(name: str, kind: str, samples):
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_str = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+        with self._lock:
+            series = sorted(self._series.items())
+            metric("llm_requests_total", "counter", [
+                (dict(model=model, endpoint=endpoint, outcome=outcome), count)
+                for (model, endpoint), stats in series for outcome, count in sorted(stats.outcomes.items())
+            ])
+            metric("llm_tokens_total", "counter", [
+                (dict(model=model, endpoint=endpoint, direction=direction), count)
+                for (model, endpoint), stats in series
+                for direction, count in (("in", stats.tokens_in), ("out", stats.tokens_out))
+            ])
+            metric("llm_cache_hits_total", "counter", [
+                (dict(model=model, endpoint=endpoint), stats.cache_hits) for (model, endpoint), stats in series
+            ])
+            for name, attr in (("llm_request_latency_seconds", "latency"), ("llm_queue_wait_seconds", "queue_wait")):
+                samples = []
+                for (model, endpoint), stats in series:
+                    values = getattr(stats, attr)
+                    samples.extend(
+                        (dict(model=model, endpoint=endpoint, quantile=q), percentile(values, q)) for q in QUANTILES
+                    )
+                metric(name, "summary", samples)
+                for (model, endpoint), stats in series:
+                    labels = f'{{model="{model}",endpoint="{endpoint}"}}'
+                    lines.append(f"{name}_sum{labels} {getattr(stats, attr + '_sum')}")
+                    lines.append(f"{name}_count{labels} {stats.requests}")
+            metric("llm_items_done_total", "counter", [({}, self.items_done)])
+            metric("llm_items_backlog", "gauge", [({}, self.backlog)])
+            metric("llm_items_per_minute", "gauge", [({}, self._throughput(now))])
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> str:
+        snapshot = self.snapshot()
+        lines = [
+            f"Run report: {snapshot['items_done']} interfaces in {snapshot['elapsed']:.1f}s, "
+            f"{snapshot['items_per_minute']:.1f} interfaces/min over the last {self._window:.0f}s, "
+            f"{snapshot['cache_hits']} answers from cache ({snapshot['cache_hit_rate'] or 0.0:.1%})",
+        ]
+        for name, stats in snapshot["models"].items():
+            if not stats["requests"]:
+                lines.append(f"  {name}: no requests, {stats['cache_hits']} cache hits")
+                continue
+            latency = stats["latency"]
+            rate = stats["parse_success_rate"] or 0.0
+            lines.append(
+                f"  {name}: {stats['requests']} requests {stats['outcomes']}, "
+                f"parsed {rate:.1%} of answers, {stats['cache_hits']} cache hits, "
+                f"tokens in/out {stats['tokens_in']}/{stats['tokens_out']}, "
+                f"latency p50/p95/p99 {latency['p50']:.2f}/{latency['p95']:.2f}/{latency['p99']:.2f}s, "
+                f"queue wait p95 {stats['queue_wait']['p95']:.2f}s"
+            )
+        return "\n".join(lines)
+
+
+def serve_metrics(metrics: Metrics, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve ``/metrics`` (Prometheus text format) and ``/metrics.json`` on a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.prometheus().encode()
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.snapshot(), indent=2).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="llm-metrics").start()
+    print(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
@@ -0,0 +1,378 @@
+import sys, json, time, random, hashlib, argparse, threading
+from copy import deepcopy
+from dataclasses import dataclass, field
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pymongo import UpdateOne
+from pymongo.results import BulkWriteResult
+from context_packer import estimate_tokens
+
+CANNED_VERDICTS = [
+    {
+        "is_not_empty": True,
+        "clears_calling_identity": False,
+        "contains_security_check": True,
+        "description": "The method enforces the MANAGE_USERS permission before acting.",
+        "permission": "android.permission.MANAGE_USERS",
+        "sensitive": False,
+    },
+    {
+        "is_not_empty": True,
+        "clears_calling_identity": True,
+        "contains_security_check": False,
+        "description": "No explicit security check; the calling identity is cleared before the work.",
+        "permission": None,
+        "sensitive": True,
+    },
+    {
+        "is_not_empty": False,
+        "clears_calling_identity": False,
+        "contains_security_check": False,
+        "description": "The method is a stub that only logs.",
+        "permission": None,
+        "sensitive": False,
+    },
+    {
+        "is_not_empty": True,
+        "clears_calling_identity": False,
+        "contains_security_check": True,
+        "description": "检查权限 android.permission.DUMP — vérifié avant l'accès.",
+        "permission": "android.permission.DUMP",
+        "sensitive": False,
+    },
+]
+
+
+@dataclass
+class MockConfig:
+    """
+    Behaviour of the mock endpoint. Time to first token is drawn from a log-normal
+    distribution around ``latency_ms``; the completion then arrives at
+    ``chars_per_second`` (instantly if None), followed by ``trailing_chars`` of prose
+    after the JSON object. ``capacity`` requests are served at once, the rest queue.
+    """
+
+    latency_ms: float = 200.0
+    latency_sigma: float = 0.5
+    chars_per_second: float = None
+    trailing_chars: int = 0
+    error_rate: float = 0.0
+    invalid_rate: float = 0.0
+    retry_after: float = 1.0
+    capacity: int = None
+    verdicts: list = field(default_factory=lambda: list(CANNED_VERDICTS))
+    seed: int = 0
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    Local OpenAI-compatible ``/v1/chat/completions`` endpoint answering with canned
+    verdicts, picked by a hash of the prompt so the same code always gets the same one.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, config: MockConfig, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), MockHandler)
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.rng_lock = threading.Lock()
+        self.slots = threading.Semaphore(config.capacity) if config.capacity else None
+        self.stats = dict(requests=0, errors=0, invalid=0, cancelled=0)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True, name="llm-mock").start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # A client that drops its connection, e.g. after cancelling a stream, is no error
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def draw(self):
+        config = self.config
+        with self.rng_lock:
+            self.stats["requests"] += 1
+            latency = config.latency_ms / 1000 * self.rng.lognormvariate(0, config.latency_sigma)
+            roll = self.rng.random()
+            status = self.rng.choice((429, 500, 503)) if roll < config.error_rate else 200
+            invalid = status == 200 and roll < config.error_rate + config.invalid_rate
+            if status != 200:
+                self.stats["errors"] += 1
+            elif invalid:
+                self.stats["invalid"] += 1
+        return latency, status, invalid
+
+    @staticmethod
+    def usage(body: dict, text: str) -> dict:
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in body.get("messages", []))
+        completion_tokens = estimate_tokens(text)
+        return dict(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                    total_tokens=prompt_tokens + completion_tokens)
+
+    def completion(self, body: dict, invalid: bool) -> str:
+        if invalid:
+            return "I could not determine whether this method performs a security check."
+        prompt = "".join(message["content"] for message in body.get("messages", []))
+        digest = int.from_bytes(hashlib.sha256(prompt.encode("utf-8")).digest()[:4], "big")
+        verdict = self.config.verdicts[digest % len(self.config.verdicts)]
+        # Raw UTF-8 rather than \u escapes, as real models answer
+        text = json.dumps(verdict, indent=2, ensure_ascii=False)
+        if self.config.trailing_chars:
+            text += "\n\nExplanation: " + "The method was analysed step by step. " * (self.config.trailing_chars // 38 + 1)
+        return text
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockLLMServer
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        latency, status, invalid = self.server.draw()
+        slots = self.server.slots
+        if slots:
+            slots.acquire()
+        try:
+            time.sleep(latency)
+            if status != 200:
+                self._send_json(status, {"error": {"message": "injected failure"}},
+                                {"Retry-After": str(self.server.config.retry_after)} if status == 429 else {})
+            elif body.get("stream"):
+                self._stream(self.server.completion(body, invalid))
+            else:
+                text = self.server.completion(body, invalid)
+                self._generate(len(text))
+                self._send_json(200, {
+                    "object": "chat.completion",
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": self.server.usage(body, text),
+                })
+        finally:
+            if slots:
+                slots.release()
+
+    def _generate(self, chars: int):
+        if self.server.config.chars_per_second:
+            time.sleep(chars / self.server.config.chars_per_second)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, text: str, chunk_chars: int = 16):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = [
+            {"choices": [{"index": 0, "delta": {"content": text[pos:pos + chunk_chars]}}]}
+            for pos in range(0, len(text), chunk_chars)
+        ]
+        try:
+            for event in events:
+                self._generate(chunk_chars)
+                self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading, e.g. after the JSON object was complete
+            with self.server.rng_lock:
+                self.server.stats["cancelled"] += 1
+            self.close_connection = True
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+_MISSING = object()
+
+
+def _get_path(doc, path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _set_path(doc: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(_matches(doc, sub_query) for sub_query in condition):
+                return False
+        elif key == "$or":
+            if not any(_matches(doc, sub_query) for sub_query in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            value = _get_path(doc, key)
+            for op, argument in condition.items():
+                if op == "$exists":
+                    matched = (value is not _MISSING) == bool(argument)
+                elif op == "$in":
+                    matched = value is not _MISSING and value in argument
+                elif op == "$gt":
+                    matched = value is not _MISSING and value > argument
+                elif op == "$lt":
+                    matched = value is not _MISSING and value < argument
+                elif op == "$ne":
+                    matched = value is _MISSING or value != argument
+                else:
+                    raise NotImplementedError(f"FakeCollection does not support {op}")
+                if not matched:
+                    return False
+        elif _get_path(doc, key) != condition:
+            return False
+    return True
+
+
+def _project(doc: dict, projection: dict) -> dict:
+    if not projection:
+        return deepcopy(doc)
+    projected = {"_id": doc["_id"]}
+    for path in projection:
+        value = _get_path(doc, path)
+        if value is not _MISSING:
+            _set_path(projected, path, deepcopy(value))
+    return projected
+
+
+class FakeCursor:
+    def __init__(self, docs: list):
+        self._docs = docs
+
+    def sort(self, key: str, direction: int = 1):
+        self._docs.sort(key=lambda doc: _get_path(doc, key), reverse=direction < 0)
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def limit(self, count: int):
+        if count:
+            self._docs = self._docs[:count]
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+class FakeCollection:
+    """
+    In-memory stand-in for the ``binder_interface`` collection, covering the
+    operations ``llm.run`` uses: ``find`` with projection, ``sort``, ``limit`` and
+    ``batch_size``, ``count_documents`` and ``bulk_write`` of ``$set`` updates.
+    ``write_delay`` adds a round trip per bulk write.
+    """
+
+    def __init__(self, docs: list = (), write_delay: float = 0.0):
+        self._docs = {doc["_id"]: deepcopy(doc) for doc in docs}
+        self._lock = threading.Lock()
+        self.write_delay = write_delay
+        self.bulk_writes = 0
+
+    def insert_many(self, docs: list):
+        with self._lock:
+            for doc in docs:
+                self._docs[doc["_id"]] = deepcopy(doc)
+
+    def find(self, query: dict = None, projection: dict = None) -> FakeCursor:
+        with self._lock:
+            return FakeCursor([_project(doc, projection) for doc in self._docs.values() if _matches(doc, query or {})])
+
+    def count_documents(self, query: dict) -> int:
+        with self._lock:
+            return sum(1 for doc in self._docs.values() if _matches(doc, query))
+
+    def bulk_write(self, requests: list, ordered: bool = True) -> BulkWriteResult:
+        time.sleep(self.write_delay)
+        matched = 0
+        with self._lock:
+            self.bulk_writes += 1
+            for request in requests:
+                if not isinstance(request, UpdateOne) or set(request._doc) != {"$set"}:
+                    raise NotImplementedError("FakeCollection only supports UpdateOne with $set")
+                for doc in self._docs.values():
+                    if _matches(doc, request._filter):
+                        for path, value in request._doc["$set"].items():
+                            _set_path(doc, path, deepcopy(value))
+                        matched += 1
+                        break
+        return BulkWriteResult(
+            {"nInserted": 0, "nUpserted": 0, "nMatched": matched, "nModified": matched, "nRemoved": 0, "upserted": []},
+            True,
+        )
+
+
+def add_config_arguments(arg_parser: argparse.ArgumentParser):
+    defaults = MockConfig()
+    arg_parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms, help="median time to first token")
+    arg_parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma,
+                            help="log-normal spread of the latency, 0 for a fixed latency")
+    arg_parser.add_argument("--chars-per-second", type=float, default=defaults.chars_per_second)
+    arg_parser.add_argument("--trailing-chars", type=int, default=defaults.trailing_chars,
+                            help="prose generated after the JSON object")
+    arg_parser.add_argument("--error-rate", type=float, default=defaults.error_rate,
+                            help="share of requests answered with 429/500/503")
+    arg_parser.add_argument("--invalid-rate", type=float, default=defaults.invalid_rate,
+                            help="share of requests answered with text that is not JSON")
+    arg_parser.add_argument("--capacity", type=int, default=defaults.capacity, help="requests served at once")
+    arg_parser.add_argument("--verdicts", help="JSON file with a list of verdict objects to answer with")
+    arg_parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def config_from_args(args) -> MockConfig:
+    config = MockConfig(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        chars_per_second=args.chars_per_second,
+        trailing_chars=args.trailing_chars,
+        error_rate=args.error_rate,
+        invalid_rate=args.invalid_rate,
+        capacity=args.capacity,
+        seed=args.seed,
+    )
+    if args.verdicts:
+        with open(args.verdicts, "r") as f:
+            config.verdicts = json.load(f)
+    return config
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Offline OpenAI-compatible mock for llm.py")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=11430)
+    add_config_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    server = MockLLMServer(config_from_args(args), args.host, args.port)
+    print(f"Serving mock completions on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats))
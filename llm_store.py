@@ -0,0 +1,260 @@
+import os, json, time, asyncio, threading
+from collections import deque
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+import pymongo.collection
+from bson import json_util
+
+
+class ResultSink:
+    """
+    Buffers ``$set`` updates and writes them as unordered ``bulk_write`` batches, when
+    ``batch_size`` updates are pending or every ``flush_interval`` seconds, and once more
+    on exit. Failed writes are reported per document and kept in ``failed``.
+    """
+
+    def __init__(self, collection: pymongo.collection.Collection, batch_size: int = 100,
+                 flush_interval: float = 5.0):
+        self._collection = collection
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pending: list[tuple[UpdateOne, str]] = []
+        self._flusher: asyncio.Task = None
+        self._writes: set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+        self.written = 0
+        self.failed: list[tuple[str, str]] = []
+
+    async def __aenter__(self):
+        self._flusher = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._flusher.cancel()
+        await self.drain()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+
+    def add(self, doc_id, fields: dict, label: str):
+        """Queue ``$set: fields`` for the document ``doc_id``; ``label`` names it in error reports."""
+        self._pending.append((UpdateOne({"_id": doc_id}, {"$set": fields}), label))
+        if len(self._pending) >= self._batch_size:
+            # Write in the background so the caller is not held up by the round trip
+            self._start_write()
+
+    def _start_write(self) -> asyncio.Task:
+        """Write the pending updates on a worker thread, tracked in ``_writes`` until done."""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return None
+        task = asyncio.create_task(asyncio.to_thread(self._write, batch))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+        return task
+
+    async def flush(self):
+        task = self._start_write()
+        if task is not None:
+            # Shielded so that cancelling the periodic flusher does not abandon a write
+            await asyncio.shield(task)
+
+    async def drain(self):
+        """Flush, and wait until every update queued so far has been written."""
+        self._start_write()
+        while self._writes:
+            await asyncio.gather(*self._writes)
+
+    def _write(self, batch: list[tuple[UpdateOne, str]]):
+        written = 0
+        failed = []
+        try:
+            result = self._collection.bulk_write([op for op, _ in batch], ordered=False)
+            written = result.matched_count
+        except BulkWriteError as e:
+            written = e.details.get("nMatched", 0)
+            for error in e.details.get("writeErrors", []):
+                failed.append((batch[error["index"]][1], error.get("errmsg")))
+        except PyMongoError as e:
+            failed = [(label, str(e)) for _, label in batch]
+
+        for label, error in failed:
+            print(f"Error writing result for {label}: {error}")
+        with self._lock:
+            self.written += written
+            self.failed.extend(failed)
+
+
+class WorkSelector:
+    """
+    Streams the documents matching ``query`` that still miss a result for at least one
+    of ``model_keys``, in ``_id`` order and ``batch_size`` documents at a time, with
+    only ``fields`` (plus the existing results of those models) projected.
+
+    With a ``quorum``, documents whose ensemble already reached at least that quorum
+    are skipped, whatever models they miss.
+
+    Callers report ``started``/``finished`` for each document. ``checkpoint`` is the
+    last ``_id`` up to which every document has finished; once saved, a later run with
+    the same query and models resumes after it. Documents that failed before the
+    checkpoint are picked up again by a run without a checkpoint.
+    """
+
+    DEFAULT_FIELDS = ("serviceName", "interfaceCode", "callee.name", "source")
+
+    def __init__(self, collection: pymongo.collection.Collection, query: dict, model_keys: list[str],
+                 fields=DEFAULT_FIELDS, batch_size: int = 100, checkpoint_path: str = None, quorum: int = None):
+        self._collection = collection
+        self._base_query = query
+        self._model_keys = list(model_keys)
+        self._fields = fields
+        self._batch_size = batch_size
+        self._checkpoint_path = checkpoint_path
+        self._quorum = quorum
+        self._in_flight = deque()
+        self._finished = set()
+        self.resume_after = self._load_checkpoint()
+        self.checkpoint = self.resume_after
+        self.selected = 0
+
+    @property
+    def query(self) -> dict:
+        conditions = [
+            self._base_query,
+            {"$or": [{f"results.{key}": {"$exists": False}} for key in self._model_keys]},
+        ]
+        if self._quorum:
+            conditions.append({"$or": [
+                {"ensembleQuorum": {"$exists": False}}, {"ensembleQuorum": {"$lt": self._quorum}},
+            ]})
+        if self.resume_after is not None:
+            conditions.append({"_id": {"$gt": self.resume_after}})
+        return {"$and": conditions}
+
+    @property
+    def projection(self) -> dict:
+        projection = {field: 1 for field in self._fields}
+        projection.update({f"results.{key}": 1 for key in self._model_keys})
+        return projection
+
+    def _checkpoint_scope(self) -> dict:
+        return dict(query=json_util.dumps(self._base_query, sort_keys=True), models=sorted(self._model_keys),
+                    quorum=self._quorum)
+
+    def _load_checkpoint(self):
+        if not self._checkpoint_path or not os.path.exists(self._checkpoint_path):
+            return None
+        with open(self._checkpoint_path, "r") as f:
+            saved = json.load(f)
+        if {key: saved.get(key) for key in ("query", "models", "quorum")} != self._checkpoint_scope():
+            print(f"Ignoring checkpoint {self._checkpoint_path} written for a different query")
+            return None
+        return json_util.loads(saved["after"])
+
+    def save_checkpoint(self, doc_id):
+        if not self._checkpoint_path or doc_id is None:
+            return
+        temp_path = self._checkpoint_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(dict(self._checkpoint_scope(), after=json_util.dumps(doc_id)), f)
+        os.replace(temp_path, self._checkpoint_path)
+
+    def clear_checkpoint(self):
+        if self._checkpoint_path and os.path.exists(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
+
+    def started(self, doc_id):
+        self._in_flight.append(doc_id)
+
+    def finished(self, doc_id):
+        self._finished.add(doc_id)
+        while self._in_flight and self._in_flight[0] in self._finished:
+            self.checkpoint = self._in_flight.popleft()
+            self._finished.discard(self.checkpoint)
+
+    def _batches(self):
+        # One query per batch, continuing after the last _id, so no server cursor is
+        # left idle (and timed out) while the batches before it are worked on
+        query = self.query
+        last_id = None
+        while True:
+            batch_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+            batch = list(self._collection.find(batch_query, self.projection)
+                         .sort("_id", ASCENDING).limit(self._batch_size))
+            if batch:
+                yield batch
+            if len(batch) < self._batch_size:
+                return
+            last_id = batch[-1]["_id"]
+
+    async def iter_batches(self):
+        """
+        Yield batches of documents. The next batch is fetched on a worker thread while
+        the current one is being handed out, and never more than one batch ahead.
+        """
+        batches = self._batches()
+        next_batch = asyncio.create_task(asyncio.to_thread(next, batches, None))
+        while (batch := await next_batch) is not None:
+            self.selected += len(batch)
+            next_batch = asyncio.create_task(asyncio.to_thread(next, batches, None))
+            yield batch
+
+
+class DeadLetterLog:
+    """
+    Append-only JSON lines file of the documents whose analysis failed after all
+    retries, one line per document and model, so they can be replayed later.
+    """
+
+    def __init__(self, path: str = "llm_dead_letter.jsonl"):
+        self._path = path
+        self._taken_path = path + ".replaying"
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def record(self, doc_id, model_name: str, label: str, error: Exception):
+        entry = dict(_id=doc_id, model=model_name, label=label, error=f"{type(error).__name__}: {error}",
+                     time=time.time())
+        with self._lock, open(self._path, "a") as f:
+            f.write(json_util.dumps(entry) + "\n")
+            self.recorded += 1
+
+    @staticmethod
+    def _read(path: str) -> list[dict]:
+        if not os.path.exists(path):
+            return []
+        with open(path, "r") as f:
+            return [json_util.loads(line) for line in f if line.strip()]
+
+    def entries(self) -> list[dict]:
+        return self._read(self._path)
+
+    def take(self) -> dict:
+        """
+        Move the log aside and return a query selecting the documents it listed.
+        Documents that fail again while replaying are recorded afresh. The entries
+        taken are only deleted by :meth:`replayed`, so after a crashed replay the
+        next ``take`` returns them again.
+        """
+        with self._lock:
+            if os.path.exists(self._path):
+                if os.path.exists(self._taken_path):
+                    # Left over from a replay that did not finish: keep both
+                    with open(self._path, "r") as f:
+                        entries = f.read()
+                    with open(self._taken_path, "a") as f:
+                        f.write(entries)
+                    os.remove(self._path)
+                else:
+                    os.replace(self._path, self._taken_path)
+        entries = self._read(self._taken_path)
+        doc_ids = list({json_util.dumps(entry["_id"]): entry["_id"] for entry in entries}.values())
+        return {"_id": {"$in": doc_ids}}
+
+    def replayed(self):
+        """Delete the entries returned by :meth:`take`, once their replay has finished."""
+        with self._lock:
+            if os.path.exists(self._taken_path):
+                os.remove(self._taken_path)
@@ -0,0 +1,111 @@
+import re, json
+import requests
+from llm_dispatch import InvalidResponseError
+
+
+def iter_sse_content(resp: requests.Response):
+    """Yield the content deltas of an OpenAI-compatible ``text/event-stream`` completion."""
+    # Event streams are always UTF-8, whatever charset (if any) the Content-Type declares
+    for raw_line in resp.iter_lines():
+        line = raw_line.decode("utf-8")
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return
+        try:
+            choices = json.loads(data).get("choices") or []
+        except ValueError as e:
+            raise InvalidResponseError(f"Malformed stream event: {data[:80]}") from e
+        for choice in choices:
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                yield content
+
+
+class JsonObjectScanner:
+    """
+    Finds the end of the first JSON object in text fed piece by piece, tracking only
+    brace depth and string state, and rejects output that cannot become one: text
+    before the opening brace (apart from whitespace and a Markdown code fence), or
+    more than ``max_chars`` characters without the object closing.
+    """
+
+    FENCE = "```json"
+    PREAMBLE = re.compile(r"\s*(?:```(?:json)?\s*)?")
+
+    def __init__(self, max_chars: int = 16384):
+        self.max_chars = max_chars
+        self.text = ""
+        self._start = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str):
+        """Add ``chunk``; return the complete object's text once it has been seen, else None."""
+        self.text += chunk
+        if self._start is None:
+            if self.FENCE.startswith(self.text.lstrip()):
+                return None
+            start = self.PREAMBLE.match(self.text).end()
+            if start == len(self.text):
+                return None
+            if self.text[start] != "{":
+                raise InvalidResponseError(f"Expected a JSON object, got: {self.text[:80]!r}")
+            self._start = self._pos = start
+
+        text = self.text
+        for pos in range(self._pos, len(text)):
+            char = text[pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    return text[self._start:pos + 1]
+        self._pos = len(text)
+
+        if len(text) > self.max_chars:
+            raise InvalidResponseError(f"No complete JSON object in the first {self.max_chars} characters")
+        return None
+
+
+def parse_json_object(text: str, max_chars: int = 16384) -> dict:
+    """Parse the first JSON object in a complete reply, ignoring any code fence or text after it."""
+    object_text = JsonObjectScanner(max_chars).feed(text)
+    if object_text is None:
+        raise InvalidResponseError(f"No complete JSON object in the reply: {text[:80]!r}")
+    try:
+        return json.loads(object_text)
+    except ValueError as e:
+        raise InvalidResponseError(f"Invalid JSON object: {e}") from e
+
+
+def read_streamed_object(resp: requests.Response, max_chars: int = 16384) -> dict:
+    """
+    Read a streamed completion only up to the end of its JSON object and close the
+    response there, which also stops the server from generating the rest.
+    """
+    scanner = JsonObjectScanner(max_chars)
+    try:
+        for content in iter_sse_content(resp):
+            object_text = scanner.feed(content)
+            if object_text is not None:
+                try:
+                    return json.loads(object_text)
+                except ValueError as e:
+                    raise InvalidResponseError(f"Invalid JSON object: {e}") from e
+    finally:
+        resp.close()
+    raise InvalidResponseError(f"Stream ended without a complete JSON object: {scanner.text[:80]!r}")
@@ -0,0 +1,237 @@
+import os, sys, json, time, random, platform, argparse, tracemalloc
+from protobuf_decoder import Parser, ParsedResults, parse_classpath_bin, parse_apx_manifest
+
+try:
+    from protobuf_decoder import MessageView
+except ImportError:  # decoders before the lazy view, e.g. to record a baseline
+    MessageView = None
+
+# Decoders before the buffer rewrite only take hex strings
+PARSE_TAKES_BYTES = hasattr(Parser, "parse_buffer")
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode_field(field: int, wire_type: int, payload) -> bytes:
+    tag = encode_varint(field << 3 | wire_type)
+    if wire_type == 0:
+        return tag + encode_varint(payload)
+    if wire_type == 2:
+        return tag + encode_varint(len(payload)) + payload
+    return tag + payload
+
+
+def wide_flat_message(fields: int = 20000) -> bytes:
+    rng = random.Random(1)
+    return b"".join(
+        encode_field(idx % 100 + 1, 0, rng.getrandbits(rng.choice((7, 28, 63))))
+        for idx in range(fields)
+    )
+
+
+def deep_nested_message(depth: int = 200, repeat: int = 50) -> bytes:
+    message = encode_field(1, 0, 1)
+    for level in range(depth):
+        message = encode_field(1, 2, message + encode_field(2, 0, level))
+    return message * repeat
+
+
+def large_strings_message(count: int = 64, size: int = 16 * 1024) -> bytes:
+    rng = random.Random(2)
+    alphabet = b"abcdefghijklmnopqrstuvwxyz/._-"
+    return b"".join(
+        encode_field(1, 2, bytes(rng.choice(alphabet) for _ in range(size)))
+        for _ in range(count)
+    )
+
+
+def fixed64_message(count: int = 20000) -> bytes:
+    rng = random.Random(3)
+    return b"".join(encode_field(idx % 15 + 1, 1, rng.randbytes(8)) for idx in range(count))
+
+
+def classpath_message(jars: int = 200) -> bytes:
+    return b"".join(
+        encode_field(1, 2,
+                     encode_field(1, 2, f"/apex/com.android.module{idx}/javalib/module{idx}.jar".encode())
+                     + encode_field(2, 0, 1)
+                     + encode_field(3, 2, b"30"))
+        for idx in range(jars)
+    )
+
+
+def apex_manifest_message() -> bytes:
+    return (encode_field(1, 2, b"com.android.art")
+            + encode_field(2, 0, 341010000)
+            + encode_field(3, 0, 0)
+            + encode_field(6, 2, b"341010000"))
+
+
+SYNTHETIC_CASES = {
+    "wide_flat": (wide_flat_message, ("parse", "view_scan")),
+    "deep_nested": (deep_nested_message, ("parse", "view_scan", "view_last")),
+    "large_strings": (large_strings_message, ("parse", "view_scan")),
+    "fixed64": (fixed64_message, ("parse", "view_scan")),
+    "classpath": (classpath_message, ("parse", "parse_classpath_bin", "view_scan")),
+    "apex_manifest": (apex_manifest_message, ("parse", "parse_apx_manifest")),
+}
+
+
+def parse_input(data: bytes):
+    """What ``Parser.parse`` takes, converted once outside of the timed loop."""
+    return data if PARSE_TAKES_BYTES else data.hex()
+
+
+FUNCTIONS = {
+    "parse": lambda data: Parser().parse(data),
+    "parse_classpath_bin": parse_classpath_bin,
+    "parse_apx_manifest": parse_apx_manifest,
+    # Locate the top-level fields without decoding them
+    "view_scan": lambda data: len(MessageView(data)),
+    # Reach one deeply nested value: only the messages on its path are scanned
+    "view_last": lambda data: _view_last(MessageView(data)),
+}
+
+
+def _view_last(view: MessageView):
+    field = view[-1]
+    while field.is_length_delimited:
+        field = field.message[0]
+    return field.varint
+
+
+def sample_functions(path: str):
+    name = os.path.basename(path)
+    if "classpath" in name:
+        return "parse", "parse_classpath_bin", "view_scan"
+    if "apex_manifest" in name:
+        return "parse", "parse_apx_manifest"
+    return "parse", "view_scan"
+
+
+def count_fields(parsed: ParsedResults) -> int:
+    count = 0
+    stack = [parsed]
+    while stack:
+        results = stack.pop()
+        count += len(results.results)
+        stack.extend(result.data for result in results.results if isinstance(result.data, ParsedResults))
+    return count
+
+
+def measure(func, data: bytes, min_seconds: float, repeats: int) -> dict:
+    # Repeat the call until a run lasts at least min_seconds, and keep the best run
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(data)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+        loops *= 2
+
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(data)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(seconds_per_call=best / loops, peak_kib=peak / 1024)
+
+
+def run_benchmarks(samples, min_seconds: float = 0.2, repeats: int = 3, only=None) -> dict:
+    cases = {name: (factory(), functions) for name, (factory, functions) in SYNTHETIC_CASES.items()}
+    for path in samples:
+        with open(path, "rb") as f:
+            cases[f"sample:{os.path.basename(path)}"] = (f.read(), sample_functions(path))
+
+    results = {}
+    for case_name, (data, functions) in cases.items():
+        if only and not any(pattern in case_name for pattern in only):
+            continue
+        fields = count_fields(Parser().parse(parse_input(data)))
+        for func_name in functions:
+            if func_name.startswith("view_") and MessageView is None:
+                continue
+            func_data = parse_input(data) if func_name == "parse" else data
+            stats = measure(FUNCTIONS[func_name], func_data, min_seconds, repeats)
+            seconds = stats["seconds_per_call"]
+            result = dict(
+                bytes=len(data),
+                fields=fields,
+                mb_per_s=round(len(data) / seconds / 1e6, 3),
+                fields_per_s=round(fields / seconds, 1),
+                peak_kib=round(stats["peak_kib"], 1),
+            )
+            results[f"{case_name}/{func_name}"] = result
+            print(f"{case_name:<32} {func_name:<20} {result['mb_per_s']:>10.3f} MB/s "
+                  f"{result['fields_per_s']:>14.1f} fields/s {result['peak_kib']:>10.1f} KiB peak", file=sys.stderr)
+
+    return dict(
+        python=platform.python_version(),
+        machine=platform.machine(),
+        parse_input="bytes" if PARSE_TAKES_BYTES else "hex",
+        results=results,
+    )
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    regressed = False
+    for key, now in current["results"].items():
+        before = baseline["results"].get(key)
+        if before is None:
+            print(f"{key}: new")
+            continue
+        speed = now["mb_per_s"] / before["mb_per_s"] - 1
+        memory = now["peak_kib"] / before["peak_kib"] - 1 if before["peak_kib"] else 0.0
+        flag = ""
+        if speed < -threshold or memory > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"{key}: throughput {speed:+.1%}, peak memory {memory:+.1%}{flag}")
+    return regressed
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark protobuf_decoder")
+    arg_parser.add_argument("samples", nargs="*", help="captured .pb files, e.g. bootclasspath.pb, apex_manifest.pb")
+    arg_parser.add_argument("--only", action="append", help="only run cases whose name contains this")
+    arg_parser.add_argument("--min-seconds", type=float, default=0.2)
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    arg_parser.add_argument("--save", help="write results as JSON to this file")
+    arg_parser.add_argument("--compare", help="compare against a JSON file written by --save, "
+                                              "e.g. protobuf_bench_baseline.json")
+    arg_parser.add_argument("--threshold", type=float, default=0.2,
+                            help="relative slowdown or memory growth reported as a regression")
+    args = arg_parser.parse_args()
+
+    report = run_benchmarks(args.samples, min_seconds=args.min_seconds, repeats=args.repeats, only=args.only)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            if compare(json.load(f), report, args.threshold):
+                sys.exit(1)
+    elif not args.save:
+        print(json.dumps(report, indent=2, sort_keys=True))
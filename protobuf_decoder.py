@@ -1,9 +1,12 @@
 from __future__ import annotations
+import os
 import re
 import struct
-import ctypes
 from typing import List, Tuple, Union, Generator
 from enum import Enum
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 import binascii
 from dataclasses import dataclass
 
@@ -12,40 +15,42 @@ ParsedDataType = Union[str, int, "FixedBitsValue", "ParsedResults"]
 
 
 class FixedBitsValue:
-    _is_unsigned: bool
-    _unsigned_int_value: int
-    _signed_int_value: int
-    _bits: int
+    """
+    A fixed32/fixed64 field. Only the raw bits are stored; the signed, unsigned and
+    floating point interpretations are computed when they are accessed.
+    """
+    __slots__ = ("_bit_value", "_bits")
 
-    _value_type: str
+    _FLOAT_STRUCTS = {64: struct.Struct("<d"), 32: struct.Struct("<f")}
+    _VALUE_TYPES = {64: "double", 32: "float"}
 
     def __init__(self, bit_value: int, bits: int):
+        if bits not in self._FLOAT_STRUCTS:
+            raise ValueError(f"Not Supported: {bits}bits")
+        if bit_value > 0 and bit_value & ((1 << bits) - 1) == 0:
+            raise ValueError(f"Invalid {bits} bits range: {bit_value}")
+
         self._bit_value = bit_value
         self._bits = bits
-        self._parse()
-
-    def _parse(self):
-        if self._bits == 64:
-            self._pack_fmt = "<q"
-            self._unpack_fmt = "d"
-            self._value_type = "double"
-            self._signed_int_value = ctypes.c_int64(self._bit_value).value
-            self._unsigned_int_value = ctypes.c_uint64(self._bit_value).value
-
-        elif self._bits == 32:
-            self._pack_fmt = "<l"
-            self._unpack_fmt = "f"
-            self._value_type = "float"
-            self._signed_int_value = ctypes.c_int32(self._bit_value).value
-            self._unsigned_int_value = ctypes.c_uint32(self._bit_value).value
 
-        else:
-            raise ValueError(f"Not Supported: {self._bits}bits")
+    @property
+    def _unsigned_int_value(self) -> int:
+        return self._bit_value & ((1 << self._bits) - 1)
+
+    @property
+    def _signed_int_value(self) -> int:
+        unsigned_int_value = self._unsigned_int_value
+        if unsigned_int_value >> (self._bits - 1):
+            return unsigned_int_value - (1 << self._bits)
+        return unsigned_int_value
 
-        if self._bit_value > 0 and self._signed_int_value == 0 and self._unsigned_int_value == 0:
-            raise ValueError(f"Invalid {self._bits} bits range: {self._bit_value}")
+    @property
+    def _is_unsigned(self) -> bool:
+        return bool(self._unsigned_int_value >> (self._bits - 1))
 
-        self._is_unsigned = not self._signed_int_value == self._unsigned_int_value
+    @property
+    def _value_type(self) -> str:
+        return self._VALUE_TYPES[self._bits]
 
     @property
     def int(self):
@@ -61,7 +66,8 @@ class FixedBitsValue:
 
     @property
     def value(self):
-        return struct.unpack(self._unpack_fmt, struct.pack(self._pack_fmt, self._signed_int_value))[0]
+        float_struct = self._FLOAT_STRUCTS[self._bits]
+        return float_struct.unpack(self._unsigned_int_value.to_bytes(float_struct.size, "little"))[0]
 
     def __str__(self):
         _name = f"Fixed{self._bits}Value"
@@ -87,7 +93,7 @@ class FixedBitsValue:
         return dict_result
 
 
-@dataclass(init=False)
+@dataclass(init=False, slots=True)
 class ParsedResult:
     field: int
     wire_type: str
@@ -98,9 +104,10 @@ class ParsedResult:
         self.wire_type = wire_type
         self.data = data
 
-    def to_dict(self):
+    def _to_dict(self, nested: list):
         if isinstance(self.data, ParsedResults):
-            data = self.data.to_dict()
+            data = {}
+            nested.append((self.data, data))
         elif isinstance(self.data, FixedBitsValue):
             data = self.data.to_dict()
         else:
@@ -112,8 +119,14 @@ class ParsedResult:
             data=data
         )
 
+    def to_dict(self):
+        nested = []
+        dict_result = self._to_dict(nested)
+        ParsedResults._fill_dicts(nested)
+        return dict_result
 
-@dataclass
+
+@dataclass(slots=True)
 class ParsedResults:
     results: List[ParsedResult]
     remain_data: str = None
@@ -129,31 +142,22 @@ class ParsedResults:
     def __getitem__(self, item):
         return self.results[item]
 
-    def to_dict(self):
-        results = [result.to_dict() for result in self.results]
-        dict_results = dict(
-            results=results,
-        )
-        if self.has_remain_data:
-            dict_results["remain_data"] = self.remain_data
+    @staticmethod
+    def _fill_dicts(nested: list):
+        # Nested messages are converted from an explicit stack, not recursively, so
+        # anything the parser could decode can also be converted
+        while nested:
+            parsed_results, dict_results = nested.pop()
+            dict_results["results"] = [result._to_dict(nested) for result in parsed_results.results]
+            if parsed_results.has_remain_data:
+                dict_results["remain_data"] = parsed_results.remain_data
 
+    def to_dict(self):
+        dict_results = {}
+        self._fill_dicts([(self, dict_results)])
         return dict_results
 
 
-class State(Enum):
-    FIND_FIELD = 1
-    PARSE_VARINT = 2
-    PARSE_LENGTH_DELIMITED = 3
-    GET_DELIMITED_DATA = 4
-    TERMINATED = 5
-
-    PARSE_BIT64 = 6
-    PARSE_BIT32 = 7
-
-    PARSE_START_GROUP = 8
-    PARSE_END_GROUP = 9
-
-
 class WireType(Enum):
     VARINT = 0
     LEN = 2
@@ -189,9 +193,8 @@ class Utils:
 
     @classmethod
     def get_chunked_list(cls, string) -> Generator[str]:
-        while string:
-            yield string[:2]
-            string = string[2:]
+        for idx in range(0, len(string), 2):
+            yield string[idx:idx + 2]
 
     @classmethod
     def hex_string_to_binary(cls, string) -> str:
@@ -234,384 +237,926 @@ class Utils:
 
     @classmethod
     def show_parsed_results(cls, parsed_results: ParsedResults, depth=0, print_func=print):
-        if parsed_results.has_results:
-            for result in parsed_results.results:
+        # One iterator per open message instead of recursion, like Parser.parse_buffer
+        stack = [(parsed_results, iter(parsed_results.results), depth)]
+        while stack:
+            parsed_results, results, depth = stack[-1]
+            for result in results:
                 if isinstance(result.data, ParsedResults):
                     print_func("\t" * depth, f"[{result.field}: {result.wire_type}] =>")
-                    cls.show_parsed_results(result.data, depth + 1)
-                else:
-                    print_func("\t" * depth, f"[{result.field}: {result.wire_type}] => {result.data}")
-        if parsed_results.has_remain_data:
-            print_func("\t" * depth, f"left over bytes: {parsed_results.remain_data}")
-
-
-class BytesBuffer:
-    def __init__(self):
-        self._buffer = []
-
-    def append(self, byte_string):
-        self._buffer.append(byte_string)
-
-    def flush(self):
-        self._buffer = []
-
-    def __iter__(self):
-        return iter(self._buffer)
+                    stack.append((result.data, iter(result.data.results), depth + 1))
+                    break
+                print_func("\t" * depth, f"[{result.field}: {result.wire_type}] => {result.data}")
+            else:
+                stack.pop()
+                if parsed_results.has_remain_data:
+                    print_func("\t" * depth, f"left over bytes: {parsed_results.remain_data}")
+
+
+_WIRE_TYPE_NAMES = {
+    WireType.VARINT.value: "varint",
+    WireType.I64.value: "fixed64",
+    WireType.I32.value: "fixed32",
+}
+
+
+def _read_varint(view, pos: int, end: int) -> Tuple[Union[int, None], int]:
+    value = 0
+    shift = 0
+    while pos < end:
+        byte = view[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+    return None, pos
+
+
+def _locate_field(view, pos: int, end: int) -> Union[Tuple[int, int, Union[int, None]], None]:
+    """
+    Find the value of the field whose tag starts at ``pos`` without decoding it.
+
+    Returns ``(tag, value_start, value_length)``, or None when the field is cut off
+    before ``end``. ``value_length`` is None for groups and invalid wire types, which
+    cannot be skipped.
+    """
+    tag, pos = _read_varint(view, pos, end)
+    if tag is None:
+        return None
+
+    wire_type = tag & 0x7
+    if wire_type == WireType.VARINT.value:
+        value, value_end = _read_varint(view, pos, end)
+        if value is None:
+            return None
+        return tag, pos, value_end - pos
+    if wire_type == WireType.LEN.value:
+        length, pos = _read_varint(view, pos, end)
+        if length is None or end - pos < length:
+            return None
+        return tag, pos, length
+    if wire_type == WireType.I64.value or wire_type == WireType.I32.value:
+        length = 8 if wire_type == WireType.I64.value else 4
+        if end - pos < length:
+            return None
+        return tag, pos, length
+    return tag, pos, None
+
+
+# Nesting limit of the CLI and decode_blob, the same as protobuf's own default
+# recursion limit; it also keeps the JSON output within what json.dumps can nest
+DEFAULT_MAX_DEPTH = 100
+
+
+class DecodeLimitError(ValueError):
+    """Raised as soon as a :class:`Parser` budget (depth, fields or bytes) is exceeded."""
+
+    def __init__(self, message: str, offset: int, depth: int):
+        super().__init__(f"{message} at offset {offset}, depth {depth}")
+        self.message = message
+        self.offset = offset
+        self.depth = depth
+
+
+class _Frame:
+    __slots__ = ("field", "results", "pos", "end", "remain_from", "is_done", "depth")
+
+    def __init__(self, field: Union[int, None], pos: int, end: int, depth: int):
+        self.field = field
+        self.results: List[ParsedResult] = []
+        self.pos = pos
+        self.end = end
+        self.remain_from = None
+        self.is_done = True
+        self.depth = depth
 
 
-class Fetcher:
-    def __init__(self):
-        self._data_length = 0
-        self._fetch_index = 0
+class Parser:
+    """
+    Schema-less protobuf decoder.
+
+    Nested messages are decoded with an explicit stack, not recursion. ``max_depth``
+    limits how deep nested messages may go, ``max_fields`` how many fields may be
+    decoded in total, and ``max_bytes`` how many bytes may be walked in total (the
+    input once, plus each nested payload again for every level it is decoded at).
+    Exceeding a budget raises :class:`DecodeLimitError` immediately. The budgets
+    cover everything one instance decodes, which ``fields_count`` and ``bytes_count``
+    keep track of; create a new parser per message for per-message budgets.
+    """
+
+    def __init__(self, nexted_depth: int = 0, strict: bool = False,
+                 max_depth: int = None, max_fields: int = None, max_bytes: int = None):
+        self._nested_depth = nexted_depth
+        self._is_strict = strict
+        self._max_depth = max_depth
+        self._max_fields = max_fields
+        self._max_bytes = max_bytes
+        self.fields_count = 0
+        self.bytes_count = 0
 
-    def set_data_length(self, data_length):
-        self._valid(data_length)
-        self._data_length = data_length
+    def _create_nested_parser(self) -> Parser:
+        return Parser(
+            nexted_depth=self._nested_depth + 1,
+            strict=self._is_strict,
+            max_depth=self._max_depth,
+            max_fields=self._max_fields,
+            max_bytes=self._max_bytes,
+        )
 
     @staticmethod
-    def _valid(data_length):
-        if not isinstance(data_length, int):
-            raise TypeError(f"a int object is required, not {repr(type(data_length))}")
+    def is_maybe_nested_protobuf(string_or_not) -> bool:
+        """
+        Determine if the given input might be a nested protobuf.
 
-        if data_length <= 0:
-            raise ValueError(f"data_length should be positive")
+        Args:
+            string_or_not (str | bytes): Hex string or raw payload to be checked.
 
-    def fetch(self):
-        self._fetch_index += 1
+        Returns:
+            bool: True if the input is likely a nested protobuf, otherwise False.
+        """
 
-    @property
-    def has_next(self):
-        return self._fetch_index < self._data_length - 1
+        # Try to convert the input to UTF-8
+        try:
+            if isinstance(string_or_not, str):
+                _data = Utils.hex_string_to_utf8(string_or_not)
+            else:
+                _data = str(string_or_not, "utf-8")
+        except UnicodeDecodeError:
+            # If a UnicodeDecodeError occurs, it's possibly a nested protobuf
+            return True
 
-    def seek(self, index=0):
-        self._fetch_index = index
+        # Check the first 4 characters of the decoded data
+        for c in _data[0:4]:
+            # If any character has an ordinal value less than 0x20,
+            # it's possibly a nested protobuf
+            if ord(c) < 0x20:
+                return True
 
-    @property
-    def fetching_count(self):
-        return self._fetch_index
+        # If none of the above conditions were met, it's likely not a nested protobuf
+        return False
 
-    @property
-    def fetching_bits(self):
-        return self.fetching_count * 8
+    def _parse_delimited(self, field: int, payload: memoryview) -> ParsedResult:
+        if self.is_maybe_nested_protobuf(payload):
+            data = self._create_nested_parser().parse_buffer(payload)
+            wire_type = "length_delimited"
+        else:
+            data = str(payload, "utf-8")
+            wire_type = "string"
 
-    def fetch_64bits(self):
-        self.set_data_length(8 + 1)
+        return ParsedResult(field=field, wire_type=wire_type, data=data)
 
-    def fetch_32bits(self):
-        self.set_data_length(4 + 1)
+    def parse_buffer(self, data, start: int = 0, end: int = None) -> ParsedResults:
+        """
+        Decode ``data[start:end]`` by walking offsets over the buffer.
 
+        Leftover bytes are reported the same way as the hex string parser always did:
+        an incomplete field keeps its tag bytes, an incomplete length-delimited payload
+        only keeps the payload bytes received so far.
+        """
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        if end is None:
+            end = len(view)
+
+        max_depth, max_fields, max_bytes = self._max_depth, self._max_fields, self._max_bytes
+        fields_count = self.fields_count
+        bytes_count = self.bytes_count + end - start
+        if max_bytes is not None and bytes_count > max_bytes:
+            raise DecodeLimitError(f"Byte budget of {max_bytes} exceeded", start, self._nested_depth)
+
+        stack = [_Frame(None, start, end, self._nested_depth)]
+        while True:
+            frame = stack[-1]
+            results, pos, frame_end = frame.results, frame.pos, frame.end
+            nested = None
+
+            while pos < frame_end:
+                field_start = pos
+                tag, pos = _read_varint(view, pos, frame_end)
+                if tag is None:
+                    frame.remain_from = field_start
+                    break
+
+                wire_type = tag & 0x7
+                field = tag >> 3
+
+                if wire_type == WireType.VARINT.value:
+                    value, pos = _read_varint(view, pos, frame_end)
+                    if value is None:
+                        frame.remain_from, frame.is_done = field_start, False
+                        break
+                    result = ParsedResult(field=field, wire_type="varint", data=value)
+
+                elif wire_type == WireType.LEN.value:
+                    length, pos = _read_varint(view, pos, frame_end)
+                    if length is None:
+                        frame.remain_from, frame.is_done = field_start, False
+                        break
+                    if length == 0:
+                        result = ParsedResult(field=field, wire_type="string", data="")
+                    elif frame_end - pos < length:
+                        frame.remain_from = pos
+                        break
+                    else:
+                        payload = view[pos:pos + length]
+                        if self.is_maybe_nested_protobuf(payload):
+                            depth = frame.depth + 1
+                            if max_depth is not None and depth > max_depth:
+                                raise DecodeLimitError(f"Nesting deeper than {max_depth}", field_start, depth)
+                            bytes_count += length
+                            if max_bytes is not None and bytes_count > max_bytes:
+                                raise DecodeLimitError(f"Byte budget of {max_bytes} exceeded", field_start, depth)
+                            nested = _Frame(field, pos, pos + length, depth)
+                        else:
+                            result = ParsedResult(field=field, wire_type="string", data=str(payload, "utf-8"))
+                        pos += length
+
+                elif wire_type == WireType.I64.value or wire_type == WireType.I32.value:
+                    size = 8 if wire_type == WireType.I64.value else 4
+                    if frame_end - pos < size:
+                        frame.remain_from, frame.is_done = field_start, False
+                        break
+                    result = ParsedResult(
+                        field=field,
+                        wire_type=_WIRE_TYPE_NAMES[wire_type],
+                        data=FixedBitsValue(bit_value=int.from_bytes(view[pos:pos + size], "little"), bits=size * 8)
+                    )
+                    pos += size
 
-class RemainChunkTransaction:
-    def __init__(self):
-        self._is_done = True
-        self._remain_hex_string_list = []
+                else:
+                    # Groups are not decoded, and anything else is not a valid wire type:
+                    # everything from this tag on is left over.
+                    if wire_type not in (WireType.SGROUP.value, WireType.EGROUP.value) and self._is_strict:
+                        raise AssertionError(f"Invalid wire_type: {wire_type}")
+                    frame.remain_from, frame.is_done = field_start, False
+                    break
+
+                fields_count += 1
+                if max_fields is not None and fields_count > max_fields:
+                    raise DecodeLimitError(f"Field budget of {max_fields} exceeded", field_start, frame.depth)
+                if nested is not None:
+                    break
+                results.append(result)
+
+            frame.pos = pos
+            if nested is not None:
+                stack.append(nested)
+                continue
 
-    def consume_chunk(self, chunk):
-        self._remain_hex_string_list.append(
-            Utils.chunk_to_hex_string(chunk)
-        )
+            if self._is_strict:
+                assert frame.is_done, "parsing process is not done, Maybe invalid protobuf"
 
-    def flush_chunk(self):
-        self._remain_hex_string_list = []
+            if frame.remain_from is None or frame.remain_from >= frame_end:
+                parsed = ParsedResults(results=results)
+            else:
+                parsed = ParsedResults(results=results, remain_data=view[frame.remain_from:frame_end].hex(" "))
 
-    def start(self):
-        self._is_done = False
+            stack.pop()
+            if not stack:
+                self.fields_count, self.bytes_count = fields_count, bytes_count
+                return parsed
+            stack[-1].results.append(ParsedResult(field=frame.field, wire_type="length_delimited", data=parsed))
 
-    def done(self):
-        self._is_done = True
-        self.flush_chunk()
+    def parse(self, test_target) -> ParsedResults:
+        """
+        Decode a protobuf message given as raw bytes (``bytes``, ``bytearray``,
+        ``memoryview``) or as a hex string.
+        """
+        if isinstance(test_target, str):
+            if test_target == "":
+                return ParsedResults(results=[])
+
+            is_valid, validate_string = Utils.validate(test_target)
+            if not is_valid:
+                raise ValueError("Invalid hex format")
+            test_target = bytes.fromhex(validate_string)
+
+        return self.parse_buffer(test_target)
+
+class FieldView:
+    """
+    One field of a :class:`MessageView`. Only the tag is decoded up front; the value is
+    decoded from ``(offset, length)`` in the original buffer when it is accessed.
+    """
+    __slots__ = ("field", "wire_type", "offset", "length", "_view", "_strict")
+
+    def __init__(self, view: memoryview, field: int, wire_type: int, offset: int, length: int, strict: bool = False):
+        self._view = view
+        self._strict = strict
+        self.field = field
+        self.wire_type = wire_type
+        self.offset = offset
+        self.length = length
 
     @property
-    def is_done(self):
-        return self._is_done
+    def raw(self) -> memoryview:
+        return self._view[self.offset:self.offset + self.length]
 
     @property
-    def remain_hex_string_list(self):
-        return self._remain_hex_string_list
+    def varint(self) -> int:
+        return _read_varint(self._view, self.offset, self.offset + self.length)[0]
 
     @property
-    def remain_hex_string(self):
-        return " ".join(self._remain_hex_string_list)
+    def string(self) -> str:
+        return str(self.raw, "utf-8")
 
     @property
-    def has_remain_data(self):
-        return len(self._remain_hex_string_list) > 0
-
+    def fixed(self) -> FixedBitsValue:
+        return FixedBitsValue(bit_value=int.from_bytes(self.raw, "little"), bits=self.length * 8)
 
-class Parser:
-    def __init__(self, nexted_depth: int = 0, strict: bool = False):
-        self._nested_depth = nexted_depth
-        self._buffer = BytesBuffer()
-        self._fetcher = Fetcher()
-        self._target_field = None
-        self._parsed_data: List[ParsedResult] = []
-        self._state = State.FIND_FIELD
-        self._is_strict = strict
-
-        self._t = RemainChunkTransaction()
+    @property
+    def message(self) -> MessageView:
+        return MessageView(self._view, self.offset, self.offset + self.length, strict=self._strict)
 
-    def _create_nested_parser(self) -> Parser:
-        return Parser(nexted_depth=self._nested_depth + 1, strict=self._is_strict)
+    @property
+    def is_length_delimited(self) -> bool:
+        return self.wire_type == WireType.LEN.value
+
+    def to_result(self) -> ParsedResult:
+        """Decode this field the same way :class:`Parser` does, guessing about nesting."""
+        if not self.is_length_delimited:
+            data = self.varint if self.wire_type == WireType.VARINT.value else self.fixed
+            return ParsedResult(field=self.field, wire_type=_WIRE_TYPE_NAMES[self.wire_type], data=data)
+        if self.length == 0:
+            return ParsedResult(field=self.field, wire_type="string", data="")
+        return Parser(strict=self._strict)._parse_delimited(self.field, self.raw)
 
-    @staticmethod
-    def _has_next(chunk_bytes) -> bool:
-        return bool(chunk_bytes & 0x80)
+    @property
+    def data(self) -> ParsedDataType:
+        return self.to_result().data
 
-    @staticmethod
-    def _get_value(chunk_bytes) -> int:
-        return chunk_bytes & 0x7F
+    def __repr__(self):
+        return f"FieldView(field={self.field}, wire_type={self.wire_type}, offset={self.offset}, length={self.length})"
+
+
+class MessageView:
+    """
+    Lazy, zero-copy view of a protobuf message.
+
+    Fields are located by scanning tags and skipping over values, so nested messages
+    and strings are only decoded when a :class:`FieldView` value is accessed. Scanning
+    stops at the first field that cannot be located (truncated data, groups, invalid
+    wire types); ``remain_offset`` then points at it, and a strict view raises.
+
+    Use it to pick a few fields out of a large message: locating every field is much
+    cheaper than decoding them, but decoding every field through :class:`FieldView`
+    objects is slower than a single :meth:`Parser.parse` (see ``protobuf_bench.py``).
+    """
+
+    _MAX_TAG = (1 << 64) - 1
+
+    def __init__(self, data, start: int = 0, end: int = None, strict: bool = False):
+        self._view = data if isinstance(data, memoryview) else memoryview(data)
+        self._start = start
+        self._end = len(self._view) if end is None else end
+        self._strict = strict
+        # Parallel lists of (tag, offset, length); FieldView objects are only
+        # created when a field is accessed.
+        self._tags: Union[List[int], None] = None
+        self._offsets: Union[List[int], None] = None
+        self._lengths: Union[List[int], None] = None
+        self.remain_offset: Union[int, None] = None
+
+    def _scan(self) -> int:
+        if self._tags is not None:
+            return len(self._tags)
+
+        view, end, strict = self._view, self._end, self._strict
+        tags, offsets, lengths = [], [], []
+        pos = self._start
+        while pos < end:
+            # Fast path for tags of up to two bytes: varints are skipped without being
+            # decoded, lengths of up to two bytes are read inline
+            byte = view[pos]
+            if byte < 0x80:
+                tag, value_start = byte, pos + 1
+            elif pos + 1 < end and view[pos + 1] < 0x80:
+                tag, value_start = byte & 0x7F | view[pos + 1] << 7, pos + 2
+            else:
+                tag = None
+            if tag is not None and value_start < end:
+                wire_type = tag & 0x7
+                if wire_type == 0:
+                    value_end = value_start
+                    while value_end < end and view[value_end] & 0x80:
+                        value_end += 1
+                    if value_end < end:
+                        tags.append(tag)
+                        offsets.append(value_start)
+                        lengths.append(value_end + 1 - value_start)
+                        pos = value_end + 1
+                        continue
+                elif wire_type == 2:
+                    length = view[value_start]
+                    payload_start = value_start + 1
+                    if length >= 0x80:
+                        if payload_start < end and view[payload_start] < 0x80:
+                            length = length & 0x7F | view[payload_start] << 7
+                            payload_start += 1
+                        else:
+                            length = None
+                    if length is not None and payload_start + length <= end:
+                        tags.append(tag)
+                        offsets.append(payload_start)
+                        lengths.append(length)
+                        pos = payload_start + length
+                        continue
+
+            located = _locate_field(view, pos, end)
+            if located is None:
+                self.remain_offset = pos
+                break
+
+            tag, value_start, length = located
+            if length is None or tag > self._MAX_TAG:
+                wire_type = tag & 0x7
+                if wire_type not in (WireType.SGROUP.value, WireType.EGROUP.value) and strict:
+                    raise AssertionError(f"Invalid wire_type: {wire_type}")
+                self.remain_offset = pos
+                break
+
+            tags.append(tag)
+            offsets.append(value_start)
+            lengths.append(length)
+            pos = value_start + length
+
+        self._tags, self._offsets, self._lengths = tags, offsets, lengths
+        if strict and self.remain_offset is not None:
+            raise AssertionError(f"parsing process is not done at offset {self.remain_offset}, Maybe invalid protobuf")
+        return len(tags)
+
+    def _field_view(self, idx: int) -> FieldView:
+        tag = self._tags[idx]
+        return FieldView(self._view, tag >> 3, tag & 0x7, self._offsets[idx], self._lengths[idx], strict=self._strict)
 
-    @staticmethod
-    def _parse_wire_type(chunk_bytes) -> Tuple[int, int]:
-        wire_type = chunk_bytes & 0x7
-        field = chunk_bytes >> 3
-        return wire_type, field
-
-    def _get_buffered_value(self, mask=7) -> int:
-        bit_value = 0
-        for idx, byte_string in enumerate(self._buffer):
-            bit_value += byte_string << (mask * idx)
-        return bit_value
-
-    def _next_buffer_handler(self, value):
-        self._buffer.append(value)
-
-    def _handler_find_field(self, chunk):
-        value = self._get_value(chunk)
-        if self._has_next(chunk):
-            return self._next_buffer_handler(value)
-
-        self._t.start()
-
-        self._buffer.append(value)
-        bit_value = self._get_buffered_value()
-        wire_type, field = self._parse_wire_type(bit_value)
-        self._target_field = field
-
-        if wire_type == WireType.VARINT.value:
-            self._state = State.PARSE_VARINT
-        elif wire_type == WireType.LEN.value:
-            self._state = State.PARSE_LENGTH_DELIMITED
-        elif wire_type == WireType.I64.value:
-            self._state = State.PARSE_BIT64
-        elif wire_type == WireType.I32.value:
-            self._state = State.PARSE_BIT32
-        elif wire_type == WireType.SGROUP.value:
-            self._state = State.PARSE_START_GROUP
-        elif wire_type == WireType.EGROUP.value:
-            self._state = State.PARSE_END_GROUP
-        elif wire_type == WireType.EGROUP.value:
-            self._state = State.TERMINATED
-        else:
-            if self._is_strict:
-                raise AssertionError(f"Invalid wire_type: {wire_type}")
-            self._state = State.TERMINATED
-
-        self._buffer.flush()
-
-    def _parse_varint_handler(self, chunk):
-        value = self._get_value(chunk)
-        if self._has_next(chunk):
-            return self._next_buffer_handler(value)
-
-        self._buffer.append(value)
-        bit_value = self._get_buffered_value()
-        self._parsed_data.append(
-            ParsedResult(
-                field=self._target_field,
-                wire_type="varint",
-                data=bit_value
-            )
-        )
+    @property
+    def has_remain_data(self) -> bool:
+        self._scan()
+        return self.remain_offset is not None
 
-        self._state = State.FIND_FIELD
-        self._buffer.flush()
-        self._t.done()
-
-    def _parse_fixed_handler(self, chunk):
-        self._next_buffer_handler(chunk)
-        self._fetcher.fetch()
-
-        if not self._fetcher.has_next:
-            bits = self._fetcher.fetching_bits
-            int_value = self._get_buffered_value(mask=8)
-
-            self._parsed_data.append(
-                ParsedResult(
-                    field=self._target_field,
-                    wire_type=f"fixed{bits}",
-                    data=FixedBitsValue(bit_value=int_value, bits=bits)
-                )
-            )
-
-            self._state = State.FIND_FIELD
-            self._buffer.flush()
-            self._fetcher.seek()
-            self._t.done()
-
-    def _zero_length_delimited_handler(self):
-        self._parsed_data.append(
-            ParsedResult(
-                field=self._target_field,
-                wire_type="string",
-                data=""
-            )
-        )
-        self._state = State.FIND_FIELD
-        self._buffer.flush()
-        self._t.done()
+    def fields(self, field: int) -> List[FieldView]:
+        self._scan()
+        return [self._field_view(idx) for idx, tag in enumerate(self._tags) if tag >> 3 == field]
 
-    def _parse_length_delimited_handler(self, chunk):
-        value = self._get_value(chunk)
-        if self._has_next(chunk):
-            return self._next_buffer_handler(value)
+    def first(self, field: int) -> Union[FieldView, None]:
+        self._scan()
+        for idx, tag in enumerate(self._tags):
+            if tag >> 3 == field:
+                return self._field_view(idx)
+        return None
 
-        self._buffer.append(value)
-        data_length = self._get_buffered_value()
-        if data_length == 0:
-            return self._zero_length_delimited_handler()
+    def to_results(self) -> ParsedResults:
+        """Fully decode the viewed range, identical to :meth:`Parser.parse`."""
+        return Parser(strict=self._strict).parse_buffer(self._view, self._start, self._end)
 
-        self._fetcher.set_data_length(data_length)
-        self._state = State.GET_DELIMITED_DATA
-        self._buffer.flush()
-        self._t.done()
+    def __iter__(self):
+        for idx in range(self._scan()):
+            yield self._field_view(idx)
 
-    def _next_get_delimited_data_handler(self, value):
-        self._fetcher.fetch()
-        self._buffer.append(value)
+    def __len__(self):
+        return self._scan()
 
-    @staticmethod
-    def is_maybe_nested_protobuf(string_or_not) -> bool:
+    def __getitem__(self, item):
+        count = self._scan()
+        if isinstance(item, slice):
+            return [self._field_view(idx) for idx in range(*item.indices(count))]
+        if item < 0:
+            item += count
+        if not 0 <= item < count:
+            raise IndexError("field index out of range")
+        return self._field_view(item)
+
+
+class StreamParser:
+    """
+    Incremental decoder for a stream of top-level fields.
+
+    ``feed`` buffers only the top-level field that is still incomplete and returns the
+    fields completed by each chunk, decoded exactly as :meth:`Parser.parse` would
+    decode them. Once a group or an invalid wire type is met nothing more can be
+    decoded, and the rest of the stream is kept as left-over data.
+
+    Decode budgets (see :class:`Parser`) apply to the stream as a whole: the fields
+    and bytes decoded by every :meth:`feed` and :meth:`close` count against the same
+    ``max_fields`` and ``max_bytes``, and an incomplete field is not buffered beyond
+    what is left of ``max_bytes``.
+    """
+
+    def __init__(self, strict: bool = False, max_depth: int = None, max_fields: int = None,
+                 max_bytes: int = None):
+        self._is_strict = strict
+        self._max_bytes = max_bytes
+        # One parser for the whole stream, so its budgets are shared by every field
+        self._parser = Parser(strict=strict, max_depth=max_depth, max_fields=max_fields, max_bytes=max_bytes)
+        self._buffer = bytearray()
+        self._offset = 0
+        self._is_terminated = False
+        self.remain_data: Union[str, None] = None
+
+    def _parse(self, data) -> ParsedResults:
+        try:
+            return self._parser.parse_buffer(data)
+        except DecodeLimitError as e:
+            raise DecodeLimitError(e.message, self._offset + e.offset, e.depth) from None
+
+    def _next_field_end(self) -> Union[int, None]:
+        located = _locate_field(self._buffer, 0, len(self._buffer))
+        if located is None:
+            return None
+
+        tag, value_start, length = located
+        if length is None:
+            wire_type = tag & 0x7
+            if wire_type not in (WireType.SGROUP.value, WireType.EGROUP.value) and self._is_strict:
+                raise AssertionError(f"Invalid wire_type: {wire_type}")
+            self._is_terminated = True
+            return None
+        return value_start + length
+
+    def _split(self, chunk) -> List[bytes]:
+        self._buffer += chunk
+        if self._max_bytes is not None and len(self._buffer) > self._max_bytes - self._parser.bytes_count:
+            raise DecodeLimitError(f"Byte budget of {self._max_bytes} exceeded", self._offset, 0)
+        if self._is_terminated:
+            return []
+
+        fields = []
+        while self._buffer:
+            field_end = self._next_field_end()
+            if field_end is None:
+                break
+            fields.append(bytes(self._buffer[:field_end]))
+            del self._buffer[:field_end]
+            self._offset += field_end
+        return fields
+
+    def feed(self, chunk) -> List[ParsedResult]:
+        results = []
+        for field_data in self._split(chunk):
+            results.extend(self._parse(field_data).results)
+        return results
+
+    def feed_bytes(self, chunk) -> bytes:
+        """Like :meth:`feed`, but return the completed top-level fields undecoded."""
+        return b"".join(self._split(chunk))
+
+    def feed_views(self, chunk) -> List[FieldView]:
+        """Like :meth:`feed`, but return undecoded :class:`FieldView` objects."""
+        return [MessageView(field_data, strict=self._is_strict)[0] for field_data in self._split(chunk)]
+
+    def close(self) -> Union[str, None]:
         """
-        Determine if the given input might be a nested protobuf.
-
-        Args:
-            string_or_not (str): Input string or data to be checked.
-
-        Returns:
-            bool: True if the input is likely a nested protobuf, otherwise False.
+        Finish the stream and return the left-over data, formatted like
+        :attr:`ParsedResults.remain_data`. A strict parser raises instead.
         """
+        left = self._parse(bytes(self._buffer))
+        self._buffer = bytearray()
+        self.remain_data = left.remain_data
+        return self.remain_data
+
+
+def iter_fields(fileobj, chunk_size: int = 64 * 1024, strict: bool = False) -> Generator[ParsedResult]:
+    """
+    Yield the top-level fields read from a binary file object (a file, a pipe,
+    ``sys.stdin.buffer`` ...) as soon as each one is complete.
+    """
+    parser = StreamParser(strict=strict)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield from parser.feed(chunk)
+    parser.close()
+
+
+def iter_field_views(fileobj, chunk_size: int = 64 * 1024, strict: bool = False) -> Generator[FieldView]:
+    """Like :func:`iter_fields`, but yield undecoded :class:`FieldView` objects."""
+    parser = StreamParser(strict=strict)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield from parser.feed_views(chunk)
+    parser.close()
+
+
+@dataclass(frozen=True)
+class SchemaField:
+    name: str
+    kind: str
+    repeated: bool = False
+    schema: MessageSchema = None
+
+
+class MessageSchema:
+    """
+    Declarative decoder for a known message type.
+
+    Only the field numbers listed in ``fields`` are decoded, straight from the buffer
+    into ``record_type`` (called with one keyword argument per schema field); everything
+    else is skipped without being looked at. Unlike :class:`Parser` nothing is guessed:
+    each field is decoded as its declared ``kind``. Decoding stops quietly at a
+    truncated field or a group, like a non-strict :class:`Parser`.
+    """
+
+    _WIRE_TYPES = {
+        "string": WireType.LEN.value,
+        "bytes": WireType.LEN.value,
+        "message": WireType.LEN.value,
+        "varint": WireType.VARINT.value,
+        "int64": WireType.VARINT.value,
+        "bool": WireType.VARINT.value,
+        "enum": WireType.VARINT.value,
+        "fixed64": WireType.I64.value,
+        "fixed32": WireType.I32.value,
+    }
+
+    _DEFAULTS = {
+        "string": "",
+        "bytes": b"",
+        "message": None,
+        "varint": 0,
+        "int64": 0,
+        "bool": False,
+        "enum": 0,
+        "fixed64": 0,
+        "fixed32": 0,
+    }
+
+    def __init__(self, record_type, fields: dict[int, SchemaField]):
+        for number, schema_field in fields.items():
+            if schema_field.kind not in self._WIRE_TYPES:
+                raise ValueError(f"Unsupported kind for field {number}: {schema_field.kind}")
+        self.record_type = record_type
+        self.fields = fields
+        self._defaults = {
+            schema_field.name: self._DEFAULTS[schema_field.kind]
+            for schema_field in fields.values() if not schema_field.repeated
+        }
+        self._repeated = [schema_field.name for schema_field in fields.values() if schema_field.repeated]
+
+    def _new_values(self) -> dict:
+        values = dict(self._defaults)
+        for name in self._repeated:
+            values[name] = []
+        return values
+
+    def _decode_into(self, values: dict, view: memoryview, pos: int, end: int):
+        fields = self.fields
+        while pos < end:
+            field_start = pos
+            # Tags and lengths almost always fit in one byte
+            tag = view[pos]
+            if tag < 0x80:
+                pos += 1
+            else:
+                tag, pos = _read_varint(view, pos, end)
+                if tag is None:
+                    return
+            wire_type = tag & 0x7
+
+            if wire_type == 2:  # WireType.LEN
+                length = view[pos] if pos < end else 0x80
+                if length < 0x80:
+                    pos += 1
+                else:
+                    length, pos = _read_varint(view, pos, end)
+                    if length is None:
+                        return
+                value_end = pos + length
+            elif wire_type == 0:  # WireType.VARINT
+                value = view[pos] if pos < end else 0x80
+                if value < 0x80:
+                    value_end = pos + 1
+                else:
+                    value, value_end = _read_varint(view, pos, end)
+                    if value is None:
+                        return
+            elif wire_type == 1 or wire_type == 5:  # WireType.I64, WireType.I32
+                value_end = pos + (8 if wire_type == 1 else 4)
+            else:
+                return
+            if value_end > end:
+                return
+
+            schema_field = fields.get(tag >> 3)
+            if schema_field is not None:
+                kind = schema_field.kind
+                if self._WIRE_TYPES[kind] != wire_type:
+                    raise ValueError(
+                        f"Field {tag >> 3} ({schema_field.name}) at offset {field_start}: "
+                        f"expected wire type {self._WIRE_TYPES[kind]}, got {wire_type}"
+                    )
+                if kind == "string":
+                    value = str(view[pos:value_end], "utf-8")
+                elif kind == "message":
+                    value = schema_field.schema.decode(view, pos, value_end)
+                elif kind == "bytes":
+                    value = bytes(view[pos:value_end])
+                elif wire_type != 0:
+                    value = int.from_bytes(view[pos:value_end], "little")
+                elif kind == "int64":
+                    value = value - (1 << 64) if value >= 1 << 63 else value
+                elif kind == "bool":
+                    value = value != 0
+
+                if schema_field.repeated:
+                    values[schema_field.name].append(value)
+                else:
+                    values[schema_field.name] = value
+            pos = value_end
+
+    def decode(self, data, start: int = 0, end: int = None):
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        values = self._new_values()
+        self._decode_into(values, view, start, len(view) if end is None else end)
+        return self.record_type(**values)
+
+    def decode_stream(self, fileobj, chunk_size: int = 64 * 1024):
+        """Like :meth:`decode`, reading the message from a binary file object chunk by chunk."""
+        values = self._new_values()
+        stream_parser = StreamParser()
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            fields_data = stream_parser.feed_bytes(chunk)
+            self._decode_into(values, memoryview(fields_data), 0, len(fields_data))
+        return self.record_type(**values)
+
+
+@dataclass(slots=True)
+class ClasspathJar:
+    path: str
+    classpath: int
+    min_sdk_version: str
+    max_sdk_version: str
+
+
+@dataclass(slots=True)
+class ExportedClasspathsJars:
+    jars: List[ClasspathJar]
+
+
+@dataclass(slots=True)
+class ApexManifest:
+    name: str
+    version: int
+    version_name: str
+
+
+# packages/modules/common/proto/classpaths.proto
+CLASSPATH_JAR_SCHEMA = MessageSchema(ClasspathJar, {
+    1: SchemaField("path", "string"),
+    2: SchemaField("classpath", "enum"),
+    3: SchemaField("min_sdk_version", "string"),
+    4: SchemaField("max_sdk_version", "string"),
+})
+
+EXPORTED_CLASSPATHS_JARS_SCHEMA = MessageSchema(ExportedClasspathsJars, {
+    1: SchemaField("jars", "message", repeated=True, schema=CLASSPATH_JAR_SCHEMA),
+})
+
+# system/apex/proto/apex_manifest.proto
+APEX_MANIFEST_SCHEMA = MessageSchema(ApexManifest, {
+    1: SchemaField("name", "string"),
+    2: SchemaField("version", "int64"),
+    6: SchemaField("version_name", "string"),
+})
 
-        # Try to convert the input hex string to UTF-8
-        try:
-            _data = Utils.hex_string_to_utf8(string_or_not)
-        except UnicodeDecodeError:
-            # If a UnicodeDecodeError occurs, it's possibly a nested protobuf
-            return True
-
-        # Check the first 4 characters of the decoded data
-        for c in _data[0:4]:
-            # If any character has an ordinal value less than 0x20,
-            # it's possibly a nested protobuf
-            if ord(c) < 0x20:
-                return True
-
-        # If none of the above conditions were met, it's likely not a nested protobuf
-        return False
 
-    def _get_delimited_data_handler(self, chunk):
-        value = chunk
-        if self._fetcher.has_next:
-            return self._next_get_delimited_data_handler(value)
+def parse_classpath_bin(data):
+    if hasattr(data, "read"):
+        jars = EXPORTED_CLASSPATHS_JARS_SCHEMA.decode_stream(data).jars
+    else:
+        jars = EXPORTED_CLASSPATHS_JARS_SCHEMA.decode(data).jars
+    # Keep the first occurrence of each path, in order
+    return list(dict.fromkeys(jar.path for jar in jars))
 
-        self._buffer.append(value)
-        data = list(map(lambda x: hex(x)[2:].zfill(2), self._buffer))
 
-        string_or_not = "".join(data)
-        if self.is_maybe_nested_protobuf(string_or_not):
-            data = self._create_nested_parser().parse(string_or_not)
-            wire_type = "length_delimited"
-        else:
-            data = Utils.hex_string_to_utf8(string_or_not)
-            wire_type = "string"
+def parse_apx_manifest(data):
+    parser = Parser()
+    results = parser.parse(data).to_dict()["results"]
+    return results
 
-        self._parsed_data.append(
-            ParsedResult(
-                field=self._target_field,
-                wire_type=wire_type,
-                data=data
-            )
-        )
-        self._buffer.flush()
-        self._fetcher.seek()
-        self._state = State.FIND_FIELD
-        self._t.done()
-
-    def _create_parsed_results(self) -> ParsedResults:
-        if not self._t.has_remain_data:
-            return ParsedResults(results=self._parsed_data)
-
-        return ParsedResults(
-            results=self._parsed_data,
-            remain_data=self._t.remain_hex_string
-        )
 
-    def parse(self, test_target) -> ParsedResults:
-        if test_target == "":
-            return self._create_parsed_results()
+def read_apex_manifest(data) -> ApexManifest:
+    return APEX_MANIFEST_SCHEMA.decode(data)
 
-        is_valid, validate_string = Utils.validate(test_target)
-        if not is_valid:
-            raise ValueError("Invalid hex format")
+@dataclass
+class DecodeOutcome:
+    index: int
+    result: object = None
+    error: str = None
 
-        for hex_chunk in Utils.get_chunked_list(validate_string):
-            chunk = Utils.hex_string_to_decimal(hex_chunk)
+    @property
+    def ok(self):
+        return self.error is None
 
-            self._t.consume_chunk(chunk)
 
-            if self._state == State.FIND_FIELD:
-                self._handler_find_field(chunk)
+def decode_blob(blob, strict: bool = False, max_depth: int = DEFAULT_MAX_DEPTH, max_fields: int = None,
+                max_bytes: int = None) -> ParsedResults:
+    return Parser(strict=strict, max_depth=max_depth, max_fields=max_fields, max_bytes=max_bytes).parse(blob)
 
-            elif self._state == State.PARSE_VARINT:
-                self._parse_varint_handler(chunk)
 
-            elif self._state == State.PARSE_LENGTH_DELIMITED:
-                self._parse_length_delimited_handler(chunk)
+def _decode_chunk(decoder, start: int, items) -> List[DecodeOutcome]:
+    outcomes = []
+    for offset, item in enumerate(items):
+        try:
+            outcomes.append(DecodeOutcome(index=start + offset, result=decoder(item)))
+        except Exception as e:
+            outcomes.append(DecodeOutcome(index=start + offset, error=f"{type(e).__name__}: {e}"))
+    return outcomes
 
-            elif self._state == State.GET_DELIMITED_DATA:
-                self._get_delimited_data_handler(chunk)
 
-            elif self._state == State.PARSE_BIT64:
-                self._fetcher.fetch_64bits()
-                self._parse_fixed_handler(chunk)
+def iter_decode_many(blobs, workers: int = None, chunk_size: int = 32, decoder=decode_blob) -> Generator[DecodeOutcome]:
+    """
+    Decode many items on a process pool and yield one :class:`DecodeOutcome` per item,
+    in input order.
 
-            elif self._state == State.PARSE_BIT32:
-                self._fetcher.fetch_32bits()
-                self._parse_fixed_handler(chunk)
+    Items are submitted ``chunk_size`` at a time, with at most two chunks per worker in
+    flight, so ``blobs`` may be a lazy iterable of any length. ``decoder`` is called with
+    each item in a worker process and must be picklable (a module-level function);
+    any exception it raises is captured in the outcome instead of stopping the batch.
+    ``workers=1`` decodes in this process.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
 
-            elif self._state in (State.PARSE_START_GROUP, State.PARSE_END_GROUP):
-                continue
+    def chunks():
+        items = iter(blobs)
+        start = 0
+        while chunk := list(islice(items, chunk_size)):
+            yield start, chunk
+            start += len(chunk)
 
-            elif self._state == State.TERMINATED:
-                pass
+    if workers <= 1:
+        for start, chunk in chunks():
+            yield from _decode_chunk(decoder, start, chunk)
+        return
 
-            else:
-                raise ValueError(f"Unsupported State {self._state}")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, chunk in chunks():
+            pending.append(executor.submit(_decode_chunk, decoder, start, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
 
-        if self._is_strict:
-            assert self._t.is_done, "parsing process is not done, Maybe invalid protobuf"
 
-        return self._create_parsed_results()
+def decode_many(blobs, workers: int = None, chunk_size: int = 32, decoder=decode_blob) -> List[DecodeOutcome]:
+    return list(iter_decode_many(blobs, workers=workers, chunk_size=chunk_size, decoder=decoder))
 
-def parse_classpath_bin(data):
-    parser = Parser()
-    results = parser.parse(binascii.hexlify(data).decode()).to_dict()["results"]
-    ret = []
-    for item in results:
-        path = item["data"]["results"][0]["data"]
-        if not path in ret:
-            ret.append(path)
-    return ret
 
+def _decode_file_to_dict(path, **limits) -> dict:
+    with open(path, "rb") as f:
+        return Parser(**limits).parse(f.read()).to_dict()
 
-def parse_apx_manifest(data):
-    parser = Parser()
-    results = parser.parse(binascii.hexlify(data).decode()).to_dict()["results"]
-    return results
 
 if __name__ == "__main__":
-    import sys, binascii, json
-    # Read from stdin
-    data = sys.stdin.buffer.read()
-    parsed = Parser().parse(binascii.hexlify(data).decode()).to_dict()
-    print(json.dumps(parsed, indent=4))
\ No newline at end of file
+    import sys, json, argparse, functools
+
+    arg_parser = argparse.ArgumentParser(description="Decode a protobuf message read from stdin")
+    arg_parser.add_argument("--stream", action="store_true",
+                            help="print each top-level field as a JSON line as soon as it is decoded")
+    arg_parser.add_argument("--dir", help="decode every .pb file under this directory and print JSON lines")
+    arg_parser.add_argument("--workers", type=int, default=None, help="worker processes for --dir")
+    arg_parser.add_argument("--max-depth", type=int, default=DEFAULT_MAX_DEPTH,
+                            help="maximum nesting depth (default: %(default)s)")
+    arg_parser.add_argument("--max-fields", type=int, default=None, help="maximum number of decoded fields")
+    arg_parser.add_argument("--max-bytes", type=int, default=None, help="maximum number of bytes walked")
+    args = arg_parser.parse_args()
+    limits = dict(max_depth=args.max_depth, max_fields=args.max_fields, max_bytes=args.max_bytes)
+
+    if args.dir:
+        pb_paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(args.dir)
+            for name in names if name.endswith(".pb")
+        )
+        for outcome in iter_decode_many(
+            pb_paths, workers=args.workers, decoder=functools.partial(_decode_file_to_dict, **limits)
+        ):
+            line = dict(path=pb_paths[outcome.index])
+            if outcome.ok:
+                line.update(outcome.result)
+            else:
+                line["error"] = outcome.error
+            print(json.dumps(line))
+    elif args.stream:
+        stream_parser = StreamParser(**limits)
+        while True:
+            chunk = sys.stdin.buffer.read1(64 * 1024)
+            if not chunk:
+                break
+            for result in stream_parser.feed(chunk):
+                print(json.dumps(result.to_dict()), flush=True)
+        remain_data = stream_parser.close()
+        if remain_data is not None:
+            print(json.dumps(dict(remain_data=remain_data)))
+    else:
+        # Read from stdin
+        data = sys.stdin.buffer.read()
+        parsed = Parser(**limits).parse(data).to_dict()
+        print(json.dumps(parsed, indent=4))
@@ -0,0 +1,177 @@
+import os, re, sys, math, argparse
+from collections import Counter
+from dataclasses import dataclass
+
+KNOWLEDGE_BASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt", "rag_knowledgebase.txt")
+
+SIGNATURE_PATTERN = re.compile(r"<([\w.$]+): [^ ]+ ([\w$<>]+)\(")
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z][A-Za-z0-9]*")
+WORD_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+# Java keywords and Binder boilerplate that say nothing about the module
+STOP_WORDS = {
+    "a", "an", "and", "as", "at", "by", "for", "from", "in", "of", "on", "or", "the", "to", "with",
+    "abstract", "boolean", "break", "byte", "case", "catch", "char", "class", "else", "extends", "false",
+    "final", "finally", "float", "if", "import", "instanceof", "int", "interface", "long", "new", "null",
+    "private", "protected", "public", "return", "short", "static", "super", "switch", "synchronized", "this",
+    "throw", "throws", "true", "try", "void", "while", "string", "object", "exception", "remote", "parcel",
+    "binder", "transact", "stub", "proxy", "impl", "get", "set", "is", "m", "i", "e", "com", "android",
+    "server", "internal", "service", "manager",
+}
+SUFFIXES = ("ing", "ed", "es", "s", "e")
+
+
+def stem(word: str) -> str:
+    if word.endswith("ss"):
+        return word
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split identifiers and prose alike into lower-case stemmed words, camel case
+    included. Short identifiers are also kept whole, so "WiFi" and "Wifi" match.
+    """
+    words = []
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        pieces = WORD_PATTERN.findall(identifier)
+        words.extend(piece.lower() for piece in pieces)
+        if len(pieces) > 1 and len(identifier) <= 8:
+            words.append(identifier.lower())
+    return [stem(word) for word in words if word not in STOP_WORDS]
+
+
+@dataclass
+class KnowledgeEntry:
+    module: str
+    categories: list[str]
+
+    def __str__(self):
+        return f"{self.module}: {' | '.join(self.categories)}"
+
+
+def load_knowledge_base(path: str = KNOWLEDGE_BASE_PATH) -> list[KnowledgeEntry]:
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            module, sep, categories = line.partition(":")
+            if not sep:
+                continue
+            entries.append(KnowledgeEntry(
+                module.strip(), [category.strip() for category in categories.split("|") if category.strip()]
+            ))
+    return entries
+
+
+class BM25Index:
+    """Okapi BM25 over pre-tokenized documents."""
+
+    def __init__(self, documents: list[list[str]], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(document) for document in documents]
+        self.lengths = [len(document) for document in documents]
+        self.average_length = sum(self.lengths) / len(documents) if documents else 0.0
+        document_frequency = Counter(term for counts in self.term_counts for term in counts)
+        self.idf = {
+            term: math.log(1 + (len(documents) - freq + 0.5) / (freq + 0.5))
+            for term, freq in document_frequency.items()
+        }
+
+    def scores(self, query: dict[str, float]) -> list[float]:
+        """Score every document for ``query``, a mapping of term to query weight."""
+        scores = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / self.average_length)
+            score = 0.0
+            for term, weight in query.items():
+                tf = counts.get(term)
+                if tf:
+                    score += weight * self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+
+class KnowledgeIndex:
+    """
+    Retrieves the knowledge base modules most relevant to a Binder method. Words of the
+    fully qualified class name weigh ``class_weight`` and words of the method name
+    ``method_weight`` times as much as words from the source. Module names are also
+    scored as a field of their own, added ``module_weight`` times to the score of the
+    whole entry, so a method of the notification service is not outranked by a module
+    that merely lists more matching categories.
+    """
+
+    def __init__(self, entries: list[KnowledgeEntry], class_weight: float = 3.0, method_weight: float = 2.0,
+                 module_weight: float = 1.0):
+        self.entries = entries
+        self.class_weight = class_weight
+        self.method_weight = method_weight
+        self.module_weight = module_weight
+        self.index = BM25Index([tokenize(str(entry)) for entry in entries])
+        self.module_index = BM25Index([tokenize(entry.module) for entry in entries])
+
+    @classmethod
+    def load(cls, path: str = KNOWLEDGE_BASE_PATH, **kwargs):
+        return cls(load_knowledge_base(path), **kwargs)
+
+    def query(self, class_name: str = "", method_name: str = "", source: str = "") -> dict[str, float]:
+        # Only whether a word occurs in the source counts, so long methods do not drown the names
+        query = {term: 1.0 for term in tokenize(source)}
+        for term in tokenize(method_name):
+            query[term] = max(query.get(term, 0.0), self.method_weight)
+        for term in tokenize(class_name):
+            query[term] = max(query.get(term, 0.0), self.class_weight)
+        return query
+
+    def search(self, class_name: str = "", method_name: str = "", source: str = "", k: int = 3):
+        """Return up to ``k`` ``(entry, score)`` pairs, best first, leaving out modules with no match."""
+        query = self.query(class_name, method_name, source)
+        scores = [
+            score + self.module_weight * module_score
+            for score, module_score in zip(self.index.scores(query), self.module_index.scores(query))
+        ]
+        ranked = sorted(zip(self.entries, scores), key=lambda item: item[1], reverse=True)
+        return [(entry, score) for entry, score in ranked[:k] if score > 0]
+
+    def knowledge_for(self, signature: str, source: str = "", k: int = 3) -> str:
+        """The ``knowledge_placeholder`` text for a method given by its Soot signature."""
+        class_name, method_name = parse_signature(signature)
+        return "\n".join(str(entry) for entry, _ in self.search(class_name, method_name, source, k))
+
+
+def parse_signature(signature: str) -> tuple[str, str]:
+    match = SIGNATURE_PATTERN.search(signature)
+    return (match.group(1), match.group(2)) if match else ("", signature)
+
+
+def fill_prompt(template: str, **values) -> str:
+    """Replace each ``<name>_placeholder`` in a prompt template with ``values[name]``."""
+    for name, value in values.items():
+        template = template.replace(f"{name}_placeholder", str(value))
+    return template
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Show the knowledge base modules retrieved for a method")
+    arg_parser.add_argument("signature", help="Soot signature, e.g. '<com.android.server.wifi.WifiServiceImpl: "
+                                              "boolean setWifiEnabled(java.lang.String,boolean)>'")
+    arg_parser.add_argument("source", nargs="?", help="file with the method source, - for stdin")
+    arg_parser.add_argument("-k", type=int, default=3)
+    arg_parser.add_argument("--knowledge-base", default=KNOWLEDGE_BASE_PATH)
+    args = arg_parser.parse_args()
+
+    method_source = ""
+    if args.source == "-":
+        method_source = sys.stdin.read()
+    elif args.source:
+        with open(args.source, "r", encoding="utf-8") as f:
+            method_source = f.read()
+
+    knowledge_index = KnowledgeIndex.load(args.knowledge_base)
+    owner, name = parse_signature(args.signature)
+    for entry, entry_score in knowledge_index.search(owner, name, method_source, args.k):
+        print(f"{entry_score:6.2f}  {entry}")